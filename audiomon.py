@@ -0,0 +1,420 @@
+"""Audio path monitoring.
+
+The monitor has its own JACK client, which collects xruns, DSP load and
+buffer size and sample rate changes.  Once a second these are turned into a
+Sample for the current config, so we get a time series per config, and
+added to the config's totals for the current buffer size.  The totals are
+what we need to pick the smallest buffer size that a config runs at without
+xruns, so they're kept across restarts in AUDIO_STATS_FILE.
+
+There's also an optional latency probe, which sends an impulse out of a
+playback port and times its arrival at a capture port.  This needs a
+loopback cable between the two (and the impulse is audible otherwise), so
+it's only run automatically if the ports are given in the
+PIDAL_LATENCY_PROBE environment variable ("<playback>,<capture>").  It can
+also be run from the command line:
+
+    python3 audiomon.py latency system:playback_1 system:capture_1
+    python3 audiomon.py watch
+"""
+
+from __future__ import annotations
+
+import asyncio
+import attr
+from boot import lazy_import
+from collections import deque
+from events import Topic
+import jack
+import json
+import os
+from snapshot import SnapshotWriter
+import sys
+import threading
+import time
+from typing import Any, Deque, Dict, Optional, Tuple
+
+np = lazy_import('numpy')
+
+AUDIO_STATS_FILE = os.path.expanduser('~/.pidal/audio-stats.json')
+LATENCY_PROBE_ENV = 'PIDAL_LATENCY_PROBE'
+
+# Time between samples, in seconds.
+SAMPLE_INTERVAL = 1.0
+
+# Number of samples kept for each config.
+MAX_SAMPLES = 600
+
+# Time a config must have been running before its latency is probed, so
+# that mod-host has finished loading plugins.
+PROBE_DELAY = 5.0
+
+@attr.s(frozen=True)
+class Sample:
+    """Audio path measurements over one sample interval.
+
+    Attributes:
+        time: End of the interval.
+        cpu_load: JACK DSP load, percent.
+        xruns: Number of xruns during the interval.
+        max_delay: Longest xrun delay in the interval, microseconds.
+        blocksize: Buffer size (frames per period).
+        samplerate: Sample rate.
+        changed: True if the buffer size or sample rate changed during the
+            interval.  These are expected to cause xruns, so these samples
+            aren't counted in the totals.
+    """
+    time : float = attr.ib()
+    cpu_load : float = attr.ib()
+    xruns : int = attr.ib()
+    max_delay : float = attr.ib()
+    blocksize : int = attr.ib()
+    samplerate : int = attr.ib()
+    changed : bool = attr.ib(default=False)
+
+# Published for every sample: (config name, sample).
+AUDIO_SAMPLE = Topic('audio_sample', (str, Sample))
+
+@attr.s
+class Totals:
+    """Accumulated measurements of a config at one buffer size."""
+    seconds : float = attr.ib(default=0.0)
+    xruns : int = attr.ib(default=0)
+    cpu_total : float = attr.ib(default=0.0)
+    cpu_max : float = attr.ib(default=0.0)
+
+    # Measured round-trip latency in milliseconds, None if not measured.
+    latency : Optional[float] = attr.ib(default=None)
+
+    def add(self, sample: Sample, seconds: float) -> None:
+        self.seconds += seconds
+        self.xruns += sample.xruns
+        self.cpu_total += sample.cpu_load * seconds
+        self.cpu_max = max(self.cpu_max, sample.cpu_load)
+
+    @property
+    def cpu_mean(self) -> float:
+        return self.cpu_total / self.seconds if self.seconds else 0.0
+
+    @property
+    def xrun_rate(self) -> float:
+        """Xruns per hour."""
+        return self.xruns * 3600 / self.seconds if self.seconds else 0.0
+
+    def to_json(self) -> Dict[str, Any]:
+        return attr.asdict(self)
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> Totals:
+        return cls(**{key: value for key, value in data.items()
+                      if key in attr.fields_dict(cls)
+                      })
+
+class ConfigStats:
+    """Measurements for one config.
+
+    Attributes:
+        samples: The most recent samples.
+        totals: Totals by buffer size.
+    """
+
+    def __init__(self):
+        self.samples : Deque[Sample] = deque(maxlen=MAX_SAMPLES)
+        self.totals : Dict[int, Totals] = {}
+
+    def get_totals(self, blocksize: int) -> Totals:
+        totals = self.totals.get(blocksize)
+        if totals is None:
+            totals = self.totals[blocksize] = Totals()
+        return totals
+
+class _LatencyProbe:
+    """Process callback state for measure_latency()."""
+
+    def __init__(self, client: jack.Client, threshold: float):
+        self.client = client
+        self.threshold = threshold
+        self.out = client.outports.register('probe_out')
+        self.inp = client.inports.register('probe_in')
+        self.armed = threading.Event()
+        self.done = threading.Event()
+        self.sent : Optional[int] = None
+        self.latency : Optional[int] = None
+
+    def process(self, frames: int) -> None:
+        out = self.out.get_array()
+        out.fill(0)
+        if not self.armed.is_set() or self.done.is_set():
+            return
+        if self.sent is None:
+            out[0] = 1.0
+            self.sent = self.client.last_frame_time
+            return
+        hits = np.flatnonzero(np.abs(self.inp.get_array()) > self.threshold)
+        if hits.size:
+            self.latency = \
+                self.client.last_frame_time + int(hits[0]) - self.sent
+            self.done.set()
+
+def measure_latency(playback: str, capture: str, timeout: float = 2.0,
+                    threshold: float = 0.1
+                    ) -> Optional[int]:
+    """Measure the round-trip latency from 'playback' to 'capture'.
+
+    This uses a temporary JACK client, so there's no process callback
+    overhead when we're not measuring.
+
+    Args:
+        playback: Name of the JACK playback port to send the impulse to.
+        capture: Name of the JACK capture port connected to 'playback' by
+            a loopback cable.
+        timeout: Seconds to wait for the impulse.
+        threshold: Input level at which the impulse is detected.
+
+    Returns the latency in frames, None if the impulse didn't arrive.
+    """
+    client = jack.Client('pidal-latency')
+    probe = _LatencyProbe(client, threshold)
+    client.set_process_callback(probe.process)
+    with client:
+        client.connect(probe.out, playback)
+        client.connect(capture, probe.inp)
+        probe.armed.set()
+        probe.done.wait(timeout)
+    return probe.latency
+
+class AudioMonitor:
+    """Collects JACK measurements per config.
+
+    Attributes:
+        client: The monitor's JACK client.
+        config_name: Name of the current config, measurements are
+            attributed to it.
+        stats: Measurements by config name.
+        latency_ports: (playback, capture) ports for the latency probe,
+            None if the probe shouldn't run automatically.
+    """
+
+    def __init__(self, filename: Optional[str] = AUDIO_STATS_FILE,
+                 interval: float = SAMPLE_INTERVAL
+                 ):
+        """
+        Args:
+            filename: File the totals are stored in, None to not store
+                them.
+            interval: Time between samples, in seconds.
+        """
+        self.interval = interval
+        self.client = jack.Client('pidal-monitor')
+        self.client.set_xrun_callback(self.__xrun)
+        self.client.set_blocksize_callback(self.__blocksize_changed)
+        self.client.set_samplerate_callback(self.__samplerate_changed)
+        self.config_name : Optional[str] = None
+        self.__config_time = 0.0
+        self.stats : Dict[str, ConfigStats] = {}
+
+        ports = os.environ.get(LATENCY_PROBE_ENV)
+        self.latency_ports : Optional[Tuple[str, str]] = \
+            tuple(ports.split(',', 1)) if ports else None
+
+        # Written by the JACK callbacks, read by the sampler.  There's only
+        # one writer for each, so they don't need a lock.
+        self.__xruns = 0
+        self.__max_delay = 0.0
+        self.__changes = 0
+
+        # Values as of the last sample.
+        self.__last_xruns = 0
+        self.__last_changes = 0
+        self.__last_time = time.time()
+        self.__lock = threading.Lock()
+
+        self.__writer : Optional[SnapshotWriter] = None
+        if filename:
+            self.__writer = SnapshotWriter(self.to_json, filename,
+                                           min_interval=30.0
+                                           )
+            self.__load(filename)
+
+    def __load(self, filename: str) -> None:
+        try:
+            with open(filename) as src:
+                data = json.load(src)
+        except (OSError, ValueError):
+            return
+        for name, by_blocksize in data.items():
+            stats = self.stats[name] = ConfigStats()
+            for blocksize, totals in by_blocksize.items():
+                stats.totals[int(blocksize)] = Totals.from_json(totals)
+
+    def to_json(self) -> Dict[str, Any]:
+        """Returns the totals of all configs, as stored in the stats file.
+        """
+        return {name: {str(blocksize): totals.to_json()
+                       for blocksize, totals in sorted(stats.totals.items())
+                       }
+                for name, stats in self.stats.items()
+                }
+
+    # JACK callbacks.  These run in JACK's notification thread, so they
+    # mustn't call into JACK.
+
+    def __xrun(self, delayed_usecs: float) -> None:
+        self.__xruns += 1
+        self.__max_delay = max(self.__max_delay, delayed_usecs)
+
+    def __blocksize_changed(self, blocksize: int) -> None:
+        self.__changes += 1
+
+    def __samplerate_changed(self, samplerate: int) -> None:
+        self.__changes += 1
+
+    def start(self) -> None:
+        """Activate the JACK client."""
+        self.client.activate()
+
+    def set_config(self, name: str) -> None:
+        """Attribute measurements to config 'name' from now on."""
+        self.sample()
+        with self.__lock:
+            self.config_name = name
+            self.__config_time = time.time()
+
+    def get_stats(self, name: str) -> ConfigStats:
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = ConfigStats()
+        return stats
+
+    def sample(self) -> Optional[Sample]:
+        """Take a sample, attributing the interval since the last one to the
+        current config.
+
+        Returns the sample, None if there's no current config.
+        """
+        with self.__lock:
+            now = time.time()
+            xruns = self.__xruns
+            changes = self.__changes
+            max_delay, self.__max_delay = self.__max_delay, 0.0
+            sample = Sample(now, self.client.cpu_load(),
+                            xruns - self.__last_xruns,
+                            max_delay,
+                            self.client.blocksize,
+                            self.client.samplerate,
+                            changes != self.__last_changes
+                            )
+            seconds = now - self.__last_time
+            self.__last_xruns = xruns
+            self.__last_changes = changes
+            self.__last_time = now
+            name = self.config_name
+            if name is None:
+                return None
+
+            stats = self.get_stats(name)
+            stats.samples.append(sample)
+            if not sample.changed:
+                stats.get_totals(sample.blocksize).add(sample, seconds)
+            self.__mark_dirty()
+        AUDIO_SAMPLE.publish(name, sample)
+        return sample
+
+    def probe_latency(self) -> Optional[float]:
+        """Measure the round-trip latency on 'latency_ports' and record it
+        for the current config and buffer size.
+
+        Returns the latency in milliseconds, None if it couldn't be
+        measured.
+        """
+        name = self.config_name
+        if not self.latency_ports or name is None:
+            return None
+        try:
+            frames = measure_latency(*self.latency_ports)
+        except jack.JackError as ex:
+            print(f'Latency probe failed: {ex}')
+            return None
+        if frames is None:
+            print(f'Latency probe on {self.latency_ports} timed out')
+            return None
+        latency = frames * 1000 / self.client.samplerate
+        self.get_stats(name).get_totals(self.client.blocksize).latency = \
+            latency
+        self.__mark_dirty()
+        return latency
+
+    def __mark_dirty(self) -> None:
+        if self.__writer:
+            self.__writer.mark_dirty()
+
+    def __needs_probe(self) -> bool:
+        if not self.latency_ports or self.config_name is None or \
+                time.time() - self.__config_time < PROBE_DELAY:
+            return False
+        totals = self.get_stats(self.config_name).totals.get(
+            self.client.blocksize
+        )
+        return totals is not None and totals.latency is None
+
+    async def run(self) -> None:
+        """The sampler, run this in the engine's event loop."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            self.sample()
+            if self.__needs_probe():
+                await loop.run_in_executor(None, self.probe_latency)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Returns the current measurements and the totals of the current
+        config, for the remote API.
+        """
+        result : Dict[str, Any] = {
+            'config': self.config_name,
+            'cpu_load': self.client.cpu_load(),
+            'blocksize': self.client.blocksize,
+            'samplerate': self.client.samplerate,
+            'xruns': self.__xruns,
+        }
+        stats = self.stats.get(self.config_name)
+        if stats:
+            result['totals'] = {
+                str(blocksize): dict(totals.to_json(),
+                                     cpu_mean=totals.cpu_mean,
+                                     xrun_rate=totals.xrun_rate
+                                     )
+                for blocksize, totals in sorted(stats.totals.items())
+            }
+        return result
+
+    def get_series(self) -> Dict[str, Any]:
+        """Returns the sample time series of all configs."""
+        return {name: [attr.asdict(sample) for sample in stats.samples]
+                for name, stats in self.stats.items()
+                }
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'latency':
+        client = jack.Client('pidal-latency-info')
+        frames = measure_latency(sys.argv[2], sys.argv[3])
+        if frames is None:
+            print('no impulse received')
+            sys.exit(1)
+        print(f'{frames} frames, '
+              f'{frames * 1000 / client.samplerate:.2f} ms '
+              f'at {client.blocksize} frames per period')
+    elif len(sys.argv) == 2 and sys.argv[1] == 'watch':
+        monitor = AudioMonitor(filename=None)
+        monitor.start()
+        monitor.config_name = 'watch'
+        while True:
+            time.sleep(monitor.interval)
+            sample = monitor.sample()
+            print(f'load {sample.cpu_load:5.1f}%  xruns {sample.xruns}  '
+                  f'{sample.blocksize}/{sample.samplerate}'
+                  f'{"  (changed)" if sample.changed else ""}')
+    else:
+        print(f'usage: {sys.argv[0]} latency <playback-port> <capture-port>'
+              f'\n       {sys.argv[0]} watch')
+        sys.exit(1)
@@ -0,0 +1,262 @@
+"""Audio taps for analysis.
+
+An AudioTap is a JACK client whose process callback copies the frames of
+some ports into RingBuffers.  Consumers (the tuner, level meters, auto-gain)
+read windows of the most recent frames from the ring buffers without
+blocking the process callback and without copying: a ring buffer stores
+every frame twice, in two consecutive halves of its array, so any window of
+up to 'capacity' frames is a contiguous slice of the array and window()
+returns a view.
+
+The ring buffers are single producer (the process callback) lock-free: the
+producer writes the frames, then advances the frame count, and a consumer
+reads the frame count, then slices.  A view stays valid until the producer
+has written another (capacity - window size) frames, which is seconds for
+the default capacity, much longer than any analysis takes.
+
+Taps are shared and only exist while in use, get them with get_tap():
+
+    tap = get_tap(['system:capture_1'])
+    tap.acquire()
+    ...
+    frames = tap.rings[0].window(4096)
+    ...
+    tap.release()
+
+Run this module for microbenchmarks of the process callback:
+
+    python3 audiotap.py
+
+The benchmarks use fake ports, so they measure our part of the callback but
+not JACK's port buffer lookup or the call into Python.
+"""
+
+from __future__ import annotations
+
+from boot import lazy_import
+import jack
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Deferred, since numpy takes a while to import and is only needed once
+# we're running (see boot.py).
+np = lazy_import('numpy')
+
+# Default ring buffer capacity, in seconds.
+TAP_SECONDS = 2.0
+
+class RingBuffer:
+    """Single producer ring buffer of audio frames.
+
+    Attributes:
+        capacity: Number of frames held.
+        written: Total number of frames ever written.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.written = 0
+        self.__data = np.zeros(2 * capacity, dtype=np.float32)
+
+    def write(self, frames: np.ndarray) -> None:
+        """Append 'frames', which must be no more than 'capacity' frames.
+
+        Only one thread may write.
+        """
+        count = len(frames)
+        capacity = self.capacity
+        data = self.__data
+        pos = self.written % capacity
+        end = pos + count
+        data[pos:end] = frames
+        if end <= capacity:
+            data[pos + capacity:end + capacity] = frames
+        else:
+            split = capacity - pos
+            data[pos + capacity:] = frames[:split]
+            data[:end - capacity] = frames[split:]
+        self.written += count
+
+    def window(self, count: int, end: Optional[int] = None) -> np.ndarray:
+        """Returns a view of 'count' frames.
+
+        Args:
+            count: Number of frames, at most 'capacity'.
+            end: Frame count (as in 'written') of the end of the window,
+                defaults to the most recent frame.  Must be within
+                'capacity' frames of 'written'.
+        """
+        if end is None:
+            end = self.written
+        pos = end % self.capacity + self.capacity
+        return self.__data[pos - count:pos]
+
+class AudioTap:
+    """A JACK client copying ports into ring buffers.
+
+    Attributes:
+        ports: Names of the tapped ports.
+        rings: Ring buffer of each port.
+        samplerate: The JACK sample rate, valid while acquired.
+    """
+
+    def __init__(self, ports: Sequence[Optional[str]],
+                 seconds: float = TAP_SECONDS,
+                 client_name: str = 'pidal-tap'
+                 ):
+        """
+        Args:
+            ports: Names of the JACK ports to tap.  A channel can be left
+                unconnected with None, see set_sources().
+            seconds: Ring buffer capacity.
+            client_name: JACK client name.
+        """
+        self.ports = list(ports)
+        self.seconds = seconds
+        self.client_name = client_name
+        self.rings : List[RingBuffer] = []
+        self.samplerate = 0
+        self.__client : Optional[jack.Client] = None
+        self.__users = 0
+        self.__lock = threading.Lock()
+
+        # (input port, ring buffer) pairs, used by the process callback.
+        # Port objects have a get_array() method.
+        self._channels : List[Tuple[object, RingBuffer]] = []
+
+    @property
+    def running(self) -> bool:
+        return self.__client is not None
+
+    def acquire(self) -> None:
+        """Start the tap if this is its first user."""
+        with self.__lock:
+            self.__users += 1
+            if self.__client:
+                return
+            client = jack.Client(self.client_name)
+            self.samplerate = client.samplerate
+            capacity = max(int(self.seconds * self.samplerate),
+                           client.blocksize
+                           )
+            self.rings = [RingBuffer(capacity) for port in self.ports]
+            self._channels = [
+                (client.inports.register(f'in_{i + 1}'), ring)
+                for i, ring in enumerate(self.rings)
+            ]
+            client.set_process_callback(self._process)
+            client.activate()
+            self.__client = client
+            for i, port in enumerate(self.ports):
+                if port:
+                    self.__connect(i, port)
+
+    def __connect(self, channel: int, port: str) -> None:
+        try:
+            self.__client.connect(port, self._channels[channel][0])
+        except jack.JackError as ex:
+            print(f'Unable to tap {port}: {ex}')
+
+    def set_sources(self, channel: int, ports: Sequence[str]) -> None:
+        """Connect a channel of a running tap to 'ports' (and only those).
+
+        JACK mixes the signals of all of the ports connected to an input,
+        so the channel gets their sum.
+        """
+        with self.__lock:
+            if not self.__client:
+                return
+            input = self._channels[channel][0]
+            current = {port.name
+                       for port in self.__client.get_all_connections(input)
+                       }
+            for name in current - set(ports):
+                self.__client.disconnect(name, input)
+            for name in set(ports) - current:
+                self.__connect(channel, name)
+
+    def release(self) -> None:
+        """Stop the tap if this is its last user."""
+        with self.__lock:
+            self.__users -= 1
+            if self.__users > 0 or not self.__client:
+                return
+            self.__users = 0
+            self.__client.deactivate()
+            self.__client.close()
+            self.__client = None
+
+    def _process(self, frames: int) -> None:
+        """The JACK process callback."""
+        for input, ring in self._channels:
+            ring.write(input.get_array())
+
+_taps : Dict[Tuple[Optional[str], ...], AudioTap] = {}
+_taps_lock = threading.Lock()
+
+def get_tap(ports: Sequence[Optional[str]]) -> AudioTap:
+    """Returns the shared tap of 'ports', creating it if necessary.
+
+    The tap still needs to be acquired to run.
+    """
+    key = tuple(ports)
+    with _taps_lock:
+        tap = _taps.get(key)
+        if tap is None:
+            tap = _taps[key] = AudioTap(ports, client_name=
+                                        f'pidal-tap-{len(_taps) + 1}'
+                                        )
+        return tap
+
+if __name__ == '__main__':
+    class _FakePort:
+        def __init__(self, frames: int):
+            self.array = np.random.default_rng(0).normal(
+                0, 0.1, frames
+            ).astype(np.float32)
+
+        def get_array(self) -> np.ndarray:
+            return self.array
+
+    rate = 48000
+    iterations = 20000
+
+    # Check the ring buffer against a plain concatenation first.
+    ring = RingBuffer(1000)
+    expected = np.zeros(0, dtype=np.float32)
+    for i in range(50):
+        block = np.arange(i * 96, (i + 1) * 96, dtype=np.float32)
+        ring.write(block)
+        expected = np.concatenate((expected, block))
+        for count in (1, 96, 500, 1000):
+            if count <= len(expected) and \
+                    not np.array_equal(ring.window(count), expected[-count:]):
+                raise SystemExit(f'ring buffer mismatch at {i}, {count}')
+    print('ring buffer ok')
+
+    for frames in (64, 128, 256):
+        for channels in (1, 2):
+            tap = AudioTap(['bench'] * channels)
+            rings = [RingBuffer(int(TAP_SECONDS * rate))
+                     for i in range(channels)
+                     ]
+            tap._channels = [(_FakePort(frames), ring) for ring in rings]
+            start = time.perf_counter()
+            for i in range(iterations):
+                tap._process(frames)
+            elapsed = (time.perf_counter() - start) / iterations
+            period = frames / rate
+            print(f'{frames:4d} frames, {channels} channel(s): '
+                  f'{elapsed * 1e6:6.2f} us per callback, '
+                  f'{100 * elapsed / period:5.2f}% of the period')
+
+    # Consumer side: a window is a view, its cost doesn't depend on size.
+    ring = RingBuffer(int(TAP_SECONDS * rate))
+    ring.write(np.zeros(4096, dtype=np.float32))
+    for count in (256, 4096):
+        start = time.perf_counter()
+        for i in range(iterations):
+            ring.window(count)
+        elapsed = (time.perf_counter() - start) / iterations
+        print(f'window({count}): {elapsed * 1e6:.2f} us')
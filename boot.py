@@ -0,0 +1,253 @@
+"""Startup profiler.
+
+Records a timeline of the boot: interpreter startup, module imports,
+waits for helper programs to come up, deliberate sleeps, engine and UI
+initialization and the first paint of the UI.  main.py calls start()
+before importing anything else (so that all other imports are timed) and
+finish() once the UI is up and the engine is initialized, which prints the
+timeline and writes it to BOOT_FILE.  The remote API serves it as the
+'boot' metric.  Nothing is recorded outside of start()/finish(), so
+modules can use span() and sleep() without caring whether they're part of
+a boot.
+
+Imports are timed by wrapping the __import__ builtin until finish(), so
+they show up nested the way they happen: an import's time includes the
+imports it triggers.  Waits and sleeps are recorded by the code doing them
+with span() and sleep(), which cost nothing outside of the boot.
+
+This module also provides lazy_import(), used to defer heavy modules
+(numpy in particular) that are only needed after boot.
+"""
+
+from __future__ import annotations
+
+import builtins
+from contextlib import contextmanager
+from importlib import import_module
+import os
+from snapshot import write_atomically
+import sys
+import threading
+import time
+import types
+from typing import Any, Dict, Iterator, List, Optional
+
+BOOT_FILE = os.path.expanduser('~/.pidal/boot.json')
+
+# Imports that take less time than this are left out of the timeline (but
+# are still included in the time of the imports that triggered them).
+MIN_IMPORT_TIME = 0.005
+
+# Event kinds.
+INTERPRETER = 'interpreter'
+IMPORT = 'import'
+WAIT = 'wait'
+SLEEP = 'sleep'
+INIT = 'init'
+MARK = 'mark'
+
+class Event:
+    """An entry in the boot timeline.
+
+    Attributes:
+        name: What happened.
+        kind: One of the event kinds (IMPORT, WAIT...)
+        start: Start time, in seconds from the start of the process.
+        duration: Duration in seconds, 0 for marks.
+        depth: Nesting depth (of imports and spans).
+    """
+
+    def __init__(self, name: str, kind: str, start: float, depth: int):
+        self.name = name
+        self.kind = kind
+        self.start = start
+        self.duration = 0.0
+        self.depth = depth
+
+    def to_json(self) -> Dict[str, Any]:
+        return {'name': self.name, 'kind': self.kind,
+                'start': round(self.start, 4),
+                'duration': round(self.duration, 4), 'depth': self.depth
+                }
+
+def _process_age() -> float:
+    """Returns the time since the process was started, in seconds."""
+    try:
+        with open('/proc/self/stat') as src:
+            start_ticks = int(src.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as src:
+            uptime = float(src.read().split()[0])
+        return max(uptime - start_ticks / os.sysconf('SC_CLK_TCK'), 0.0)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+# Time of the start of the process, on the time.monotonic() clock.
+_origin = time.monotonic() - _process_age()
+_events : List[Event] = [Event('python startup', INTERPRETER, 0.0, 0)]
+_events[0].duration = time.monotonic() - _origin
+_lock = threading.Lock()
+_depth = threading.local()
+
+# True between start() and finish().
+_active = False
+_finished = False
+_original_import = builtins.__import__
+
+def _now() -> float:
+    return time.monotonic() - _origin
+
+@contextmanager
+def span(name: str, kind: str = INIT) -> Iterator[None]:
+    """Context manager recording the enclosed code in the timeline.
+
+    Does nothing outside of the boot.
+    """
+    if not _active:
+        yield
+        return
+    depth = getattr(_depth, 'value', 0)
+    event = Event(name, kind, _now(), depth)
+    _depth.value = depth + 1
+    try:
+        yield
+    finally:
+        _depth.value = depth
+        event.duration = _now() - event.start
+        with _lock:
+            _events.append(event)
+
+def mark(name: str) -> None:
+    """Record a point in time (e.g. the first paint of the UI)."""
+    if _active:
+        with _lock:
+            _events.append(Event(name, MARK, _now(),
+                                 getattr(_depth, 'value', 0)
+                                 ))
+
+def sleep(seconds: float, reason: str) -> None:
+    """time.sleep(), recorded in the timeline as a sleep for 'reason'."""
+    with span(reason, SLEEP):
+        time.sleep(seconds)
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    # Only time imports that actually load something.  Relative imports
+    # aren't used in this code base, but the check is just a dict lookup
+    # for them too.
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    depth = getattr(_depth, 'value', 0)
+    event = Event(name, IMPORT, _now(), depth)
+    _depth.value = depth + 1
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _depth.value = depth
+        event.duration = _now() - event.start
+        if event.duration >= MIN_IMPORT_TIME:
+            with _lock:
+                _events.append(event)
+
+def start() -> None:
+    """Start recording the boot."""
+    global _active
+    if not _active and not _finished:
+        _active = True
+        builtins.__import__ = _timed_import
+
+def get_timeline() -> List[Dict[str, Any]]:
+    """Returns the timeline, ordered by start time."""
+    with _lock:
+        return [event.to_json()
+                for event in sorted(_events, key=lambda e: e.start)
+                ]
+
+def format_timeline() -> str:
+    lines = []
+    for event in get_timeline():
+        if event['kind'] == MARK:
+            duration = ''
+        else:
+            duration = f'{event["duration"] * 1000:.0f}ms'
+        lines.append(f'{event["start"]:7.3f}s {duration:>8} '
+                     f'{event["kind"]:11} '
+                     f'{"  " * event["depth"]}{event["name"]}'
+                     )
+    return '\n'.join(lines)
+
+def get_totals() -> Dict[str, float]:
+    """Returns the total time by event kind (top level events only, so that
+    nested time isn't counted twice) and the total boot time.
+    """
+    totals : Dict[str, float] = {}
+    with _lock:
+        for event in _events:
+            if not event.depth:
+                totals[event.kind] = totals.get(event.kind, 0.0) + \
+                    event.duration
+        totals['boot'] = max((event.start + event.duration
+                              for event in _events
+                              ),
+                             default=0.0
+                             )
+    totals.pop(MARK, None)
+    return totals
+
+def get_metrics() -> Dict[str, Any]:
+    """Returns the timeline and totals, for the remote API."""
+    return {'finished': _finished, 'totals': get_totals(),
+            'timeline': get_timeline()
+            }
+
+def finish(filename: Optional[str] = BOOT_FILE) -> None:
+    """End the boot: stop recording, print the timeline and write it to
+    'filename' (if provided).
+    """
+    global _active, _finished
+    if not _active:
+        return
+    mark('boot complete')
+    _active = False
+    _finished = True
+    if builtins.__import__ is _timed_import:
+        builtins.__import__ = _original_import
+    print('Boot timeline:')
+    print(format_timeline())
+    print('Totals: ' + ', '.join(f'{kind} {seconds:.2f}s'
+                                 for kind, seconds in get_totals().items()
+                                 ))
+    if filename:
+        try:
+            write_atomically(filename, get_metrics())
+        except OSError as ex:
+            print(f'Unable to write {filename}: {ex}')
+
+class LazyModule(types.ModuleType):
+    """A module that is imported on first attribute access.
+
+    Don't use this for modules whose attributes are needed at import time
+    (base classes, decorators, default argument values), that just moves
+    the import.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__lock = threading.Lock()
+        self.__module : Optional[types.ModuleType] = None
+
+    def __getattr__(self, attr: str) -> Any:
+        # Only called for attributes that aren't in our __dict__.
+        with self.__lock:
+            if self.__module is None:
+                self.__module = sys.modules.get(self.__name__)
+            if self.__module is None:
+                with span(f'{self.__name__} (deferred)', IMPORT):
+                    self.__module = import_module(self.__name__)
+        value = getattr(self.__module, attr)
+        setattr(self, attr, value)
+        return value
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Returns module 'name', imported on first use if it hasn't already
+    been imported.
+    """
+    return sys.modules.get(name) or LazyModule(name)
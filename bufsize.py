@@ -0,0 +1,219 @@
+"""Adaptive JACK buffer sizing.
+
+Rather than running every config at the buffer size that the heaviest one
+needs, we keep a target buffer size for each config and switch JACK to it
+when the config is selected.
+
+Targets are learned from the audio monitor's samples (see audiomon):
+
+-   A config that gets an xrun at its target buffer size has that size
+    marked as failed and its target raised to the next size up.
+-   A config that has run for PROBE_TIME without xruns at its target tries
+    the next size down, unless that size has failed within the last
+    FAILURE_EXPIRY seconds.  A single xrun can be a fluke (a burst of
+    system load, a slow disk) so failures don't rule a size out forever.
+
+Xruns right after a config or buffer size change are expected (mod-host
+loading plugins, JACK restarting its cycle) so samples in the first
+SETTLE_TIME seconds are ignored.  Targets and failed sizes are kept across
+restarts in BUFFER_SIZE_FILE.
+
+A config can also pin its buffer size by setting its 'blocksize'
+attribute, in which case nothing is learned for it.
+"""
+
+from __future__ import annotations
+
+from audiomon import AUDIO_SAMPLE, AudioMonitor, Sample
+import jack
+import json
+import os
+from snapshot import SnapshotWriter
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+BUFFER_SIZE_FILE = os.path.expanduser('~/.pidal/buffer-sizes.json')
+
+# The buffer sizes we use, smallest first.
+BUFFER_SIZES = [64, 128, 256, 512, 1024]
+
+# Target for configs we know nothing about.  This is what run.sh starts jackd
+# with.
+DEFAULT_BUFFER_SIZE = int(os.environ.get('PERIODS', 256))
+
+# Seconds after a change during which xruns are ignored.
+SETTLE_TIME = 5.0
+
+# Seconds without xruns after which we try a smaller buffer size.
+PROBE_TIME = 600.0
+
+# Seconds after which a failed size may be tried again.
+FAILURE_EXPIRY = 24 * 3600.0
+
+class _Target:
+    """Learned buffer size state of a config."""
+
+    def __init__(self, size: int, failed: Optional[Dict[int, float]] = None):
+        self.size = size
+
+        # Mapping from failed size to the time it last failed.
+        self.failed : Dict[int, float] = failed or {}
+
+        # Seconds spent at 'size' without an xrun.
+        self.clean_time = 0.0
+
+    def to_json(self) -> Dict[str, Any]:
+        return {'size': self.size,
+                'failed': {str(size): t
+                           for size, t in sorted(self.failed.items())
+                           }
+                }
+
+    def has_failed(self, size: int, now: float) -> bool:
+        """Returns true if 'size' has failed recently."""
+        t = self.failed.get(size)
+        return t is not None and now - t < FAILURE_EXPIRY
+
+class BufferSizer:
+    """Selects and learns the buffer size of each config."""
+
+    def __init__(self, monitor: AudioMonitor,
+                 filename: Optional[str] = BUFFER_SIZE_FILE,
+                 sizes: List[int] = BUFFER_SIZES,
+                 default: int = DEFAULT_BUFFER_SIZE
+                 ):
+        """
+        Args:
+            monitor: The audio monitor.  Its JACK client is used to change
+                the buffer size.
+            filename: File the targets are stored in, None to not store
+                them.
+            sizes: The available buffer sizes, smallest first.
+            default: Initial target for new configs.
+        """
+        self.monitor = monitor
+        self.sizes = sizes
+        self.default = default
+        self.__targets : Dict[str, _Target] = {}
+        self.__pinned : Dict[str, int] = {}
+        self.__lock = threading.Lock()
+
+        # Time of the last config or buffer size change.
+        self.__change_time = 0.0
+
+        self.__writer : Optional[SnapshotWriter] = None
+        if filename:
+            self.__writer = SnapshotWriter(self.to_json, filename)
+            self.__load(filename)
+        AUDIO_SAMPLE.subscribe(self.__sample)
+
+    def __load(self, filename: str) -> None:
+        try:
+            with open(filename) as src:
+                data = json.load(src)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for name, target in data.items():
+            failed = target.get('failed', {})
+            if isinstance(failed, list):
+                # Older files only have the sizes.
+                failed = {size: now for size in failed}
+            self.__targets[name] = _Target(
+                int(target['size']),
+                {int(size): float(t) for size, t in failed.items()}
+            )
+
+    def to_json(self) -> Dict[str, Any]:
+        with self.__lock:
+            return {name: target.to_json()
+                    for name, target in self.__targets.items()
+                    }
+
+    def __mark_dirty(self) -> None:
+        if self.__writer:
+            self.__writer.mark_dirty()
+
+    def get_target(self, name: str) -> int:
+        """Returns the buffer size for config 'name'."""
+        pinned = self.__pinned.get(name)
+        if pinned:
+            return pinned
+        target = self.__targets.get(name)
+        return target.size if target else self.default
+
+    def select(self, name: str, pinned: Optional[int] = None) -> None:
+        """Switch to the buffer size of config 'name'.
+
+        Called by the engine when the config is selected.
+
+        Args:
+            name: Config name.
+            pinned: If provided, the config's fixed buffer size.
+        """
+        with self.__lock:
+            if pinned:
+                self.__pinned[name] = pinned
+            else:
+                self.__pinned.pop(name, None)
+                if name not in self.__targets:
+                    self.__targets[name] = _Target(self.default)
+            self.__change_time = time.time()
+        self.__set_blocksize(self.get_target(name))
+
+    def __set_blocksize(self, size: int) -> None:
+        client = self.monitor.client
+        if client.blocksize == size:
+            return
+        print(f'setting JACK buffer size to {size}')
+        try:
+            client.blocksize = size
+        except jack.JackError as ex:
+            print(f'Unable to set the buffer size to {size}: {ex}')
+        self.__change_time = time.time()
+
+    def __sample(self, name: str, sample: Sample) -> None:
+        """Audio monitor sample handler, learns from the sample."""
+        with self.__lock:
+            target = self.__targets.get(name)
+            if target is None or name in self.__pinned or \
+                    sample.changed or sample.blocksize != target.size or \
+                    sample.time - self.__change_time < SETTLE_TIME:
+                return
+
+            index = self.sizes.index(target.size) \
+                if target.size in self.sizes else -1
+            new_size = None
+            if sample.xruns:
+                target.failed[target.size] = sample.time
+                target.clean_time = 0.0
+                if 0 <= index < len(self.sizes) - 1:
+                    new_size = self.sizes[index + 1]
+                    print(f'{sample.xruns} xruns in {name} at '
+                          f'{target.size}, backing off to {new_size}')
+            else:
+                target.clean_time += self.monitor.interval
+                if target.clean_time >= PROBE_TIME and index > 0 and \
+                        not target.has_failed(self.sizes[index - 1],
+                                              sample.time
+                                              ):
+                    new_size = self.sizes[index - 1]
+                    print(f'{name} clean at {target.size}, trying '
+                          f'{new_size}')
+            if new_size is None:
+                return
+            target.size = new_size
+            target.clean_time = 0.0
+        self.__mark_dirty()
+        self.__set_blocksize(new_size)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Returns the targets, for the remote API."""
+        with self.__lock:
+            result = {name: target.to_json()
+                      for name, target in self.__targets.items()
+                      }
+        for name, size in self.__pinned.items():
+            result[name] = {'size': size, 'pinned': True}
+        return result
@@ -0,0 +1,100 @@
+"""Controller response curves and multi-parameter controller targets.
+
+A curve maps the 128 possible values of a midi controller onto a parameter
+range.  Curves are precomputed as 128 entry lookup arrays when a config is
+loaded, so applying one is just an index operation.
+
+Curve specs (as used in .modcfg files) are:
+
+    linear
+        Straight line from min to max (the default).
+    log
+        Fast rise at the start of the pedal travel, like a log taper pot.
+    exp
+        Slow rise at the start of the pedal travel.
+    table:<v0>,<v1>,...
+        Piecewise linear curve through the given points, spaced evenly
+        across the pedal travel.  Points are fractions of the range, so
+        "table:0,0.8,1" covers 80% of the range in the first half of the
+        travel.
+"""
+
+from __future__ import annotations
+
+from mapping import ControllerTarget
+from modhost import ModHost
+import numpy as np
+from typing import Callable, List, Optional, Sequence, Tuple
+
+# Controller positions normalized to 0..1.
+_POSITIONS = np.linspace(0.0, 1.0, 128)
+
+def make_curve(spec: str, min: float, max: float) -> np.ndarray:
+    """Returns the 128 entry lookup array for a curve spec.
+
+    Raises ValueError if the spec is invalid.
+    """
+    if spec == 'linear':
+        shape = _POSITIONS
+    elif spec == 'log':
+        shape = np.log10(1 + 9 * _POSITIONS)
+    elif spec == 'exp':
+        shape = (10 ** _POSITIONS - 1) / 9
+    elif spec.startswith('table:'):
+        try:
+            points = [float(val) for val in spec[6:].split(',')]
+        except ValueError:
+            raise ValueError(f'Invalid curve table: {spec}')
+        if len(points) < 2:
+            raise ValueError(f'Curve table needs at least two points: {spec}')
+        shape = np.interp(_POSITIONS, np.linspace(0.0, 1.0, len(points)),
+                          points
+                          )
+    else:
+        raise ValueError(f'Unknown curve type: {spec}')
+    return min + shape * (max - min)
+
+class FanOut:
+    """Maps a single controller to any number of plugin parameters.
+
+    The curves for all parameters are stored as a single (128 x params)
+    array so that a controller value is resolved to every parameter value
+    with one row lookup, and the results are sent to mod-host as a single
+    batch.
+    """
+
+    def __init__(self, mod_host: ModHost,
+                 params: Sequence[Tuple[int, str]],
+                 curves: Sequence[np.ndarray],
+                 on_send: Optional[Callable[[List[Tuple[int, str]],
+                                             np.ndarray], None]] = None
+                 ):
+        """
+        Args:
+            mod_host: The mod-host connection.
+            params: (instance id, parameter symbol) for each parameter.
+            curves: Lookup array for each parameter.
+            on_send: If provided, called with the parameters and their
+                values after they're sent to mod-host.
+        """
+        self.mod_host = mod_host
+        self.params = list(params)
+        self.table = np.array(curves).T.copy()
+        self.on_send = on_send
+        self.last = -1
+
+    def __call__(self, value: float) -> None:
+        index = int(value)
+        if index != self.last:
+            self.last = index
+            self.mod_host.param_set_many(self.params, self.table[index])
+            if self.on_send:
+                self.on_send(self.params, self.table[index])
+
+    def target(self) -> ControllerTarget:
+        """Returns a target for the controller table.
+
+        The target receives the raw controller value, the curves do the
+        scaling.
+        """
+        return ControllerTarget(self)
@@ -2,17 +2,26 @@
 from __future__ import annotations
 
 import abc
-from ext.fcb1010 import config_change, footswitch_actuator, \
-    init as init_fcb1010, FCB1010Config, ProgramConfig
-from ext.nano import init as init_nano
-from midi import ControlChange, ProgramChange
-from modhost import ModHost
-from subprocess import Popen
+import amidi
+import boot
+from concurrent.futures import Future
+from curves import FanOut, make_curve
+from fcbconfig import config_change, footswitch_actuator, FCB1010Config, \
+    ProgramConfig
+from hotplug import Route
+from looper import Looper
+from mapping import ControllerKey, ControllerTarget
+from modcfg import ControllerMap, read_modcfg
+from modhost import diff_blocks, ModHost, parse_param_sets
+from procs import AsyncProcess
+from remote import RemoteServer
+from scenes import Morpher, SceneSet
 import threading
-import time
-from typing import Callable, Dict, List, Optional, Tuple
-from engine import Config, Engine, InvalidPortError, ProcessManager
-from util import Actuator, ConfigFramework, FlagSetController
+from typing import Any, Dict, List, Optional, Tuple
+from engine import Config, Engine
+from util import Actuator, ConfigFramework, FlagSetController, \
+    LoopButtons, register_config_list_chord, show_config_list
+from watcher import FileWatcher
 
 print('in custom')
 
@@ -37,35 +46,49 @@ class RadioController:
         engine.notify('pedal_button_status', index, True)
         self.active = index
 
-def double_press(func: Callable[[bool], None],
-                 alt_func: Callable[[bool], None],
-                 other: int
-                 ) -> Callable[[bool], None]:
-    """Returns a footswitch-press handler to handle simultaneous depress of two
-    footswitches.
-
-    Returns a handler that calls alt_func() if footswitch 'other' is also
-    depressed and calls func() if not.  This has the effect of binding the
-    press of both footswitches to alt_func.
-
-    Note that this isn't perfect, as triggering the first footswitch will
-    still result in a "pressed" event being passed through to func().
-    Furthermore, all footswitch released events will continue to be passed to
-    func.
+def cc_target(port, controller: int) -> ControllerTarget:
+    """Returns a controller target that forwards values as a control change
+    on 'port'.
     """
-    def handler(pressed: bool) -> None:
-        if pressed:
-            engine = Engine.get_instance()
-            if engine.is_fs_pressed(other):
-                alt_func(pressed)
-                return
-        func(pressed)
+    return ControllerTarget(lambda v: engine.send_cc(port, controller, int(v)))
 
-    return handler
+class LeveledProgram:
+    """A program change followed by a volume change, where the volume is
+    calibrated by the engine's level monitor (see the levels module).
+
+    The command is prebuilt and only rebuilt when the calibrated volume
+    changes.
+    """
 
-def show_config_list(pressed: bool) -> None:
-    if pressed:
-        engine.notify('config_list')
+    def __init__(self, port: amidi.PortInfo, key: str, bank: int,
+                 program: int, volume: int
+                 ):
+        """
+        Args:
+            port: Midi port to send to.
+            key: Preset key for the level monitor.
+            bank: Bank number.
+            program: Program number.
+            volume: Volume to use until the preset has been measured.
+        """
+        self.port = port
+        self.key = key
+        self.bank = bank
+        self.program = program
+        self.default_volume = volume
+        self.volume = volume
+        self.command = engine.program_command(port, bank, program, volume)
+
+    def send(self) -> None:
+        volume = engine.levels.volume(self.key, self.default_volume)
+        if volume != self.volume:
+            print(f'{self.key}: volume {self.volume} -> {volume}')
+            self.volume = volume
+            self.command = engine.program_command(self.port, self.bank,
+                                                  self.program, volume
+                                                  )
+        engine.send_command(self.command)
+        engine.levels.set_preset(self.key, volume)
 
 def make_program_switcher(controller: RadioController, bank, program) -> None:
     def switcher(pressed: bool) -> None:
@@ -81,24 +104,42 @@ rak_port = engine.seq.createOutputPort('to_rak')
 zyn_port = engine.seq.createOutputPort('to_zyn')
 
 
-# Start by loading guitarix.
-gtx = ProcessManager(Popen(['guitarix', '-N']))
-engine.wait_for_jack('gx_head_amp:in_0')
-engine.wait_for_jack('gx_head_fx:out_0')
-engine.wait_for_jack('gx_head_fx:out_1')
+# Start by loading guitarix.  The helper programs may already be running if
+# we're being run from the supervisor or after a restart, in which case we
+# just attach to them.
+gtx = engine.start_process(['guitarix', '-N'],
+                           ['gx_head_amp:in_0',
+                            'gx_head_fx:out_0',
+                            'gx_head_fx:out_1'
+                            ]
+                           )
 
 # Load mod-host
-modd = ProcessManager(Popen(['mod-host', '-n']))
-engine.wait_for_jack('mod-host:midi_in')
+mod_host_running = engine.has_jack_port('mod-host:midi_in')
+modd = engine.start_process(['mod-host', '-n'], ['mod-host:midi_in'])
 for x in range(3):
     try:
         mod_host = ModHost()
         break
     except ConnectionRefusedError:
-        time.sleep(1)
+        boot.sleep(1, 'mod-host connection retry')
 else:
     print('Failed to connect to mod-host')
 
+# If mod-host was left over from a previous engine, it still has the plugins
+# of whatever config was active.  Clear them out so configs can be entered
+# normally.
+if mod_host_running:
+    mod_host.send_block('remove -1')
+morpher = Morpher(mod_host)
+
+# Remote control API.
+remote_server = RemoteServer(engine, mod_host)
+engine.run_coroutine(remote_server.start())
+
+# Meter the audio path, this is what calibrates the preset volumes.
+engine.run_coroutine(engine.levels.run())
+
 # load Rakarrack and disconnect it from input.  The "-p 1" combined with -n
 # brings jack up in "FX On" mode.
 # XXX Starting this in the outer run.sh script, makes things easier for
@@ -107,11 +148,9 @@ else:
 
 # Load a2jmidid so we can control it.
 GTX_JACK_PORT = 'a2j:pidal (capture): to_gtx'
-a2j = ProcessManager(Popen(['a2jmidid', '-eu']))
-engine.wait_for_jack(GTX_JACK_PORT)
+a2j = engine.start_process(['a2jmidid', '-eu'], [GTX_JACK_PORT])
 
-import time
-time.sleep(1)
+boot.sleep(1, 'a2jmidid settle')
 engine.jack_disconnect_all('system:capture_1', True)
 engine.jack_disconnect_all('gx_head_amp:in_0', False)
 engine.jack_disconnect_all(GTX_JACK_PORT, True)
@@ -142,21 +181,51 @@ class FirstConfig(Config):
 
 
 class ModConfig(Config):
-    """
+    """A config read from a .modcfg file (see the modcfg module).
 
     Commands are:
         name <words>...
         pedal <index> <name> <action>
-        controller <name> <id> <param> <min> <max>
+        controller <name> <id> <param> <min> <max> [<curve>]
+        midi <channel> <cc> <name>
+        scene <name> <ms> <block>
+        graph <file>
+        blocksize <frames>
+
+    A pedal action is either the id of an effect to bypass or "scene
+    <name>" to morph to the named scene.
+
+    A scene block is a set of param_set commands.  Selecting the scene
+    interpolates from the current values to those in the block over <ms>
+    milliseconds.
+
+    A controller may be given several times with the same name to control
+    several parameters from one pedal.  <curve> is a curve spec as described
+    in the curves module (linear, log, exp or table:<points>).
+
+    "midi" binds midi controller <cc> on <channel> (0-15, or "*" for all
+    channels) to controller <name> for this config only.
+
+    "graph <file>" loads the plugin graph from a JSON graph file (see the
+    graph module, the path is relative to the config file) and uses its
+    compiled command stream in place of an on_enter block.  Unless there is
+    an explicit on_leave block, leaving the config removes the graph's
+    plugins.
+
+    "blocksize" pins the JACK buffer size of the config, which is otherwise
+    learned (see the bufsize module).
     """
 
-    ControllerMap = Dict[str, Tuple[int, str, float, float]]
+    ControllerMap = ControllerMap
 
     def __init__(self, name: str, buttons: List[str],
                  actions: List[Optional[str]],
                  on_enter: Optional[str],
                  on_leave: Optional[str],
-                 controllers: ModConfig.ControllerMap) -> None:
+                 controllers: ModConfig.ControllerMap,
+                 controller_names: Optional[Dict[ControllerKey, str]] = None,
+                 scenes: Optional[Dict[str, Tuple[str, float]]] = None
+                 ) -> None:
         super().__init__(name)
         self.buttons = buttons
         self.actions = actions
@@ -164,18 +233,49 @@ class ModConfig(Config):
         self.on_enter_block = on_enter
         self.on_leave_block = on_leave
 
-        # Mapping from controller name to id, param, min, max
         self.controllers: ModConfig.ControllerMap  = controllers
+        self.fan_outs = {
+            name: FanOut(mod_host,
+                         [(id, param) for id, param, *rest in params],
+                         [make_curve(curve, min, max)
+                          for id, param, min, max, curve in params
+                          ],
+                         # Keep the morpher's idea of the current values
+                         # up to date, so a morph starts from where the
+                         # pedal left the parameters.
+                         on_send=morpher.update_sent
+                         )
+            for name, params in controllers.items()
+        }
+        if controller_names:
+            self.controller_names.update(controller_names)
+
+        # Scene values and transition times in seconds.
+        scenes = scenes or {}
+        self.scene_set = SceneSet(
+            parse_param_sets(on_enter or ''),
+            {name: parse_param_sets(block)
+             for name, (block, duration) in scenes.items()
+             }
+        )
+        self.scene_durations = {name: duration
+                                for name, (block, duration) in scenes.items()
+                                }
+        self.scene_button : Optional[int] = None
 
     def with_fcb1010(self, config: FCB1010Config) -> ModConfig:
         config.init(self)
         return self
 
     def on_button(self, index: int, pressed: bool) -> None:
-        # Currently assuming that actions are just effect identifiers to
+        # Actions are either scene selections or effect identifiers to
         # toggle on and off.
         if pressed and self.actions[index]:
-            if self.button_states[index]:
+            if self.actions[index].startswith('scene '):
+                # select_scene() notifies the button changes.
+                self.select_scene(self.actions[index].split()[1], index)
+                return
+            elif self.button_states[index]:
                 mod_host.bypass(int(self.actions[index]), True)
                 self.button_states[index] = False
             else:
@@ -184,93 +284,101 @@ class ModConfig(Config):
             engine.notify('pedal_button_status', index,
                           self.button_states[index])
 
+    def select_scene(self, name: str, index: Optional[int] = None) -> None:
+        """Morph to the named scene.
+
+        Args:
+            name: Scene name.
+            index: Index of the button that selected the scene, if any.  The
+                button is shown as active until another scene is selected.
+        """
+        morpher.morph(self.scene_set.scenes[name],
+                      self.scene_durations.get(name, 0)
+                      )
+        if self.scene_button is not None:
+            self.button_states[self.scene_button] = False
+            engine.notify('pedal_button_status', self.scene_button, False)
+        self.scene_button = index
+        if index is not None:
+            self.button_states[index] = True
+            engine.notify('pedal_button_status', index, True)
+
+    def get_state(self) -> Any:
+        return list(self.button_states)
+
+    def set_state(self, state: Any) -> None:
+        # All buttons are off after on_enter(), so just press the ones that
+        # were on.
+        for index, active in enumerate(state or []):
+            if active and index < len(self.actions):
+                self.on_button(index, True)
+
     def on_enter(self):
         if self.on_enter_block:
-            mod_host.send_block(self.on_enter_block)
+            mod_host.send_batch(self.on_enter_block)
+        morpher.reset(self.scene_set.params, self.scene_set.base)
+        self.scene_button = None
+        self.__register_footswitches()
+
+    def take_over(self, old: Config) -> None:
+        if not isinstance(old, ModConfig):
+            super().take_over(old)
+            return
 
+        diff = diff_blocks(old.on_enter_block or '', self.on_enter_block or '')
+        if diff is None:
+            print(f'{self.name}: reloading everything')
+            super().take_over(old)
+            return
+        mod_host.send_batch(diff)
+
+        # Keep the state of the buttons whose actions haven't changed, reset
+        # the others to off.  The diff doesn't touch effects whose lines
+        # didn't change, so an effect that the old config had switched on
+        # has to be bypassed explicitly.
+        morpher.reset(self.scene_set.params, self.scene_set.base)
+        for index, action in enumerate(self.actions):
+            if index < len(old.actions) and action == old.actions[index]:
+                self.button_states[index] = old.button_states[index]
+                if action and action.startswith('scene ') and \
+                        self.button_states[index]:
+                    self.scene_button = index
+            elif action and not action.startswith('scene '):
+                mod_host.bypass(int(action), True)
+            engine.notify('pedal_button_status', index,
+                          self.button_states[index])
+        self.__register_footswitches()
+
+    def __register_footswitches(self):
         engine.register_footswitch(0, lambda x: self.on_button(0, x))
         engine.register_footswitch(1, lambda x: self.on_button(1, x))
-        engine.register_footswitch(
-            2,
-            double_press(lambda x: self.on_button(2, x),
-                         show_config_list,
-                         3
-                         )
-        )
-        engine.register_footswitch(
-            3,
-            double_press(lambda x: self.on_button(3, x),
-                         show_config_list,
-                         2
-                         )
-        )
+        engine.register_footswitch(2, lambda x: self.on_button(2, x))
+        engine.register_footswitch(3, lambda x: self.on_button(3, x))
+        register_config_list_chord()
 
     def on_leave(self):
+        morpher.stop()
         if self.on_leave_block:
-            mod_host.send_block(self.on_leave_block)
+            mod_host.send_batch(self.on_leave_block)
 
     def set_controller(self, name: str, value: int):
-        try:
-            id, param, min, max = self.controllers.get(name)
-            scaled_value = min + value / 127 * (max - min)
-            mod_host.param_set(id, param, scaled_value)
-        except KeyError as ex:
-            return
+        fan_out = self.fan_outs.get(name)
+        if fan_out:
+            fan_out(value)
+
+    def controller_targets(self) -> Dict[str, ControllerTarget]:
+        return {name: fan_out.target()
+                for name, fan_out in self.fan_outs.items()}
 
     @classmethod
     def read_file(self, filename: str) -> 'ModConfig':
-        src = open(filename)
-
-        name = None
-        buttons = ['1', '2', '3', '4']
-        actions = [None] * 4
-        on_enter = None
-        on_leave = None
-        controllers : ModConfig.ControllerMap = {}
-
-        def read_block():
-            result = []
-            for line in src:
-                if line.strip() == '}':
-                    return ''.join(result)
-                result.append(line)
-            raise Exception('End of line encountered in block')
-
-        def parse_cmd_or_block(args):
-            if args[0] == '{':
-                return read_block()
-            else:
-                return ' '.join(args)
-
-        for line in src:
-            cmd = line.rstrip().split()
-            if not cmd or cmd[0].startswith('#'):
-                continue
-
-            if cmd[0] == 'name':
-                name = ' '.join(cmd[1:])
-            elif cmd[0] == 'pedal':
-                num = int(cmd[1])
-                button_name = cmd[2]
-                action = parse_cmd_or_block(cmd[3:])
-                buttons[num] = button_name
-                actions[num] = action
-            elif cmd[0] == 'controller':
-                controller = cmd[1]
-                id = int(cmd[2])
-                param = cmd[3]
-                min = float(cmd[4])
-                max = float(cmd[5])
-                controllers[controller] = (id, param, min, max)
-            elif cmd[0] == 'on_enter':
-                on_enter = parse_cmd_or_block(cmd[1:])
-            elif cmd[0] == 'on_leave':
-                on_leave = parse_cmd_or_block(cmd[1:])
-            else:
-                raise Exception(f'Unknown command: {cmd[0]}')
-
-        return ModConfig(name, buttons, actions, on_enter, on_leave,
-                         controllers)
+        cfg = read_modcfg(filename)
+        config = ModConfig(cfg.name, cfg.buttons, cfg.actions, cfg.on_enter,
+                           cfg.on_leave, cfg.controllers,
+                           cfg.controller_names, cfg.scenes
+                           )
+        config.blocksize = cfg.blocksize
+        return config
 
 class GuitarixSimple(Config):
 
@@ -285,43 +393,45 @@ class GuitarixSimple(Config):
 
     def set_controller(self, controller: str, value: int):
         if controller in ('MasterVol', 'RightPedal'):
-            engine.seq.sendEvent(ControlChange(0, 0, 7, value), gtx_port)
+            engine.send_cc(gtx_port, 7, value)
         elif controller in ('DistGain', 'LeftPedal'):
-            engine.seq.sendEvent(ControlChange(0, 0, 27, value), gtx_port)
+            engine.send_cc(gtx_port, 27, value)
+
+    def controller_targets(self) -> Dict[str, ControllerTarget]:
+        volume = cc_target(gtx_port, 7)
+        gain = cc_target(gtx_port, 27)
+        return {'MasterVol': volume, 'RightPedal': volume,
+                'DistGain': gain, 'LeftPedal': gain}
 
     def switch(self, pressed: bool, cc: int, index: int) -> None:
         if pressed:
             self.states[cc] = not self.states[cc]
-            engine.seq.sendEvent(ControlChange(0, 0, cc,
-                                               0x7f if self.states[cc] else 0
-                                               ),
-                                 gtx_port
-                                 )
+            engine.send_cc(gtx_port, cc, 0x7f if self.states[cc] else 0)
             engine.notify('pedal_button_status', index, self.states[cc])
 
+    # Controllers for each footswitch.
+    SWITCH_CCS = (13, 14, 11, 12)
+
+    def get_state(self) -> Any:
+        return [self.states[cc] for cc in self.SWITCH_CCS]
+
+    def set_state(self, state: Any) -> None:
+        for index, (cc, active) in enumerate(zip(self.SWITCH_CCS, state)):
+            if active and not self.states[cc]:
+                self.switch(True, cc, index)
+
     def on_enter(self):
         engine.jack_connect('system:capture_1', 'gx_head_amp:in_0')
         engine.set_program(gtx_port, 0, 0)
         engine.register_footswitch(0, lambda x: self.switch(x, 13, 0))
         engine.register_footswitch(1, lambda x: self.switch(x, 14, 1))
-        engine.register_footswitch(
-            2,
-            double_press(lambda x: self.switch(x, 11, 2),
-                         show_config_list,
-                         3
-                         )
-        )
-        engine.register_footswitch(
-            3,
-            double_press(lambda x: self.switch(x, 12, 3),
-                         show_config_list,
-                         2
-                         )
-        )
+        engine.register_footswitch(2, lambda x: self.switch(x, 11, 2))
+        engine.register_footswitch(3, lambda x: self.switch(x, 12, 3))
+        register_config_list_chord()
 
         # Reset all of the pedals.
         for cc in (11, 12, 13, 14):
-            engine.seq.sendEvent(ControlChange(0, 0, cc, 0), gtx_port)
+            engine.send_cc(gtx_port, cc, 0)
         self.states = {11: False, 13: False, 14: False, 12: False}
 
     def on_leave(self):
@@ -340,14 +450,20 @@ class RakConfig(Config, metaclass=abc.ABCMeta):
 
     def set_controller(self, controller: str, value: int):
         if controller in ('MasterVol', 'RightPedal'):
-            engine.seq.sendEvent(ControlChange(0, 0, 7, value), rak_port)
+            engine.send_cc(rak_port, 7, value)
         elif controller in ('DistGain', 'LeftPedal'):
-            engine.seq.sendEvent(ControlChange(0, 0, 27, value), rak_port)
+            engine.send_cc(rak_port, 27, value)
 
-    def make_program_switcher(self, bank, program, index):
+    def controller_targets(self) -> Dict[str, ControllerTarget]:
+        volume = cc_target(rak_port, 7)
+        gain = cc_target(rak_port, 27)
+        return {'MasterVol': volume, 'RightPedal': volume,
+                'DistGain': gain, 'LeftPedal': gain}
+
+    def make_program_switcher(self, program: LeveledProgram, index: int):
         def switcher(pressed: bool) -> None:
             if pressed:
-                engine.set_program(rak_port, bank, program)
+                program.send()
                 self.controller.activate(engine, index)
         return switcher
 
@@ -395,14 +511,29 @@ class RakBizConfig(RakConfig):
             (2, 7, 64),
         ]
 
+        # Program/volume commands for each entry in the map.
+        self.programs = [
+            LeveledProgram(rak_port, f'{self.name}/{states}', bank, prog, vol)
+            for states, (bank, prog, vol) in enumerate(self.map)
+        ]
+
     def __on_press(self, fs: int, bit: int, pressed: bool):
         if pressed:
             self.states ^= bit
-            bank, prog, vol = self.map[self.states]
-            engine.set_program(rak_port, bank, prog)
-            engine.seq.sendEvent(ControlChange(0, 0, 7, vol), rak_port)
+            self.programs[self.states].send()
             engine.notify('pedal_button_status', fs, bool(self.states & bit))
 
+    def get_state(self) -> Any:
+        return self.states
+
+    def set_state(self, state: Any) -> None:
+        self.states = state
+        self.programs[self.states].send()
+        for fs in range(3):
+            engine.notify('pedal_button_status', fs,
+                          bool(self.states & (1 << fs))
+                          )
+
     def set_presets(self):
         for fs in range(3):
             engine.register_footswitch(
@@ -410,15 +541,16 @@ class RakBizConfig(RakConfig):
                 lambda p, fs=fs, bit=1 << fs: self.__on_press(fs, bit, p)
             )
         engine.register_footswitch(3, show_config_list)
-        bank, prog, vol = self.map[0]
-        engine.set_program(rak_port, bank, prog)
-        engine.seq.sendEvent(ControlChange(0, 0, 7, vol), rak_port)
+        self.programs[0].send()
 
 class RakStdConfig(RakConfig):
     """Normal rak configuration.
 
     Derived classes must specify a constant PRESETS containing a list of
-    (name, bank, program, volume) tuples.
+    (name, bank, program, volume) tuples.  Presets can be referenced by name
+    using the preset index, e.g.:
+
+        ('Fuzz', *PresetIndex.get_instance().program(RAK, 'Tight Rock'), 63)
 
     They may also override INITIAL_PRESET to indicate the index of the preset
     configured upon entry.
@@ -429,34 +561,27 @@ class RakStdConfig(RakConfig):
     def __init__(self):
         super().__init__(self.NAME)
         self.buttons = [p[0] for p in self.PRESETS]
+        self.programs = [
+            LeveledProgram(rak_port, f'{self.NAME}/{name}', bank, program,
+                           volume
+                           )
+            for name, bank, program, volume in self.PRESETS
+        ]
+
+    def get_state(self) -> Any:
+        return self.controller.active
+
+    def set_state(self, state: Any) -> None:
+        self.make_program_switcher(self.programs[state], state)(True)
 
     def set_presets(self):
-        for (fs, (bank, prog)) in \
-                enumerate([(p[1], p[2]) for p in self.PRESETS]):
+        for fs, program in enumerate(self.programs):
             engine.register_footswitch(
-                fs, self.make_program_switcher(bank, prog, fs)
+                fs, self.make_program_switcher(program, fs)
             )
-
-        b2 = self.PRESETS[2]
-        b3 = self.PRESETS[3]
-        engine.register_footswitch(
-            2,
-            double_press(self.make_program_switcher(b2[1], b2[2], 2),
-                         show_config_list,
-                         3
-                         )
-        )
-        engine.register_footswitch(
-            3,
-            double_press(self.make_program_switcher(b3[1], b3[2], 3),
-                         show_config_list,
-                         2
-                         )
-        )
+        register_config_list_chord()
         self.controller.activate(engine, 0)
-        initial = self.PRESETS[self.INITIAL_PRESET]
-        engine.set_program(rak_port, initial[1], initial[2])
-        engine.seq.sendEvent(ControlChange(0, 0, 7, initial[3]), rak_port)
+        self.programs[self.INITIAL_PRESET].send()
 
 class RakFunConfig(RakStdConfig):
     NAME = 'Rak Fun'
@@ -477,8 +602,9 @@ class RakAccConfig(RakStdConfig):
     ]
 
 def act(program: int) -> None:
+    command = engine.program_command(rak_port, 3, program)
     def enable():
-        engine.set_program(rak_port, 3, program)
+        engine.send_command(command)
     return Actuator(enable, lambda: None)
 
 class NewConfig(ConfigFramework):
@@ -499,7 +625,47 @@ class NewConfig(ConfigFramework):
         engine.jack_connect('system:capture_1', 'rakarrack-plus:in_1')
         engine.jack_connect('system:capture_1', 'rakarrack-plus:in_2')
 
+class RakLoopConfig(ConfigFramework):
+    """A looper on the first two buttons, and four rak presets on the
+    other two.
+
+    The looper gets the first two so that it's clear of the config list
+    chord on footswitches 2 and 3.
+    """
+
+    def __init__(self):
+        super().__init__(
+            'Rak Loop',
+            LoopButtons(Looper(['rakarrack-plus:out_1',
+                                'rakarrack-plus:out_2'
+                                ],
+                               ['system:playback_1', 'system:playback_2']
+                               )
+                        ),
+            FlagSetController(['1', '2'], [act(p) for p in range(1, 5)])
+        )
+
+    def on_enter(self):
+        engine.midi_connect('pidal/to_rak',
+                            'rakarrack-plus/rakarrack-plus IN')
+
+        engine.jack_connect('system:capture_1', 'rakarrack-plus:in_1')
+        engine.jack_connect('system:capture_1', 'rakarrack-plus:in_2')
+        super().on_enter()
+
+    def on_leave(self):
+        super().on_leave()
+        engine.jack_disconnect_all('rakarrack-plus:in_1', False)
+        engine.jack_disconnect_all('rakarrack-plus:in_2', False)
+
 class ZynConfig(ConfigFramework):
+    # Port patterns of the keyboards.
+    KEYBOARDS = [
+        'USB Keystation 88es/USB Keystation 88es MIDI 1',
+        'Impact LX49+/Impact LX49+ MIDI 1',
+        'Q25/Q25 MIDI 1'
+    ]
+
     PRESETS = (
         (0, 33),        # 0 - Arp, Sequence 2
 
@@ -522,51 +688,107 @@ class ZynConfig(ConfigFramework):
     )
 
 
-    def __init__(self):
+    def __init__(self, keep_warm: bool = False):
+        """
+        Args:
+            keep_warm: If true, zynaddsubfx is left running when we leave
+                the config so it's immediately available next time.
+        """
         def act(bank: int, program: int):
+            leveled = LeveledProgram(zyn_port, f'ZynConfig/{bank}:{program}',
+                                     bank * 128, program, 64
+                                     )
             def enable():
                 print(f'setting program bank = {bank}, program = {program}')
-                engine.set_program(zyn_port, bank * 128, program)
-                engine.seq.sendEvent(ControlChange(0, 0, 7, 64), zyn_port)
+                leveled.send()
             return Actuator(enable, lambda: None)
 
-        super().__init__(
-            'ZynConfig',
-            FlagSetController(['1', '2', '4', '8'],
-                              [act(bank, prog) for bank, prog  in self.PRESETS]
-                              )
+        self.flags = FlagSetController(
+            ['1', '2', '4', '8'],
+            [act(bank, prog) for bank, prog  in self.PRESETS]
         )
+        super().__init__('ZynConfig', self.flags)
+
+        def wait_for_zyn():
+            engine.wait_for_jack('zynaddsubfx:out_1')
+            engine.wait_for_jack('zynaddsubfx:out_2')
+            engine.wait_for_midi('ZynAddSubFX/ZynAddSubFX')
+
+        self.zyn = AsyncProcess(['zynaddsubfx', '-U'], wait_for_zyn,
+                                keep_warm
+                                )
+
+        # Whatever keyboards are plugged in (now or later) play zyn while
+        # we're active.
+        self.keyboards = Route(self.KEYBOARDS, 'ZynAddSubFX/ZynAddSubFX')
 
     def on_enter(self):
-        self.zyn_proc = ProcessManager(Popen(['zynaddsubfx', '-U']))
-        engine.wait_for_jack('zynaddsubfx:out_1')
-        engine.wait_for_jack('zynaddsubfx:out_2')
-        engine.wait_for_midi('ZynAddSubFX/ZynAddSubFX')
-        engine.midi_connect('pidal/to_zyn', 'ZynAddSubFX/ZynAddSubFX')
+        # zyn takes a few seconds to start, so we do that in the background
+        # and finish entering the config when it's ready.  The buttons work
+        # in the meantime.
+        super().on_enter()
+        engine.notify('config_pending', self, True)
+        self.zyn.start().add_done_callback(self.__zyn_ready)
 
-        # try all three keyboards.
-        keyboards = [
-            'USB Keystation 88es/USB Keystation 88es MIDI 1',
-            'Impact LX49+/Impact LX49+ MIDI 1',
-            'Q25/Q25 MIDI 1'
-        ]
-        for keyboard in keyboards:
-            try:
-                engine.midi_connect(keyboard, 'ZynAddSubFX/ZynAddSubFX')
-                print(f'using {keyboard}')
-                break
-            except InvalidPortError:
-                pass
-        else:
-            print('Could not find any keyboards')
+    def __zyn_ready(self, future: Future) -> None:
+        if engine.cur_config is not self:
+            return
+        engine.notify('config_pending', self, False)
+        if future.exception():
+            print(f'zynaddsubfx failed to start: {future.exception()}')
+            return
+
+        engine.midi_connect('pidal/to_zyn', 'ZynAddSubFX/ZynAddSubFX')
+        engine.devices.add_route(self.keyboards)
 
         engine.jack_connect('zynaddsubfx:out_1', 'system:playback_1')
         engine.jack_connect('zynaddsubfx:out_2', 'system:playback_2')
-        super().on_enter()
+
+        # Send the current preset, any program changes sent while we were
+        # starting were lost.
+        self.flags.states[self.flags.state].enable()
 
     def on_leave(self):
         super().on_leave()
-        self.zyn_proc = None
+        engine.devices.remove_route(self.keyboards)
+        if self.zyn.keep_warm and self.zyn.ready:
+            # Leave it running, just make sure it doesn't make any noise.
+            engine.jack_disconnect_all('zynaddsubfx:out_1', True)
+            engine.jack_disconnect_all('zynaddsubfx:out_2', True)
+        self.zyn.stop()
+
+watcher = FileWatcher()
+
+def add_mod_config(filename: str,
+                   fcb1010: Optional[FCB1010Config] = None
+                   ) -> None:
+    """Load a ModConfig from 'filename' and add it to the engine.
+
+    The file is watched for changes, when it changes it is reloaded and the
+    new config replaces the old one.  If the config is active, only the
+    differences are applied to mod-host.
+    """
+    def load() -> ModConfig:
+        config = ModConfig.read_file(filename)
+        if fcb1010:
+            config.with_fcb1010(fcb1010)
+        return config
+
+    config = load()
+    engine.add_config(config)
+
+    def reload() -> None:
+        nonlocal config
+        try:
+            new_config = load()
+        except Exception as ex:
+            print(f'Error reloading {filename}: {ex}')
+            return
+        print(f'reloading {filename}')
+        engine.replace_config(config, new_config)
+        config = new_config
+
+    watcher.watch(filename, reload)
 
 fc = FCB1010Config(
     programs=[
@@ -578,19 +800,17 @@ fc = FCB1010Config(
     ]
 )
 
+# The first config is the default, the engine enters it at startup unless it
+# restores a different one.
 simple = GuitarixSimple().with_fcb1010(fc)
-engine.set_config(simple)
 engine.add_config(simple)
-engine.add_config(ModConfig.read_file('MesaStomp.modcfg'))
-engine.add_config(
-    ModConfig.read_file('MesaStomp2.modcfg').with_fcb1010(fc.offset(10))
-)
-engine.add_config(
-    ModConfig.read_file('SimpleClean.modcfg').with_fcb1010(fc.offset(20))
-)
-engine.add_config(ModConfig.read_file('ScreamingBird.modcfg'))
+add_mod_config('MesaStomp.modcfg')
+add_mod_config('MesaStomp2.modcfg', fc.offset(10))
+add_mod_config('SimpleClean.modcfg', fc.offset(20))
+add_mod_config('ScreamingBird.modcfg')
 engine.add_config(FirstConfig())
 engine.add_config(NewConfig())
+engine.add_config(RakLoopConfig())
 engine.add_config(ZynConfig())
 
 # Wait for rakarrack asynchronously (since for some reason it takes a really
@@ -609,7 +829,6 @@ thread = threading.Thread(target=wait_for_rak)
 thread.setDaemon(True)
 thread.start()
 
-# Initialize special hardware.
-init_fcb1010()
-init_nano()
+# Special hardware (the FCB1010 and the nanoKONTROL) is driven by the
+# extensions, which the engine activates when their devices show up.
 
@@ -5,14 +5,34 @@ from __future__ import annotations
 import abc
 import amidi
 import asyncio
+from audiomon import AUDIO_SAMPLE, AudioMonitor
+import boot
+from bufsize import BufferSizer
+import concurrent.futures
+from events import EventBus, EventQueue, Subscription, Topic
+from extensions import ExtensionRegistry
+from gestures import GestureHandler, GestureRecognizer
+from hotplug import DeviceRegistry, MIDI_PORT_ADDED, MIDI_PORT_REMOVED, \
+    PortWatcher, read_routes
 from importlib import import_module
 import jack
-from midi import ControlChange, Event, ProgramChange
+from layers import Layer, LayerStack
+from levels import LevelMonitor
+import os
+from mapping import compile_table, ControllerKey, ControllerTable, \
+    ControllerTarget, NUM_CONTROLLERS, TABLE_SIZE
+from midi import ControlChange, Event
+from midimsg import Command, MessageCache
+from procs import reap
 from subprocess import Popen
+from supervisor import SUPERVISED_ENV
 import threading
 import time
-from typing import Callable, List, Optional, Tuple, Union
+from typing import Any, Callable, Coroutine, Dict, Iterable, List, Optional, \
+    Tuple, Union
 from RPi import GPIO
+from snapshot import read_snapshot, SnapshotWriter
+from switches import SwitchMatrix
 
 class ProcessManager:
 
@@ -20,8 +40,9 @@ class ProcessManager:
         self.__proc = proc
 
     def __del__(self):
-        self.__proc.kill()
-        self.__proc.wait()
+        # Don't block whoever dropped the last reference (usually a
+        # footswitch callback) waiting for the process to exit.
+        reap(self.__proc)
 
 _engine : Engine = None
 
@@ -31,6 +52,14 @@ class Config:
         self.name = name
         self.buttons = ['1', '2', '3', '4']
 
+        # Config specific mappings from physical controller to controller
+        # name.  These override the engine's mappings.
+        self.controller_names : Dict[ControllerKey, str] = {}
+
+        # JACK buffer size to run the config at.  If None, this is learned
+        # (see the bufsize module).
+        self.blocksize : Optional[int] = None
+
     def on_enter(self):
         """Called when the config is selected.
 
@@ -49,6 +78,16 @@ class Config:
         """
         pass
 
+    def take_over(self, old: Config) -> None:
+        """Called when the config replaces 'old' while 'old' is active.
+
+        This happens when a config is reloaded.  The base class just leaves
+        the old config and enters the new one, derived classes can override
+        this to apply only what has changed.
+        """
+        old.on_leave()
+        self.on_enter()
+
     def set_controller(self, controller: str, value: int) -> None:
         """Called by extensions to set the value of a controller.
 
@@ -56,6 +95,30 @@ class Config:
         """
         pass
 
+    def controller_targets(self) -> Dict[str, ControllerTarget]:
+        """Returns the mapping from controller names to targets.
+
+        Controllers with targets are dispatched directly from the engine's
+        compiled controller table, set_controller() is only called for
+        controllers that are not in this mapping.
+        """
+        return {}
+
+    def get_state(self) -> Any:
+        """Returns the state of the config to be stored in the engine
+        snapshot.
+
+        The state must be JSON serializable.
+        """
+        return None
+
+    def set_state(self, state: Any) -> None:
+        """Restore the state returned by get_state().
+
+        Called right after on_enter() when restoring the engine snapshot.
+        """
+        pass
+
 class ExtensionConfig(metaclass=abc.ABCMeta):
     """Interface for extensions."""
 
@@ -73,25 +136,126 @@ class InvalidPortError(Exception):
 # Footswitch GPIO port numbers.
 FSIO = [16, 20, 21, 26]
 
+# Microswitch GPIO port numbers.
+MSIO = [17, 22, 23, 27]
+
+# Engine event topics.
+CONFIG_CHANGE = Topic('config_change', (Config,))
+PEDAL_BUTTON_STATUS = Topic('pedal_button_status', (int, bool))
+CONFIG_LIST = Topic('config_list', ())
+CONFIG_PENDING = Topic('config_pending', (Config, bool))
+CONTROLLER_LEARNED = Topic('controller_learned', (str, int, int))
+
+# Events that indicate a change to the state stored in the engine snapshot.
+_STATE_EVENTS = (CONFIG_CHANGE, PEDAL_BUTTON_STATUS, CONTROLLER_LEARNED)
+
+# Seconds after which midi learn mode is left if no controller was moved.
+LEARN_TIMEOUT = 15.0
+
+def _bindings_to_json(bindings: Dict[ControllerKey, str]) -> List[list]:
+    return [[channel, controller, name]
+            for (channel, controller), name in bindings.items()
+            ]
+
+def _bindings_from_json(data: List[list]) -> Dict[ControllerKey, str]:
+    return {(channel, controller): name
+            for channel, controller, name in data
+            }
+
 class Engine:
 
 
     def __init__(self):
-        self.__footswitches : List[Callable[[bool], None]] = \
-            [None, None, None, None]
-        self.__last_press = [0, 0, 0, 0]
-        self.__fs_pressed = [ False, False, False, False]
-        self.__microswitches : List[Callable[[], None]] = \
-            [None, None, None, None]
-        self.__ms_stack = [self.__microswitches]
-        self.__fs_stack = [self.__footswitches]
+        # Switch binding layers: the base layer holds bindings that are
+        # always present, the config layer those of the current config.
+        self.layers = LayerStack()
+        self.base_layer = self.layers.push('base')
+        self.config_layer = self.layers.push('config')
+        self.gestures = GestureRecognizer(lambda: self.layers.table)
+
+        # The switch matrix.  The GPIO switches are added in initialize(),
+        # the footswitches first so that they're switches 0-3.
+        self.switches = SwitchMatrix()
+        self.switches.on_press = self.gestures.press
+        self.switches.on_release = self.gestures.release
 
         self.seq = amidi.getSequencer(name = 'pidal')
+        self.messages = MessageCache()
         self.jack = jack.Client('pidal')
         self.configs = []
         self.cur_config = None
-        self.subscriptions = {}
+        self.bus = EventBus(CONFIG_CHANGE, PEDAL_BUTTON_STATUS, CONFIG_LIST,
+                            CONFIG_PENDING, CONTROLLER_LEARNED, AUDIO_SAMPLE,
+                            MIDI_PORT_ADDED, MIDI_PORT_REMOVED
+                            )
+
+        # Audio path measurements, attributed to the current config.  This
+        # is started in initialize().
+        self.audio = AudioMonitor()
+        CONFIG_CHANGE.subscribe(
+            lambda config: self.audio.set_config(config.name)
+        )
+        self.buffer_sizes = BufferSizer(self.audio)
+
+        # Level metering and preset volume calibration.  Configs report
+        # their presets to it, it's started by whoever wants metering.
+        self.levels = LevelMonitor(self.jack)
         self.__midi_handlers = []
+
+        # Midi hotplug, the extensions driven by it and the midi routing
+        # rules.  Watching starts in initialize(), after the configs have
+        # been added.
+        self.midi_ports = PortWatcher()
+        self.extensions = ExtensionRegistry(self.midi_ports)
+        self.devices = DeviceRegistry(self.midi_ports, self.midi_connect,
+                                      self.midi_disconnect)
+        for route in read_routes():
+            self.devices.add_route(route)
+
+        # Mapping from physical controller to controller name, populated by
+        # extensions and midi learn.
+        self.controller_names : Dict[ControllerKey, str] = {}
+
+        # Compiled controller tables for each config and the table for the
+        # current config.
+        self.__controller_tables : Dict[Config, ControllerTable] = {}
+        self.__controller_table : Optional[ControllerTable] = None
+
+        # Controller name and config for midi learn (see learn_controller()),
+        # and the timer that ends learn mode.
+        self.__learn_name : Optional[str] = None
+        self.__learn_config : Optional[Config] = None
+        self.__learn_timer : Optional[threading.Timer] = None
+
+        # Learned bindings, which are stored in the snapshot: those for all
+        # configs and those for specific configs, by config name.  The
+        # latter are applied to a config whenever it's added (or reloaded).
+        self.__learned : Dict[ControllerKey, str] = {}
+        self.__config_learned : Dict[str, Dict[ControllerKey, str]] = {}
+
+        # Last values of the table driven controllers (indexed like the
+        # controller tables, -1 if unset) and of the named controllers.
+        self.__cc_values = [-1] * TABLE_SIZE
+        self.__named_values : Dict[str, int] = {}
+
+        # State stored by the UI, included in the snapshot.
+        self.ui_state : Dict[str, Any] = {}
+
+        self.__snapshot = SnapshotWriter(self.get_snapshot)
+        for topic in _STATE_EVENTS:
+            topic.subscribe(lambda *args: self.state_changed())
+
+        # Snapshot state of a config that hasn't been added yet.
+        self.__pending_restore : Optional[Dict[str, Any]] = None
+
+        # The config saved in the snapshot: the last of our configs to be
+        # selected.  Temporary configs that aren't in the list (e.g. the
+        # tuner) aren't saved, so a restart goes back to what was
+        # interrupted.
+        self.__saved_config : Optional[Config] = None
+
+        self.__loop : Optional[asyncio.AbstractEventLoop] = None
+        self.__loop_ready = threading.Event()
         self.__async_thread = \
             self.__start_daemon_thread(self.__async_thread_func)
         self.__midi_input_thread = \
@@ -104,127 +268,163 @@ class Engine:
         return thread
 
     def __async_thread_func(self):
-        asyncio.run(self.__fs_mon())
+        self.__loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.__loop)
+        self.__loop_ready.set()
+        self.__loop.run_until_complete(self.__fs_mon())
+
+    def run_coroutine(self, coro: Coroutine) -> concurrent.futures.Future:
+        """Run a coroutine in the engine's event loop.
+
+        Returns a future for the result of the coroutine.
+        """
+        self.__loop_ready.wait()
+        return asyncio.run_coroutine_threadsafe(coro, self.__loop)
 
     async def __fs_mon(self):
         while True:
-            await asyncio.sleep(0.1)
-            t = time.time()
-            for i in range(4):
-                if self.__fs_pressed[i] and t - self.__last_press[i] > 0.1:
-                    # A value of zero indicates that the button is still
-                    # pressed, if it's 1 the button has been released.
-                    if GPIO.input(FSIO[i]):
-                        # Store the last press time to deal with bounces on
-                        # button release.
-                        self.__last_press[i] = time.time()
-                        self.__fs_pressed[i] = False
-                        handler = self.__footswitches[i]
-                        if handler:
-                            handler(False)
+            # We poll at a higher rate than the debounce time so that the
+            # release times seen by the gesture recognizer are reasonably
+            # accurate.
+            await asyncio.sleep(0.02)
+            self.switches.poll()
 
     def __midi_input_thread_func(self):
         """The midi input thread.  We can't do async for this."""
         while True:
             event = self.seq.getEvent()
-            for handler in self.__midi_handlers:
-                try:
-                    if handler(event):
-                        break
-                except:
-                    pass
+            try:
+                self.__dispatch_midi_event(event)
+            except Exception as ex:
+                print(f'Error handling midi event {event}: {ex}')
+
+    def __dispatch_midi_event(self, event: Event):
+        if isinstance(event, ControlChange) and \
+                self.__handle_controller(event):
+            return
+        if self.switches.handle_midi(event):
+            return
+        for handler in self.__midi_handlers:
+            try:
+                if handler(event):
+                    break
+            except Exception as ex:
+                print(f'Error in midi handler {handler}: {ex}')
 
     def register_footswitch(self, footswitch: int,
-                            callback: Callable[[bool], None]
+                            callback: Callable[[bool], None],
+                            layer: Optional[Layer] = None
                             ) -> None:
         """
 
         Args:
-            footswitch: Index of the footswitch to bind.  Must be from 0 to 3.
+            footswitch: Index of the footswitch to bind in the switch matrix.
+                The built-in footswitches are 0 to 3.
             callback: Function to be called when the footswitch is
                 pressed/released.  This is called with True when the switch is
                 pressed, False when released.  Debouncing is done by the
-                engine.
+                engine.  If the footswitch also has gestures bound, the
+                callback is called (with True, then False) when the switch is
+                tapped.
+            layer: The binding layer to register in, defaults to the config
+                layer.
         """
         print(f'registering {callback} at {footswitch}')
-        self.__footswitches[footswitch] = callback
+        (layer or self.config_layer).bind_press(footswitch, callback)
+
+    def register_gesture(self, footswitch: int, gesture: str,
+                         callback: GestureHandler,
+                         layer: Optional[Layer] = None
+                         ) -> None:
+        """Bind a gesture on a footswitch.
+
+        Args:
+            footswitch: Index of the footswitch.
+            gesture: One of the gesture names from the gestures module (TAP,
+                DOUBLE_TAP, HOLD, LONG_PRESS).
+            callback: Function to call when the gesture is recognized.
+            layer: The binding layer to register in, defaults to the config
+                layer.
+        """
+        (layer or self.config_layer).bind_gesture(footswitch, gesture,
+                                                  callback
+                                                  )
+
+    def register_chord(self, footswitches: Iterable[int],
+                       callback: GestureHandler,
+                       layer: Optional[Layer] = None
+                       ) -> None:
+        """Bind a function to the simultaneous press of a set of
+        footswitches (in the config layer unless 'layer' is provided).
+        """
+        (layer or self.config_layer).bind_chord(footswitches, callback)
 
     def footswitch_pressed(self, index: int):
         """Called when a footswitch is pressed.
 
         Args:
-            index: The footswitch index.  Should be 0..3.
+            index: The footswitch index.
         """
-        # If the last press was less than a 10th of a second ago, ignore it as
-        # it's probably just a bounce.
-        t = time.time()
-        if not self.__fs_pressed[index] and t - self.__last_press[index] > 0.1:
+        if self.switches.set(index, True):
             print(f'pressing footswitch {index}')
-            self.__footswitches[index](True)
-            self.__fs_pressed[index] = True
-        self.__last_press[index] = t
 
     def emulate_footswitch(self, index: int, pressed: bool):
-        """Call the footswitch callback as if a footswitch had been
+        """Press/release a footswitch as if it had physically been
         pressed/released.
 
         Args:
             index: button index
             pressed: True if the button is pressed, false if released.
         """
-        self.__footswitches[index](pressed)
+        # Emulated presses (e.g. from the remote API) can't bounce, and a
+        # quick release and press shouldn't be dropped.
+        self.switches.set(index, pressed, debounce=False)
 
     def is_fs_pressed(self, index: int) -> bool:
         """Returns true if the footswitch is currently pressed."""
-        return self.__fs_pressed[index]
-
-    def push_switch_configs(self):
-        self.__microswitches = [None, None, None, None]
-        self.__ms_stack.append(self.__microswitches)
-
-    def pop_switch_configs(self):
-        if len(self.__ms_stack) > 1:
-            self.__ms_stack.pop()
-        else:
-            # This is a hack, for some reason we're bottoming out.
-            print('hit bottom')
-        self.__microswitches = self.__ms_stack[-1]
-
-    def push_fs(self):
-        self.__footswitches = [None, None, None, None]
-        self.__fs_stack.append(self.__footswitches)
-
-    def pop_fs(self):
-        if len(self.__fs_stack) > 1:
-            self.__fs_stack.pop()
-        else:
-            print('hit bottom on footswitch stack')
-        self.__footswitches = self.__fs_stack[-1]
+        return self.switches.is_pressed(index)
 
     def register_microswitch(self, index: int,
-                             callback: Callable[[], None]
+                             callback: Callable[[], None],
+                             layer: Optional[Layer] = None
                              ) -> None:
-        self.__microswitches[index] = callback
+        """Bind a function to a press of a microswitch.
 
-    def microswitch_pressed(self, index: int):
-        # We don't do debouncing for the microswitches because this doesn't
-        # seem to be a problem.
-        if self.__microswitches[index]:
-            self.__microswitches[index]()
+        Args:
+            index: Index of the microswitch (0 to 3).
+            callback: Function to call when the microswitch is pressed.
+            layer: The binding layer to register in, defaults to the config
+                layer.
+        """
+        # The microswitches follow the footswitches in the switch matrix.
+        def handler(pressed: bool) -> None:
+            if pressed:
+                callback()
+        (layer or self.config_layer).bind_press(len(FSIO) + index, handler)
 
     def initialize(self):
         GPIO.setmode(GPIO.BCM)
-        BUTTONS = tuple((io, lambda x, i=i: self.footswitch_pressed(i))
-                        for io, i in zip(FSIO, range(4))) + (
-            (17, lambda x: self.microswitch_pressed(0)),
-            (22, lambda x: self.microswitch_pressed(1)),
-            (23, lambda x: self.microswitch_pressed(2)),
-            (27, lambda x: self.microswitch_pressed(3)),
-        )
-        for gpio, callback in BUTTONS:
-            GPIO.setup(gpio, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            GPIO.add_event_detect(gpio, GPIO.FALLING, callback=callback)
-        import_module('custom')
+        self.switches.add_gpio_device('footswitches', FSIO)
+
+        # We don't do debouncing for the microswitches because this doesn't
+        # seem to be a problem.
+        self.switches.add_gpio_device('microswitches', MSIO, debounce=0,
+                                      poll_release=False
+                                      )
+        with boot.span('audio monitor'):
+            self.audio.start()
+            self.run_coroutine(self.audio.run())
+        with boot.span('custom', boot.IMPORT):
+            import_module('custom')
+        with boot.span('midi ports'):
+            self.midi_ports.start()
+        with boot.span('restore state'):
+            self.restore_state()
+
+        # Enter the first config unless the snapshot has already selected
+        # one (custom.py doesn't, to avoid a transition through it).
+        if self.cur_config is None and self.configs:
+            self.set_config(self.configs[0])
 
     def get_port(self, name: str) -> Optional[amidi.PortInfo]:
         """Returns the PortInfo object with the given name.
@@ -241,18 +441,83 @@ class Engine:
         if isinstance(port, amidi.PortInfo):
             return port
         else:
-            port = self.get_port(port)
-            if not port:
+            info = self.get_port(port)
+            if not info:
                 raise ValueError(f'Port {port} does not exist')
+            return info
 
     def set_program(self, port: Union[amidi.PortInfo, str], bank: int,
                     program: int
                     ) -> None:
         """Set the bank and program as specified."""
         port = self.__get_port(port)
-        self.seq.sendEvent(ControlChange(0, 0, 0, bank >> 7), port)
-        self.seq.sendEvent(ControlChange(0, 0, 32, bank & 127), port)
-        self.seq.sendEvent(ProgramChange(0, 0, program), port)
+        for event in self.messages.program_events(0, bank, program):
+            self.seq.sendEvent(event, port)
+
+    def program_command(self, port: Union[amidi.PortInfo, str], bank: int,
+                        program: int,
+                        volume: Optional[int] = None
+                        ) -> Command:
+        """Returns a prebuilt command to set the bank and program.
+
+        If 'volume' is provided, the command also sets the channel volume
+        (controller 7) after the program change.
+        """
+        events = self.messages.program_events(0, bank, program)
+        if volume is not None:
+            events += (self.messages.control_change(0, 7, volume),)
+        return Command(self.__get_port(port), events)
+
+    def send_command(self, command: Command) -> None:
+        """Send a prebuilt command."""
+        for event in command.events:
+            self.seq.sendEvent(event, command.port)
+
+    def send_cc(self, port: amidi.PortInfo, controller: int, value: int,
+                channel: int = 0
+                ) -> None:
+        """Send a control change on 'port' using a preallocated event."""
+        self.seq.sendEvent(
+            self.messages.control_change(channel, controller, value),
+            port
+        )
+
+    def send_raw(self, port: amidi.PortInfo, data: bytes) -> None:
+        """Send a raw midi channel message (e.g. b'\\xb0\\x07\\x40').
+
+        The bytes are mapped onto a preallocated event, so this doesn't
+        allocate anything either.
+        """
+        self.seq.sendEvent(self.messages.decode(data), port)
+
+    def has_jack_port(self, port_name: str) -> bool:
+        """Returns true if the named jack port exists."""
+        return any(port.name == port_name for port in self.jack.get_ports())
+
+    def start_process(self, args: List[str], jack_ports: List[str],
+                      timeout: float = 10.0
+                      ) -> Optional[ProcessManager]:
+        """Start a helper program and wait for its jack ports.
+
+        If all of 'jack_ports' already exist, the program is assumed to be
+        running already (e.g. left over from a previous engine) and is
+        reused.  When running under the supervisor, the supervisor is
+        responsible for starting the program and we just wait for it.
+
+        Returns a ProcessManager if we started the program (the program is
+        killed when it is released), None if it is owned by someone else.
+        """
+        if all(self.has_jack_port(port) for port in jack_ports):
+            print(f'attaching to running {args[0]}')
+            return None
+
+        with boot.span(f'start {args[0]}', boot.WAIT):
+            proc = None
+            if not os.environ.get(SUPERVISED_ENV):
+                proc = ProcessManager(Popen(args))
+            for port in jack_ports:
+                self.wait_for_jack(port, timeout)
+        return proc
 
     def wait_for_jack(self, port_name: str, timeout: float =3.0):
         end_time = time.time() + timeout
@@ -291,12 +556,48 @@ class Engine:
             raise InvalidPortError(f'port {src_port} does not exist')
         self.seq.connect(s, d)
 
+    def midi_disconnect(self, src_port: str, dst_port: str) -> None:
+        s = self.seq.getPort(src_port)
+        d = self.seq.getPort(dst_port)
+        if not s:
+            raise InvalidPortError(f'port {src_port} does not exist')
+        self.seq.disconnect(s, d)
+
     def add_config(self, config: Config, index: Optional[int] = None) -> None:
         """Add a new config to the set of configs for the engine."""
         if index is None:
             self.configs.append(config)
         else:
             self.configs.insert(index, config)
+        self.__apply_learned(config)
+
+        # If this is the config from the snapshot (and it hasn't been
+        # restored because it hadn't been added yet), restore it now.
+        pending = self.__pending_restore
+        if pending and pending.get('config') == config.name:
+            self.__pending_restore = None
+            self.__restore(config, pending)
+
+    def replace_config(self, old: Config, new: Config) -> None:
+        """Replace config 'old' with 'new' in place.
+
+        If 'old' is the current config, 'new' becomes the current config
+        without going through set_config(): new.take_over() is responsible
+        for making the transition.
+        """
+        self.configs[self.configs.index(old)] = new
+        self.__controller_tables.pop(old, None)
+        self.__apply_learned(new)
+        if self.__saved_config is old:
+            self.__saved_config = new
+        if self.cur_config is old:
+            # As in set_config(), the old config's bindings go away.  The
+            # new config registers its own in take_over().
+            self.config_layer.clear()
+            self.cur_config = new
+            self.__controller_table = self.__get_controller_table(new)
+            CONFIG_CHANGE.publish(new)
+            new.take_over(old)
 
     def get_all_configs(self) -> Tuple[Config]:
         """Returns the list of configs."""
@@ -309,17 +610,105 @@ class Engine:
             return
         if self.cur_config:
             self.cur_config.on_leave()
+
+        # Drop the old config's switch bindings, particularly gestures and
+        # chords which the new config won't necessarily overwrite.
+        self.config_layer.clear()
         self.cur_config = config
+        if config in self.configs:
+            self.__saved_config = config
+        self.__controller_table = self.__get_controller_table(config)
+        self.buffer_sizes.select(config.name, config.blocksize)
+        self.levels.set_preset(None)
         self.cur_config.on_enter()
-        self.notify('config_change', config)
+        CONFIG_CHANGE.publish(config)
+
+    def subscribe(self, event: str, callable: Callable[..., None],
+                  queue: Optional[EventQueue] = None
+                  ) -> Subscription:
+        """Subscribe to the event topic named 'event'.
 
-    def subscribe(self, event: str, callable: Callable[..., None]) -> None:
-        self.subscriptions[event] = callable
+        See events.Topic.subscribe().
+        """
+        return self.bus.topic(event).subscribe(callable, queue)
 
     def notify(self, event: str, *args) -> None:
-        handler = self.subscriptions.get(event)
-        if handler:
-            self.subscriptions[event](*args)
+        """Publish an event on the topic named 'event'.
+
+        Code that publishes frequently should hold on to the topic and use
+        Topic.publish() directly.
+        """
+        self.bus.topic(event).publish(*args)
+
+    def state_changed(self) -> None:
+        """Called when something in the engine snapshot changes."""
+        self.__snapshot.mark_dirty()
+
+    def get_snapshot(self) -> Dict[str, Any]:
+        """Returns the engine state as stored in the snapshot file."""
+        config = self.__saved_config
+        return {
+            'config': config.name if config else None,
+            'state': config.get_state() if config else None,
+            'cc_values': {str(i): value
+                          for i, value in enumerate(self.__cc_values)
+                          if value >= 0
+                          },
+            'named_values': dict(self.__named_values),
+            'learned': _bindings_to_json(self.__learned),
+            'config_learned': {name: _bindings_to_json(bindings)
+                               for name, bindings in
+                                   self.__config_learned.items()
+                               },
+            'ui': self.ui_state,
+        }
+
+    def restore_state(self) -> None:
+        """Restore the state from the snapshot file.
+
+        If the config in the snapshot hasn't been added yet, it is restored
+        when it is added.
+        """
+        snapshot = read_snapshot()
+        if not snapshot:
+            return
+        self.ui_state.update(snapshot.get('ui', {}))
+        try:
+            self.__learned = _bindings_from_json(snapshot.get('learned', []))
+            self.__config_learned = {
+                name: _bindings_from_json(bindings)
+                for name, bindings in snapshot.get('config_learned',
+                                                   {}).items()
+            }
+        except (TypeError, ValueError) as ex:
+            print(f'Unable to restore learned controllers: {ex}')
+        self.controller_names.update(self.__learned)
+        for config in self.configs:
+            self.__apply_learned(config)
+        self.invalidate_controllers()
+        for config in self.configs:
+            if config.name == snapshot.get('config'):
+                self.__restore(config, snapshot)
+                break
+        else:
+            self.__pending_restore = snapshot
+
+    def __restore(self, config: Config, snapshot: Dict[str, Any]) -> None:
+        print(f'restoring config {config.name}')
+        self.set_config(config)
+        try:
+            config.set_state(snapshot.get('state'))
+        except Exception as ex:
+            print(f'Unable to restore the state of {config.name}: {ex}')
+        for index, value in snapshot.get('cc_values', {}).items():
+            index = int(index)
+            self.__cc_values[index] = value
+            self.__controller_table.dispatch(index // NUM_CONTROLLERS,
+                                             index % NUM_CONTROLLERS,
+                                             value
+                                             )
+        for name, value in snapshot.get('named_values', {}).items():
+            self.set_controller(name, value)
 
     def add_midi_input_handler(self, handler: Callable[[Event],  bool]):
         """Adds a new midi input handler.
@@ -328,18 +717,137 @@ class Engine:
         processed the event, false if the event should be delegated to
         subsequent handlers in the chain.
         """
-        self.__midi_handlers.append(handler)
+        # Handlers come and go with hotplugged devices, so the list is
+        # replaced rather than modified under the midi input thread.
+        self.__midi_handlers = self.__midi_handlers + [handler]
 
     def remove_midi_input_handler(self, handler: Callable[[Event],  bool]):
         """Remove the specified handler from the handler chain."""
-        self.__midi_handlers.remove(handler)
+        handlers = list(self.__midi_handlers)
+        handlers.remove(handler)
+        self.__midi_handlers = handlers
 
     def set_controller(self, controller: str, value: int):
         """Set the value of a controller.
 
         This also translates the controller name per the config.
         """
+        self.__named_values[controller] = value
         self.cur_config.set_controller(controller, value)
+        self.state_changed()
+
+    def __get_controller_table(self, config: Config) -> ControllerTable:
+        table = self.__controller_tables.get(config)
+        if table is None:
+            names = dict(self.controller_names)
+            names.update(config.controller_names)
+            table = self.__controller_tables[config] = \
+                compile_table(names, config.controller_targets())
+        return table
+
+    def __handle_controller(self, event: ControlChange) -> bool:
+        """Handle a control change from the midi input thread.
+
+        Returns true if the event was consumed.
+        """
+        if self.__learn_name is not None:
+            self.__learn(event)
+            return True
+        table = self.__controller_table
+        if table is not None and \
+                table.dispatch(event.channel, event.controller, event.value):
+            self.__cc_values[event.channel * NUM_CONTROLLERS +
+                             event.controller] = event.value
+            self.state_changed()
+            return True
+        return False
+
+    def __apply_learned(self, config: Config) -> None:
+        """Add the learned bindings of 'config' to its controller names."""
+        learned = self.__config_learned.get(config.name)
+        if learned:
+            config.controller_names.update(learned)
+            self.__controller_tables.pop(config, None)
+
+    def __learn(self, event: ControlChange) -> None:
+        name = self.__learn_name
+        config = self.__learn_config
+        self.cancel_learn()
+        key = (event.channel, event.controller)
+        if config:
+            config.controller_names[key] = name
+            self.__config_learned.setdefault(config.name, {})[key] = name
+        else:
+            self.controller_names[key] = name
+            self.__learned[key] = name
+        print(f'learned controller {name} = channel {event.channel}, '
+              f'cc {event.controller}')
+        self.invalidate_controllers()
+        CONTROLLER_LEARNED.publish(name, event.channel, event.controller)
+
+    def bind_controller(self, channel: Optional[int], controller: int,
+                        name: str
+                        ) -> None:
+        """Bind a physical controller to a controller name.
+
+        Args:
+            channel: Midi channel (0..15) or None for all channels.
+            controller: Midi controller number.
+            name: Controller name as understood by the configs (e.g.
+                'RightPedal').
+        """
+        self.controller_names[channel, controller] = name
+        self.invalidate_controllers()
+
+    def unbind_controller(self, channel: Optional[int], controller: int
+                          ) -> None:
+        """Remove a binding made with bind_controller()."""
+        if self.controller_names.pop((channel, controller), None):
+            self.invalidate_controllers()
+
+    def learn_controller(self, name: str, config: Optional[Config] = None,
+                         timeout: float = LEARN_TIMEOUT
+                         ) -> None:
+        """Enter midi learn mode.
+
+        The next control change received is bound to controller 'name'.  If
+        'config' is provided, the binding is specific to that config,
+        otherwise it applies to all configs.  A 'controller_learned' event is
+        sent when the binding is made.  Learned bindings are stored in the
+        snapshot.
+
+        Learn mode ends without binding anything if no controller is moved
+        within 'timeout' seconds.
+        """
+        self.cancel_learn()
+        self.__learn_config = config
+        self.__learn_name = name
+
+        def timed_out():
+            if self.__learn_timer is timer:
+                print(f'midi learn of {name} timed out')
+                self.cancel_learn()
+        timer = self.__learn_timer = threading.Timer(timeout, timed_out)
+        timer.setDaemon(True)
+        timer.start()
+
+    def cancel_learn(self) -> None:
+        """Leave midi learn mode without binding anything."""
+        self.__learn_name = self.__learn_config = None
+        timer, self.__learn_timer = self.__learn_timer, None
+        if timer:
+            timer.cancel()
+
+    def invalidate_controllers(self) -> None:
+        """Discard all compiled controller tables.
+
+        This must be called when a config's controller_names or
+        controller_targets() change.
+        """
+        self.__controller_tables.clear()
+        if self.cur_config:
+            self.__controller_table = \
+                self.__get_controller_table(self.cur_config)
 
     @classmethod
     def get_instance(cls):
@@ -0,0 +1,166 @@
+"""Publish/subscribe event bus.
+
+Events are published on Topic objects.  A topic can have any number of
+subscribers, each of which gets the event either synchronously (called from
+the publishing thread) or through an EventQueue, which defers delivery to
+whoever drains the queue (e.g. the UI thread).
+
+Topics can be typed: declared with the types of their arguments, in which
+case publishing with the wrong number of arguments is an error.  Publishing
+on a topic with no subscribers costs a single attribute check.
+"""
+
+from __future__ import annotations
+
+from collections import deque
+import threading
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+Handler = Callable[..., None]
+
+class EventQueue:
+    """Queue of deferred event deliveries.
+
+    Events delivered to the queue are run by drain(), or by a daemon thread
+    if the queue is created with 'thread=True'.
+    """
+
+    def __init__(self, thread: bool = False):
+        self.__queue : Deque[Tuple[Handler, tuple]] = deque()
+        self.__cond = threading.Condition()
+        if thread:
+            thread_obj = threading.Thread(target=self.__run)
+            thread_obj.setDaemon(True)
+            thread_obj.start()
+
+    def put(self, handler: Handler, args: tuple) -> None:
+        with self.__cond:
+            self.__queue.append((handler, args))
+            self.__cond.notify()
+
+    def drain(self) -> None:
+        """Run all pending deliveries."""
+        while True:
+            try:
+                handler, args = self.__queue.popleft()
+            except IndexError:
+                return
+            _call(handler, args)
+
+    def __run(self) -> None:
+        while True:
+            with self.__cond:
+                while not self.__queue:
+                    self.__cond.wait()
+            self.drain()
+
+def _call(handler: Handler, args: tuple) -> None:
+    try:
+        handler(*args)
+    except Exception as ex:
+        print(f'Error in event handler {handler}: {ex}')
+
+class Subscription:
+    __slots__ = ('topic', 'handler', 'queue')
+
+    def __init__(self, topic: Topic, handler: Handler,
+                 queue: Optional[EventQueue]
+                 ):
+        self.topic = topic
+        self.handler = handler
+        self.queue = queue
+
+    def cancel(self) -> None:
+        """Stop receiving events."""
+        self.topic.unsubscribe(self)
+
+class Topic:
+    """An event topic.
+
+    Attributes:
+        name: Topic name.
+        arg_types: Types of the event arguments, None if the topic is
+            untyped.
+        subscribers: Tuple of the current subscriptions.  This is replaced
+            rather than modified, so publish() can iterate over it without
+            locking.
+    """
+
+    __slots__ = ('name', 'arg_types', 'subscribers', '__lock')
+
+    def __init__(self, name: str, arg_types: Optional[Tuple[Any, ...]] = None
+                 ):
+        self.name = name
+        self.arg_types = arg_types
+        self.subscribers : Tuple[Subscription, ...] = ()
+        self.__lock = threading.Lock()
+
+    def subscribe(self, handler: Handler,
+                  queue: Optional[EventQueue] = None
+                  ) -> Subscription:
+        """Subscribe to the topic.
+
+        Args:
+            handler: Called with the event arguments.
+            queue: If provided, events are delivered through the queue rather
+                than synchronously.
+
+        Returns the subscription, which can be used to unsubscribe.
+        """
+        sub = Subscription(self, handler, queue)
+        with self.__lock:
+            self.subscribers = self.subscribers + (sub,)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self.__lock:
+            self.subscribers = \
+                tuple(s for s in self.subscribers if s is not sub)
+
+    def publish(self, *args: Any) -> None:
+        """Deliver an event to all subscribers.
+
+        Raises TypeError if the topic is typed and the arguments don't match
+        'arg_types'.  Nothing is checked when there are no subscribers.
+        """
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+        if self.arg_types is not None:
+            if len(args) != len(self.arg_types):
+                raise TypeError(f'{self.name} takes {len(self.arg_types)} '
+                                f'arguments, got {len(args)}')
+            for i, (arg, t) in enumerate(zip(args, self.arg_types)):
+                if not isinstance(arg, t):
+                    raise TypeError(f'{self.name} argument {i} must be '
+                                    f'{t.__name__}, got '
+                                    f'{type(arg).__name__}')
+        for sub in subscribers:
+            if sub.queue is not None:
+                sub.queue.put(sub.handler, args)
+            else:
+                _call(sub.handler, args)
+
+    def __repr__(self) -> str:
+        return f'<Topic {self.name}>'
+
+class EventBus:
+    """A registry of topics by name."""
+
+    def __init__(self, *topics: Topic):
+        """
+        Args:
+            topics: Topics to register.
+        """
+        self.__topics : Dict[str, Topic] = {topic.name: topic
+                                            for topic in topics
+                                            }
+        self.__lock = threading.Lock()
+
+    def topic(self, name: str) -> Topic:
+        """Returns the named topic, creating an untyped one if necessary."""
+        topic = self.__topics.get(name)
+        if topic is None:
+            with self.__lock:
+                topic = self.__topics.setdefault(name, Topic(name))
+        return topic
@@ -3,87 +3,72 @@
 
 from __future__ import annotations
 
-from engine import Config, Engine, ExtensionConfig
+from engine import Engine
+from fcbconfig import program_map
 from midi import ControlChange, Event, ProgramChange
-import os
-from typing import Callable, List
+from typing import Dict
 
-def footswitch_actuator(index: int) -> Callable[[Config], None]:
-    """Returns a footswitch actuator which can be used as the action in a
-    ProgramConfig, causing the specified footswitch to be virtually pressed
-    and released when the program event comes in.
-    """
-
-    def func(config: Config):
-        eng = Engine.get_instance()
-        eng.set_config(config)
-        eng.emulate_footswitch(index, True)
-        eng.emulate_footswitch(index, False)
-
-    func.__name__ = f'actuator{index}'
-    return func
-
-def config_change(config: Config):
-    """Actuator that can be used to just switch to the associated config."""
-    eng = Engine.get_instance()
-    eng.set_config(config)
-
-class ProgramConfig:
-    def __init__(self, program: int, action: Callable[[Config], None]):
-        """
-
-        Args:
-            program: Midi program number of the pedal that activates this
-                action.
-            action: Function to call when the midi program message is
-                received.  The function will be called with the Config in
-                which it was defined.
-        """
-        self.program = program
-        self.action = action
-
-class FCB1010Config(ExtensionConfig):
-
-    def __init__(self, programs: List[ProgramConfig]):
-        self.programs = programs
-
-    def init(self, config: Config):
-        for pc in self.programs:
-            _program_map[pc.program] = lambda pc=pc: pc.action(config)
+# Number of footswitches on the FCB1010 and the index of the first one in the
+# switch matrix.
+NUM_SWITCHES = 10
+_switch_base = -1
 
-    def offset(self, offset: int) -> FCB1010Config:
-        """Returns a config with program numbers incremented by the given
-        offset.
-        """
-        return FCB1010Config([
-            ProgramConfig(program.program + offset, program.action)
-            for program in self.programs
-        ])
-
-_program_map : Dict[int, Callable[[Config], None]] = {}
+# Mapping from the controller numbers of the expression pedals to controller
+# names.
+_controller_names : Dict[int, str] = {
+    7: 'RightPedal',
+    27: 'LeftPedal'
+}
 
 def input_handler(event: Event) -> bool:
-    if isinstance(event, ProgramChange) and event.program in _program_map:
-        _program_map[event.program]()
+    if isinstance(event, ProgramChange) and event.program in program_map:
+        program_map[event.program]()
+        return True
+    elif isinstance(event, ProgramChange) and _switch_base >= 0:
+        # Programs that aren't claimed by a config are presses of the
+        # corresponding switch in the switch matrix (the FCB1010 sends
+        # programs NUM_SWITCHES apart for each bank).
+        Engine.get_instance().switches.tap(
+            _switch_base + event.program % NUM_SWITCHES
+        )
         return True
     elif isinstance(event, ControlChange):
-        controller_name = {
-            7: 'RightPedal',
-            27: 'LeftPedal'
-        }.get(event.controller)
+        controller_name = _controller_names.get(event.controller)
         if controller_name:
             Engine.get_instance().set_controller(controller_name, event.value)
     else:
         return False
 
-def init():
-    # Make sure we have a midi soundcard defined.
-    sc_midi = os.environ.get('SOUNDCARD_MIDI')
-    if not sc_midi:
-        print('Error: no soundcard midi interface defined')
-        return
+# The pidal input port for the FCB1010, created on first activation.
+_input_port = None
+
+def activate(port: str) -> None:
+    """Activate the extension on the midi port of the soundcard that the
+    FCB1010 is plugged into (see the extensions module).
+    """
+    global _switch_base, _input_port
 
     engine = Engine.get_instance()
-    port = engine.seq.createInputPort('fcb1010_in')
-    engine.midi_connect(sc_midi, 'pidal/fcb1010_in')
+
+    # Switch matrix devices can't be removed, so a reactivated FCB1010 gets
+    # its old switches back.
+    device = engine.switches.get_device('fcb1010') or \
+        engine.switches.add_device('fcb1010', NUM_SWITCHES)
+    _switch_base = device.base
+    for controller, name in _controller_names.items():
+        engine.bind_controller(None, controller, name)
+    if _input_port is None:
+        _input_port = engine.seq.createInputPort('fcb1010_in')
+    engine.midi_connect(port, 'pidal/fcb1010_in')
     engine.add_midi_input_handler(input_handler)
+
+def deactivate() -> None:
+    """Deactivate the extension.  The subscription to the port went away
+    with the port.
+    """
+    global _switch_base
+    engine = Engine.get_instance()
+    engine.remove_midi_input_handler(input_handler)
+    for controller in _controller_names:
+        engine.unbind_controller(None, controller)
+    _switch_base = -1
@@ -1,22 +1,30 @@
 """Korg Nano Module.
+
+Control changes from the nanoKONTROL are sent to the current config as
+controllers named "nano.<controller number>".
 """
 from engine import Engine
 from midi import Event, ControlChange
 
+# The pidal input port for the nanoKONTROL, created on first activation.
+_input_port = None
+
 def event_handler(event: Event):
     if isinstance(event, ControlChange):
-        engine = Engine.get_instance()
-        engine.get_config().set_controller(f'nano.{event.controller}',
-                                           event.value)
+        Engine.get_instance().set_controller(f'nano.{event.controller}',
+                                             event.value
+                                             )
 
-def init():
+def activate(port: str) -> None:
+    """Activate the extension on the nanoKONTROL's midi port (see the
+    extensions module).
+    """
+    global _input_port
     engine = Engine.get_instance()
-    for port_info in engine.seq.iterPortInfos():
-        if port_info.fullName == 'nanoKONTROL/nanoKONTROL MIDI 1':
-            break
-    else:
-        return
+    if _input_port is None:
+        _input_port = engine.seq.createInputPort('nano_in')
+    engine.midi_connect(port, 'pidal/nano_in')
+    engine.add_midi_input_handler(event_handler)
 
-    port = engine.seq.createInputPort('nano_in')
-    engine.midi_connect(port_info.fullName, 'pidal/nano_in')
-    engine.add_midi_input_handler(input_handler)
+def deactivate() -> None:
+    Engine.get_instance().remove_midi_input_handler(event_handler)
@@ -0,0 +1,133 @@
+"""Extension registry.
+
+Extensions are the modules in ext/ that drive a particular piece of midi
+hardware.  They're listed in the manifest (ext/manifest.json) with the
+midi port of their device:
+
+    [
+        {"name": <name>, "module": <module>, "port": <port pattern>},
+        ...
+    ]
+
+The port pattern is a glob pattern matched against full ALSA port names
+("client/port") after expanding environment variables, so that an
+extension can be pointed at a port from the environment (e.g.
+"$SOUNDCARD_MIDI").
+
+An extension module isn't imported until a matching port appears (see the
+hotplug module), at which point its activate() function is called with
+the port name.  When the port goes away, its deactivate() function is
+called, and the extension is activated again with the next matching port
+that shows up.  So a driver for a device that isn't plugged in costs
+neither an import nor a midi input handler.  Extension modules provide:
+
+    def activate(port: str) -> None
+    def deactivate() -> None
+
+Both are called from the hotplug watcher thread.
+"""
+
+from __future__ import annotations
+
+import attr
+import boot
+from fnmatch import fnmatchcase
+from hotplug import MIDI_PORT_ADDED, MIDI_PORT_REMOVED, PortWatcher
+from importlib import import_module
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+MANIFEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'ext', 'manifest.json'
+                             )
+
+@attr.s
+class Extension:
+    """A manifest entry.
+
+    Attributes:
+        name: Extension name.
+        module: Name of the extension module.
+        port: Port pattern, with environment variables expanded.
+        active_port: The port the extension is active on, None if it's
+            inactive.
+    """
+    name : str = attr.ib()
+    module : str = attr.ib()
+    port : str = attr.ib()
+    active_port : Optional[str] = attr.ib(default=None)
+
+def read_manifest(filename: str = MANIFEST_FILE) -> List[Extension]:
+    """Returns the extensions listed in a manifest file."""
+    with open(filename) as src:
+        entries = json.load(src)
+    result = []
+    for entry in entries:
+        port = os.path.expandvars(entry['port'])
+        if '$' in port:
+            print(f'Error: extension {entry["name"]} is disabled, '
+                  f'{entry["port"]} is not defined')
+            continue
+        result.append(Extension(entry['name'], entry['module'], port))
+    return result
+
+class ExtensionRegistry:
+    """Activates and deactivates extensions as their devices come and go."""
+
+    def __init__(self, ports: PortWatcher, manifest: str = MANIFEST_FILE):
+        """
+        Args:
+            ports: Watcher of the midi ports.
+            manifest: Manifest file.
+        """
+        self.ports = ports
+        try:
+            self.extensions = read_manifest(manifest)
+        except (OSError, ValueError, KeyError) as ex:
+            print(f'Unable to read the extension manifest {manifest}: {ex}')
+            self.extensions = []
+        self.__lock = threading.Lock()
+        MIDI_PORT_ADDED.subscribe(self.__port_added)
+        MIDI_PORT_REMOVED.subscribe(self.__port_removed)
+
+    def __activate(self, ext: Extension, port: str) -> None:
+        print(f'activating extension {ext.name} on {port}')
+        try:
+            with boot.span(f'extension {ext.name}'):
+                import_module(ext.module).activate(port)
+        except Exception as ex:
+            print(f'Error activating extension {ext.name}: {ex}')
+            return
+        ext.active_port = port
+
+    def __port_added(self, port: str) -> None:
+        with self.__lock:
+            for ext in self.extensions:
+                if ext.active_port is None and fnmatchcase(port, ext.port):
+                    self.__activate(ext, port)
+
+    def __port_removed(self, port: str) -> None:
+        with self.__lock:
+            for ext in self.extensions:
+                if ext.active_port != port:
+                    continue
+                print(f'deactivating extension {ext.name}')
+                ext.active_port = None
+                try:
+                    import_module(ext.module).deactivate()
+                except Exception as ex:
+                    print(f'Error deactivating extension {ext.name}: {ex}')
+
+                # Move over to another matching device, if there is one.
+                for other in list(self.ports.ports):
+                    if other != port and fnmatchcase(other, ext.port):
+                        self.__activate(ext, other)
+                        break
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Returns the port of each extension (None if inactive), for the
+        remote API.
+        """
+        return {ext.name: ext.active_port for ext in self.extensions}
@@ -0,0 +1,68 @@
+"""FCB1010 program configuration.
+
+Configs use these to map the programs that the FCB1010 sends to actions.
+They're kept out of the extension module (ext.fcb1010) so that configs can
+be set up without importing the extension, which is only imported when
+the FCB1010's port appears.
+"""
+
+from __future__ import annotations
+
+from engine import Config, Engine, ExtensionConfig
+from typing import Callable, Dict, List
+
+def footswitch_actuator(index: int) -> Callable[[Config], None]:
+    """Returns a footswitch actuator which can be used as the action in a
+    ProgramConfig, causing the specified footswitch to be virtually pressed
+    and released when the program event comes in.
+    """
+
+    def func(config: Config):
+        eng = Engine.get_instance()
+        eng.set_config(config)
+        eng.emulate_footswitch(index, True)
+        eng.emulate_footswitch(index, False)
+
+    func.__name__ = f'actuator{index}'
+    return func
+
+def config_change(config: Config):
+    """Actuator that can be used to just switch to the associated config."""
+    eng = Engine.get_instance()
+    eng.set_config(config)
+
+class ProgramConfig:
+    def __init__(self, program: int, action: Callable[[Config], None]):
+        """
+
+        Args:
+            program: Midi program number of the pedal that activates this
+                action.
+            action: Function to call when the midi program message is
+                received.  The function will be called with the Config in
+                which it was defined.
+        """
+        self.program = program
+        self.action = action
+
+class FCB1010Config(ExtensionConfig):
+
+    def __init__(self, programs: List[ProgramConfig]):
+        self.programs = programs
+
+    def init(self, config: Config):
+        for pc in self.programs:
+            program_map[pc.program] = lambda pc=pc: pc.action(config)
+
+    def offset(self, offset: int) -> FCB1010Config:
+        """Returns a config with program numbers incremented by the given
+        offset.
+        """
+        return FCB1010Config([
+            ProgramConfig(program.program + offset, program.action)
+            for program in self.programs
+        ])
+
+# Mapping from program number to the action registered for it by a config,
+# used by the extension's midi input handler.
+program_map : Dict[int, Callable[[], None]] = {}
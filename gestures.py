@@ -0,0 +1,396 @@
+"""Footswitch gesture recognition.
+
+Turns raw footswitch press/release events into gestures:
+
+    tap
+        A press and release shorter than the hold time.
+    double_tap
+        Two taps, the second pressed within the double tap window of the
+        first release.
+    hold
+        The switch is held down for the hold time (fires while the switch
+        is still down).
+    long_press
+        The switch is held down for the long press time (fires while the
+        switch is still down, after any "hold").
+    chords
+        A set of switches all pressed within the chord window of each other.
+
+Recognition only costs anything for switches that need it: a switch with
+nothing bound but a plain press/release handler and that isn't part of a
+chord gets its events passed straight through, and only switches that are
+in the middle of a gesture have any state.  Otherwise, decisions are made
+from event timestamps and timers scheduled for the exact deadlines (no
+polling), so the decision latency of each gesture is bounded by the
+corresponding window.  In particular, the press of a switch that is part of
+a chord is held for the chord window and only passed through if no chord
+forms (its latency is recorded as "chord_timeout").
+
+Switches are identified by their index in the engine's switch matrix (see
+the switches module).  Measured latencies are available from
+GestureRecognizer.latency_stats().
+"""
+
+from __future__ import annotations
+
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, \
+    Tuple
+
+TAP = 'tap'
+DOUBLE_TAP = 'double_tap'
+HOLD = 'hold'
+LONG_PRESS = 'long_press'
+CHORD = 'chord'
+
+# Latency stat of the presses of chord switches that were passed through
+# because no chord formed within the chord window.
+CHORD_TIMEOUT = 'chord_timeout'
+
+PressHandler = Callable[[bool], None]
+GestureHandler = Callable[[], None]
+
+_NO_GESTURES : Dict[str, GestureHandler] = {}
+
+class Bindings:
+    """The handlers bound to a set of switches.
+
+    Attributes:
+        press: Plain press/release handler for each switch.  These are
+            called with True when the switch is pressed and False when it is
+            released.  If the switch has gestures or chords bound, the
+            handler is called (with True, then False) for a tap instead,
+            or with True once the switch is known not to be part of a
+            chord.
+        gestures: Mapping from gesture name to handler for each switch.
+        chords: Mapping from sets of switch indices to handlers.
+
+    All of these are keyed by switch index and only contain entries for the
+    switches that are bound.
+    """
+
+    __slots__ = ('press', 'gestures', 'chords')
+
+    def __init__(self):
+        self.press : Dict[int, PressHandler] = {}
+        self.gestures : Dict[int, Dict[str, GestureHandler]] = {}
+        self.chords : Dict[FrozenSet[int], GestureHandler] = {}
+
+    def clear(self) -> None:
+        """Remove all bindings."""
+        self.press.clear()
+        self.gestures.clear()
+        self.chords.clear()
+
+    def bound(self) -> Set[int]:
+        """Returns the indices of all switches with a binding."""
+        result = set(self.press)
+        result.update(self.gestures)
+        for chord in self.chords:
+            result.update(chord)
+        return result
+
+class BindingTable:
+    """The effective bindings of all switches, flattened so that the
+    handlers of a switch can be found by indexing.
+
+    Attributes:
+        size: One more than the highest bound switch index.
+        press: Press handler for each switch (or None).
+        gestures: Gesture handlers for each switch (empty if none).
+        chords: Mapping from sets of switch indices to handlers.
+        chord_mask: Bitmask of the switches that are part of a chord.
+    """
+
+    __slots__ = ('size', 'press', 'gestures', 'chords', 'chord_mask')
+
+    def __init__(self, size: int = 0):
+        self.size = size
+        self.press : List[Optional[PressHandler]] = [None] * size
+        self.gestures : List[Dict[str, GestureHandler]] = \
+            [_NO_GESTURES] * size
+        self.chords : Dict[FrozenSet[int], GestureHandler] = {}
+        self.chord_mask = 0
+
+    def get_press(self, index: int) -> Optional[PressHandler]:
+        return self.press[index] if index < self.size else None
+
+    def get_gestures(self, index: int) -> Dict[str, GestureHandler]:
+        return self.gestures[index] if index < self.size else _NO_GESTURES
+
+class Scheduler:
+    """Calls functions at specific times from a daemon thread."""
+
+    def __init__(self):
+        self.__queue : List[Tuple[float, int, Callable, tuple]] = []
+        self.__counter = itertools.count()
+        self.__cond = threading.Condition()
+        thread = threading.Thread(target=self.__run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def call_at(self, when: float, func: Callable, *args) -> None:
+        """Call func(*args) at time 'when' (as returned by time.time())."""
+        with self.__cond:
+            heapq.heappush(self.__queue,
+                           (when, next(self.__counter), func, args)
+                           )
+            self.__cond.notify()
+
+    def __run(self) -> None:
+        while True:
+            with self.__cond:
+                while not self.__queue or self.__queue[0][0] > time.time():
+                    self.__cond.wait(self.__queue[0][0] - time.time()
+                                     if self.__queue else None
+                                     )
+                when, count, func, args = heapq.heappop(self.__queue)
+            try:
+                func(*args)
+            except Exception as ex:
+                print(f'Error in scheduled call: {ex}')
+
+# Switch phases.
+IDLE = 0            # Not pressed.
+DOWN = 1            # Pressed, nothing decided yet.
+PASSED = 2          # Pressed and passed through to the press handler.
+HELD = 3            # Pressed and a hold or long press has fired.
+CONSUMED = 4        # Pressed and used in a chord or double tap.
+WAIT_DOUBLE = 5     # Released after a tap, waiting for a second tap.
+
+class _SwitchState:
+    __slots__ = ('phase', 'down_time', 'up_time', 'generation')
+
+    def __init__(self):
+        self.phase = IDLE
+        self.down_time = 0.0
+        self.up_time = 0.0
+
+        # Changed on every event, so timers can tell if they're stale.
+        self.generation = 0
+
+class GestureRecognizer:
+    """Recognizes gestures from footswitch events.
+
+    Attributes:
+        hold_time: Time a switch must be held down for a "hold".
+        long_time: Time a switch must be held down for a "long_press".
+        double_window: Maximum time between the release of the first tap and
+            the press of the second for a "double_tap".
+        chord_window: Maximum time between the presses of the switches in a
+            chord.
+    """
+
+    def __init__(self, get_table: Callable[[], BindingTable],
+                 hold_time: float = 0.5,
+                 long_time: float = 1.5,
+                 double_window: float = 0.3,
+                 chord_window: float = 0.08
+                 ):
+        """
+        Args:
+            get_table: Returns the current effective bindings.  This is
+                called on every event, so it should be cheap.
+        """
+        self.get_table = get_table
+        self.hold_time = hold_time
+        self.long_time = long_time
+        self.double_window = double_window
+        self.chord_window = chord_window
+
+        # States of the switches that are in the middle of a gesture.
+        self.__states : Dict[int, _SwitchState] = {}
+
+        # Source of generation numbers.  These are global so that a timer
+        # for a discarded state can't match a new state for the same switch.
+        self.__generations = itertools.count(1)
+        self.__lock = threading.Lock()
+        self.__scheduler = Scheduler()
+
+        # Decision latency stats: gesture -> [count, total, max]
+        self.__latency : Dict[str, List[float]] = {}
+
+    def __record(self, gesture: str, start: float, now: float) -> None:
+        stats = self.__latency.setdefault(gesture, [0, 0.0, 0.0])
+        latency = now - start
+        stats[0] += 1
+        stats[1] += latency
+        stats[2] = max(stats[2], latency)
+
+    def latency_stats(self) -> Dict[str, Tuple[int, float, float]]:
+        """Returns (count, mean, max) decision latency for each gesture.
+
+        The latency is the time from the first event of the gesture to the
+        time the gesture was recognized.
+        """
+        with self.__lock:
+            return {gesture: (count, total / count, max)
+                    for gesture, (count, total, max)
+                    in self.__latency.items()
+                    }
+
+    def __tap_action(self, table: BindingTable, index: int
+                     ) -> Optional[GestureHandler]:
+        handler = table.get_gestures(index).get(TAP)
+        if handler:
+            return handler
+        press = table.get_press(index)
+        if press:
+            return lambda: (press(True), press(False))
+        return None
+
+    def __run(self, actions: Iterable[Callable[[], None]]) -> None:
+        for action in actions:
+            try:
+                action()
+            except Exception as ex:
+                print(f'Error in footswitch handler: {ex}')
+
+    def press(self, index: int, t: Optional[float] = None) -> None:
+        """Called when switch 'index' is pressed at time 't'."""
+        t = time.time() if t is None else t
+        actions = []
+        with self.__lock:
+            self.__press(index, t, actions)
+        self.__run(actions)
+
+    def __press(self, index: int, t: float, actions: List[Callable]) -> None:
+        table = self.get_table()
+        if index >= table.size:
+            # Nothing bound.
+            self.__states.pop(index, None)
+            return
+
+        # Switches with nothing but a press handler get passed straight
+        # through.
+        gestures = table.gestures[index]
+        if not gestures and not table.chord_mask >> index & 1:
+            self.__states.pop(index, None)
+            press = table.press[index]
+            if press:
+                actions.append(lambda: press(True))
+            return
+
+        state = self.__states.get(index)
+        if state is None:
+            state = self.__states[index] = _SwitchState()
+        state.generation = next(self.__generations)
+        prev_phase = state.phase
+        state.down_time = t
+        state.phase = DOWN
+
+        # Check for a completed chord.
+        for chord, handler in table.chords.items():
+            if index in chord and all(
+                    i in self.__states and
+                    self.__states[i].phase == DOWN and
+                    t - self.__states[i].down_time <= self.chord_window
+                    for i in chord):
+                for i in chord:
+                    self.__states[i].phase = CONSUMED
+                self.__record(CHORD,
+                              min(self.__states[i].down_time for i in chord),
+                              time.time()
+                              )
+                actions.append(handler)
+                return
+
+        # Second tap of a double tap.
+        if prev_phase == WAIT_DOUBLE and DOUBLE_TAP in gestures:
+            state.phase = CONSUMED
+            self.__record(DOUBLE_TAP, state.up_time, time.time())
+            actions.append(gestures[DOUBLE_TAP])
+            return
+
+        generation = state.generation
+        if not gestures:
+            # We just need to wait long enough to know that this isn't part
+            # of a chord.
+            self.__scheduler.call_at(t + self.chord_window,
+                                     self.__chord_timeout, index, generation
+                                     )
+        if HOLD in gestures:
+            self.__scheduler.call_at(t + self.hold_time, self.__held,
+                                     index, generation, HOLD
+                                     )
+        if LONG_PRESS in gestures:
+            self.__scheduler.call_at(t + self.long_time, self.__held,
+                                     index, generation, LONG_PRESS
+                                     )
+
+    def __chord_timeout(self, index: int, generation: int) -> None:
+        actions = []
+        with self.__lock:
+            state = self.__states.get(index)
+            if state and state.generation == generation and \
+                    state.phase == DOWN:
+                state.phase = PASSED
+                press = self.get_table().get_press(index)
+                self.__record(CHORD_TIMEOUT, state.down_time, time.time())
+                if press:
+                    actions.append(lambda: press(True))
+        self.__run(actions)
+
+    def __held(self, index: int, generation: int, gesture: str) -> None:
+        actions = []
+        with self.__lock:
+            state = self.__states.get(index)
+            if state and state.generation == generation and \
+                    state.phase in (DOWN, HELD):
+                handler = self.get_table().get_gestures(index).get(gesture)
+                if handler:
+                    state.phase = HELD
+                    self.__record(gesture, state.down_time, time.time())
+                    actions.append(handler)
+        self.__run(actions)
+
+    def release(self, index: int, t: Optional[float] = None) -> None:
+        """Called when switch 'index' is released at time 't'."""
+        t = time.time() if t is None else t
+        actions = []
+        with self.__lock:
+            self.__release(index, t, actions)
+        self.__run(actions)
+
+    def __release(self, index: int, t: float, actions: List[Callable]
+                  ) -> None:
+        table = self.get_table()
+        state = self.__states.pop(index, None)
+        phase = state.phase if state else PASSED
+
+        if phase == PASSED:
+            press = table.get_press(index)
+            if press:
+                actions.append(lambda: press(False))
+        elif phase == DOWN:
+            # A tap, possibly the first of a double tap.
+            if DOUBLE_TAP in table.get_gestures(index):
+                self.__states[index] = state
+                state.generation = next(self.__generations)
+                state.up_time = t
+                state.phase = WAIT_DOUBLE
+                self.__scheduler.call_at(t + self.double_window,
+                                         self.__double_timeout, index,
+                                         state.generation
+                                         )
+            else:
+                action = self.__tap_action(table, index)
+                self.__record(TAP, state.down_time, time.time())
+                if action:
+                    actions.append(action)
+
+    def __double_timeout(self, index: int, generation: int) -> None:
+        actions = []
+        with self.__lock:
+            state = self.__states.get(index)
+            if state and state.generation == generation and \
+                    state.phase == WAIT_DOUBLE:
+                del self.__states[index]
+                self.__record(TAP, state.down_time, time.time())
+                action = self.__tap_action(self.get_table(), index)
+                if action:
+                    actions.append(action)
+        self.__run(actions)
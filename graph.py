@@ -0,0 +1,418 @@
+"""Plugin graphs.
+
+A structured representation of a mod-host pedalboard: the plugin nodes
+(with their parameters, preset and bypass state) and the connections between
+their ports.  Graphs are stored as JSON:
+
+    {
+        "nodes": [
+            {"id": 1,
+             "uri": "http://guitarix.sourceforge.net/plugins/gx_amp#GUITARIX",
+             "preset": null,
+             "params": {"MasterGain": "8.75", "Model": "\\"Mesa Boogie\\""},
+             "bypass": false
+            },
+            ...
+        ],
+        "connections": [["system:capture_1", "1:in"], ["1:out", "2:in"], ...],
+        "setup": ["feature_enable processing 0"],
+        "finish": ["feature_enable processing 2"],
+        "state": "~/.pedalboards/Mesa_Stomp_2.pedalboard"
+    }
+
+Connection endpoints are either "<node id>:<port symbol>" or the name of a
+jack port that isn't a plugin port (e.g. "system:capture_1").  Parameter
+values are stored as they're passed to mod-host, which accepts strings for
+some parameters.  "setup" and "finish" are other mod-host commands to send
+before and after the graph, "state" is a pedalboard directory to load plugin
+state from.
+
+Graphs can be imported from the mod-host command blocks in .modcfg files
+(from_block()) and from mod pedalboard directories (from_pedalboard()), and
+are compiled into a mod-host command stream by compile_graph().
+
+Run this module to convert a .modcfg on_enter block or a pedalboard to JSON
+or to compile a JSON graph:
+
+    python3 graph.py import <file.modcfg | dir.pedalboard>
+    python3 graph.py compile <file.json>
+"""
+
+from __future__ import annotations
+
+import attr
+import glob
+import json
+import os
+import re
+import sys
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Directory for plugin state files loaded with "state_load".
+STATE_TMPDIR = os.path.expanduser('~/.pidal/state-tmp')
+
+# Commands that are replaced by the "state" field or by the compiler.
+_STATE_COMMANDS = {'state_tmpdir', 'state_load'}
+
+@attr.s
+class Node:
+    id : int = attr.ib()
+    uri : str = attr.ib()
+    preset : Optional[str] = attr.ib(default=None)
+    params : Dict[str, str] = attr.ib(factory=dict)
+    bypass : bool = attr.ib(default=False)
+
+@attr.s
+class Graph:
+    nodes : Dict[int, Node] = attr.ib(factory=dict)
+    connections : List[Tuple[str, str]] = attr.ib(factory=list)
+    setup : List[str] = attr.ib(factory=list)
+    finish : List[str] = attr.ib(factory=list)
+    state : Optional[str] = attr.ib(default=None)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'nodes': [attr.asdict(node) for node in self.nodes.values()],
+            'connections': [list(conn) for conn in self.connections],
+            'setup': self.setup,
+            'finish': self.finish,
+            'state': self.state,
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> Graph:
+        nodes = {}
+        for node_data in data.get('nodes', []):
+            node = Node(int(node_data['id']), node_data['uri'],
+                        node_data.get('preset'),
+                        {symbol: str(value)
+                         for symbol, value in
+                            node_data.get('params', {}).items()
+                         },
+                        bool(node_data.get('bypass', False))
+                        )
+            nodes[node.id] = node
+        return cls(nodes,
+                   [(src, dst) for src, dst in data.get('connections', [])],
+                   list(data.get('setup', [])),
+                   list(data.get('finish', [])),
+                   data.get('state')
+                   )
+
+def read_graph(filename: str) -> Graph:
+    with open(filename) as src:
+        return Graph.from_json(json.load(src))
+
+def _home_relative(path: str) -> str:
+    """Returns 'path' relative to the home directory ("~/...") if it's in
+    it.
+    """
+    home = os.path.expanduser('~')
+    if path == home or path.startswith(home + os.sep):
+        return '~' + path[len(home):]
+    return path
+
+def _from_mod_host_port(port: str) -> str:
+    """Convert a mod-host port name ("effect_1:in") to a graph endpoint."""
+    if port.startswith('effect_'):
+        return port[7:]
+    return port
+
+def _to_mod_host_port(endpoint: str) -> str:
+    """Convert a graph endpoint to a mod-host port name."""
+    node, _, port = endpoint.partition(':')
+    if node.isdigit():
+        return f'effect_{node}:{port}'
+    return endpoint
+
+def from_block(block: str) -> Graph:
+    """Import a graph from a block of mod-host commands.
+
+    The commands are interpreted in order, so parameters set more than once
+    end up with their last value and removed plugins and connections
+    disappear.  Commands that aren't part of the graph are kept in "setup"
+    (if they come before the first plugin is added) or "finish".  The
+    absolute paths of state_tmpdir and state_load are replaced by the
+    "state" field.
+    """
+    graph = Graph()
+    for line in block.split('\n'):
+        line = line.strip()
+        cmd = line.split()
+        if not cmd:
+            continue
+        name = cmd[0]
+        if name == 'add' and len(cmd) == 3:
+            graph.nodes[int(cmd[2])] = Node(int(cmd[2]), cmd[1])
+        elif name == 'remove' and len(cmd) == 2 and \
+                int(cmd[1]) in graph.nodes:
+            id = int(cmd[1])
+            del graph.nodes[id]
+            graph.connections = [
+                conn for conn in graph.connections
+                if not any(end.partition(':')[0] == str(id) for end in conn)
+            ]
+        elif name == 'preset_load' and len(cmd) == 3 and \
+                int(cmd[1]) in graph.nodes:
+            graph.nodes[int(cmd[1])].preset = cmd[2]
+        elif name == 'param_set' and len(cmd) >= 3 and \
+                int(cmd[1]) in graph.nodes:
+            graph.nodes[int(cmd[1])].params[cmd[2]] = ' '.join(cmd[3:])
+        elif name == 'bypass' and len(cmd) == 3 and \
+                int(cmd[1]) in graph.nodes:
+            graph.nodes[int(cmd[1])].bypass = cmd[2] != '0'
+        elif name in ('connect', 'disconnect') and len(cmd) == 3:
+            conn = (_from_mod_host_port(cmd[1]), _from_mod_host_port(cmd[2]))
+            if conn in graph.connections:
+                graph.connections.remove(conn)
+            if name == 'connect':
+                graph.connections.append(conn)
+        elif name == 'state_load' and len(cmd) == 2:
+            graph.state = _home_relative(cmd[1])
+        elif name in _STATE_COMMANDS:
+            pass
+        elif graph.nodes:
+            graph.finish.append(line)
+        else:
+            graph.setup.append(line)
+    return graph
+
+# A minimal turtle reader, just enough for the files that mod-ui writes.
+
+_TOKEN_RE = re.compile(r'''
+    \s+ | \#[^\n]* |                            # whitespace and comments
+    (?P<iri><[^>]*>) |
+    (?P<string>"(?:[^"\\]|\\.)*") |
+    (?P<punct>[;,.\[\]()]) |
+    (?P<word>[^\s;,\[\]()"<>]+(?<!\.))
+''', re.VERBOSE)
+
+def _tokenize(text: str) -> Iterator[str]:
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if not match:
+            raise ValueError(
+                f'Unable to parse turtle at {text[pos:pos + 20]!r}'
+            )
+        pos = match.end()
+        if match.lastgroup:
+            yield match.group(match.lastgroup)
+
+def _parse_turtle(text: str) -> Dict[str, List[Tuple[str, str]]]:
+    """Returns a mapping from subject to (predicate, object) pairs.
+
+    Nested blank nodes ("[ ... ]") are skipped and prefix declarations are
+    ignored: we only care about the local names.
+    """
+    result : Dict[str, List[Tuple[str, str]]] = {}
+    tokens = list(_tokenize(text))
+    i = 0
+    while i < len(tokens):
+        if tokens[i] in ('@prefix', '@base'):
+            while tokens[i] != '.':
+                i += 1
+            i += 1
+            continue
+        subject = tokens[i]
+        i += 1
+        predicate = None
+        while i < len(tokens) and tokens[i] != '.':
+            token = tokens[i]
+            i += 1
+            if token == ';':
+                predicate = None
+            elif token == ',':
+                pass
+            elif token == '[':
+                depth = 1
+                while depth:
+                    depth += {'[': 1, ']': -1}.get(tokens[i], 0)
+                    i += 1
+            elif predicate is None:
+                predicate = token
+            else:
+                result.setdefault(subject, []).append((predicate, token))
+        i += 1
+    return result
+
+def _local(iri: str) -> str:
+    """Strip the brackets from a relative iri."""
+    return iri[1:-1] if iri.startswith('<') else iri
+
+def _unquote(value: str) -> str:
+    return value[1:-1] if value.startswith('"') else value
+
+def from_pedalboard(dirname: str) -> Graph:
+    """Import a graph from a mod pedalboard directory.
+
+    Plugin instances are numbered in the order they appear in the
+    pedalboard.  The pedalboard directory itself becomes the graph's "state"
+    so that plugin state files are still loaded.
+    """
+    triples : Dict[str, List[Tuple[str, str]]] = {}
+    for ttl in sorted(glob.glob(os.path.join(dirname, '*.ttl'))):
+        with open(ttl, errors='replace') as src:
+            for subject, pairs in _parse_turtle(src.read()).items():
+                triples.setdefault(subject, []).extend(pairs)
+
+    def types(subject: str) -> List[str]:
+        return [obj for pred, obj in triples.get(subject, []) if pred == 'a']
+
+    def value(subject: str, predicate: str) -> Optional[str]:
+        for pred, obj in triples.get(subject, []):
+            if pred == predicate:
+                return obj
+        return None
+
+    graph = Graph(state=_home_relative(os.path.abspath(dirname)))
+    ids : Dict[str, int] = {}
+    for subject in triples:
+        if 'ingen:Block' not in types(subject):
+            continue
+        name = _local(subject)
+        id = ids[name] = len(ids) + 1
+        preset = _local(value(subject, 'pedal:preset') or '<>')
+        node = Node(id, _local(value(subject, 'lv2:prototype') or '<>'),
+                    preset=preset or None,
+                    bypass=value(subject, 'ingen:enabled') == 'false'
+                    )
+        for pred, port in triples[subject]:
+            if pred != 'lv2:port':
+                continue
+            port_types = types(port)
+            port_value = value(port, 'ingen:value')
+            if 'lv2:ControlPort' in port_types and \
+                    'lv2:InputPort' in port_types and port_value is not None:
+                node.params[_local(port).split('/', 1)[1]] = \
+                    _unquote(port_value)
+        graph.nodes[id] = node
+
+    def endpoint(iri: str) -> Optional[str]:
+        name = _local(iri)
+        block, _, port = name.partition('/')
+        if port:
+            return f'{ids[block]}:{port}' if block in ids else None
+        elif re.fullmatch(r'(capture|playback)_\d+', name):
+            return f'system:{name}'
+        return None
+
+    for subject in triples:
+        if 'ingen:Arc' in types(subject):
+            src = endpoint(value(subject, 'ingen:tail') or '')
+            dst = endpoint(value(subject, 'ingen:head') or '')
+            if src and dst:
+                graph.connections.append((src, dst))
+    return graph
+
+def _node_of(endpoint: str) -> Optional[int]:
+    node = endpoint.partition(':')[0]
+    return int(node) if node.isdigit() else None
+
+def _topological_order(graph: Graph) -> List[int]:
+    """Returns the node ids ordered so that every node comes after the nodes
+    that feed it.  Nodes in cycles come last, in id order.
+    """
+    feeds : Dict[int, set] = {id: set() for id in graph.nodes}
+    inputs = {id: 0 for id in graph.nodes}
+    for src, dst in graph.connections:
+        src_node, dst_node = _node_of(src), _node_of(dst)
+        if src_node in feeds and dst_node in inputs and \
+                dst_node not in feeds[src_node] and src_node != dst_node:
+            feeds[src_node].add(dst_node)
+            inputs[dst_node] += 1
+
+    result = []
+    ready = sorted(id for id, count in inputs.items() if not count)
+    while ready:
+        id = ready.pop(0)
+        result.append(id)
+        for dst in sorted(feeds[id]):
+            inputs[dst] -= 1
+            if not inputs[dst]:
+                ready.append(dst)
+    result.extend(sorted(set(graph.nodes) - set(result)))
+    return result
+
+def compile_graph(graph: Graph) -> str:
+    """Returns the mod-host commands to instantiate 'graph'.
+
+    Plugins are added in topological order (sources first), each followed by
+    its preset, its parameters (one param_set per parameter) and its bypass
+    state, then the connections are made in the same order.  The result is
+    intended to be sent as a single batch (see ModHost.send_batch()).
+
+    If the graph has plugin state, this creates STATE_TMPDIR: mod-host
+    doesn't create the directory it's told to use.
+    """
+    order = _topological_order(graph)
+    rank = {id: i for i, id in enumerate(order)}
+    result = list(graph.setup)
+    if graph.state:
+        os.makedirs(STATE_TMPDIR, exist_ok=True)
+        result.append(f'state_tmpdir {STATE_TMPDIR}')
+    for id in order:
+        node = graph.nodes[id]
+        result.append(f'add {node.uri} {id}')
+        if node.preset:
+            result.append(f'preset_load {id} {node.preset}')
+        for symbol, value in node.params.items():
+            result.append(f'param_set {id} {symbol} {value}')
+        if node.bypass:
+            result.append(f'bypass {id} 1')
+
+    # Connections from outside the graph (e.g. system capture) sort first,
+    # connections to the outside last.
+    def connection_key(conn: Tuple[str, str]) -> Tuple[int, int]:
+        src, dst = (_node_of(end) for end in conn)
+        return (rank.get(src, -1), rank.get(dst, len(order)))
+    seen = set()
+    for conn in sorted(graph.connections, key=connection_key):
+        if conn not in seen:
+            seen.add(conn)
+            src, dst = conn
+            result.append(f'connect {_to_mod_host_port(src)} '
+                          f'{_to_mod_host_port(dst)}')
+
+    if graph.state:
+        result.append(f'state_load {os.path.expanduser(graph.state)}')
+    result.extend(graph.finish)
+    return '\n'.join(result)
+
+def compile_teardown(graph: Graph) -> str:
+    """Returns the mod-host commands to remove 'graph'.
+
+    Removing a plugin removes its connections, so this is just a "remove"
+    for each node.
+    """
+    return '\n'.join(f'remove {id}' for id in reversed(
+        _topological_order(graph)
+    ))
+
+def _read_modcfg_block(filename: str) -> str:
+    """Returns the on_enter block of a .modcfg file."""
+    with open(filename) as src:
+        lines = iter(src)
+        for line in lines:
+            if line.split()[:2] == ['on_enter', '{']:
+                block = []
+                for line in lines:
+                    if line.strip() == '}':
+                        return ''.join(block)
+                    block.append(line)
+    raise ValueError(f'No on_enter block in {filename}')
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in ('import', 'compile'):
+        print(__doc__)
+        sys.exit(1)
+    command, path = sys.argv[1:]
+    if command == 'import':
+        if os.path.isdir(path):
+            graph = from_pedalboard(path)
+        else:
+            graph = from_block(_read_modcfg_block(path))
+        json.dump(graph.to_json(), sys.stdout, indent=4)
+        print()
+    else:
+        print(compile_graph(read_graph(path)))
@@ -0,0 +1,327 @@
+"""MIDI hotplug detection.
+
+ALSA announces the creation and removal of sequencer clients and ports on
+the System/Announce port.  The PortWatcher subscribes to it from a
+sequencer of its own (so announcements don't go through the engine's midi
+input handlers) and whenever something is announced it compares the
+current set of ports with the one it had, publishing MIDI_PORT_ADDED and
+MIDI_PORT_REMOVED for the differences.  There's no polling: the watcher
+thread sleeps in the sequencer until ALSA has something to say.
+
+Plugging in a device produces a burst of announcements (the client, then
+each of its ports), only the first rescan of the burst finds anything new.
+
+The DeviceRegistry keeps the ports indexed by device (ALSA client) and by
+the patterns of its routing rules, and applies the rules as ports come and
+go.  A rule (a Route) connects every port matching one of its source
+patterns to its target port: when a source appears it is connected to the
+target, when the target appears all of the sources present are connected
+to it.  Each port event only touches the patterns and routes it matches,
+nothing is rescanned.  Routes can come from the code (e.g. a config that
+wants keyboards while it's active) or from ROUTES_FILE:
+
+    [
+        {"from": [<port pattern>, ...], "to": <port name>},
+        {"from": <port pattern>, "to": <port name>},
+        ...
+    ]
+"""
+
+from __future__ import annotations
+
+import amidi
+import attr
+from events import Topic
+from fnmatch import fnmatchcase
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+# Published with the full name ("client/port") of a port that appeared or
+# went away.  Published from the watcher thread.
+MIDI_PORT_ADDED = Topic('midi_port_added', (str,))
+MIDI_PORT_REMOVED = Topic('midi_port_removed', (str,))
+
+ANNOUNCE_PORT = 'System/Announce'
+
+ROUTES_FILE = os.path.expanduser('~/.pidal/midi-routes.json')
+
+class PortWatcher:
+    """Tracks the ALSA sequencer ports.
+
+    Attributes:
+        ports: The current ports by full name.
+    """
+
+    def __init__(self, client_name: str = 'pidal-hotplug'):
+        self.client_name = client_name
+        self.seq = amidi.getSequencer(name=client_name)
+        self.ports : Dict[str, amidi.PortInfo] = {}
+        self.__lock = threading.Lock()
+        self.__thread : Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Publish the ports that exist now and start watching.
+
+        Subscribers should be in place before this is called, ports that
+        exist at startup are reported like any other new port.
+        """
+        if self.__thread:
+            return
+        self.seq.createInputPort('announce')
+        announce = self.seq.getPort(ANNOUNCE_PORT)
+        if announce:
+            self.seq.connect(announce,
+                             self.seq.getPort(f'{self.client_name}/announce')
+                             )
+        else:
+            print(f'No {ANNOUNCE_PORT} port, midi hotplug is disabled')
+        self.rescan()
+        if announce:
+            self.__thread = threading.Thread(target=self.__watch)
+            self.__thread.setDaemon(True)
+            self.__thread.start()
+
+    def __watch(self) -> None:
+        while True:
+            # We don't care what the announcement is, just that something
+            # changed.
+            self.seq.getEvent()
+            try:
+                self.rescan()
+            except Exception as ex:
+                print(f'Error handling midi hotplug: {ex}')
+
+    def rescan(self) -> None:
+        """Compare the ports with the last known set and publish the
+        differences.
+        """
+        prefix = self.client_name + '/'
+        current = {port.fullName: port
+                   for port in self.seq.iterPortInfos()
+                   if not port.fullName.startswith(prefix)
+                   }
+        with self.__lock:
+            removed = [name for name in self.ports if name not in current]
+            added = [name for name in current if name not in self.ports]
+            self.ports = current
+        for name in removed:
+            print(f'midi port removed: {name}')
+            MIDI_PORT_REMOVED.publish(name)
+        for name in added:
+            print(f'midi port added: {name}')
+            MIDI_PORT_ADDED.publish(name)
+
+    def has_port(self, name: str) -> bool:
+        with self.__lock:
+            return name in self.ports
+
+@attr.s(eq=False)
+class Route:
+    """A routing rule.
+
+    Attributes:
+        sources: Glob patterns of full port names ("client/port").
+        target: Full name of the port the sources are connected to.
+        connected: The sources currently connected by the rule.
+    """
+    sources : List[str] = attr.ib()
+    target : str = attr.ib()
+    connected : Set[str] = attr.ib(factory=set)
+
+def read_routes(filename: str = ROUTES_FILE) -> List[Route]:
+    """Returns the routes in a routes file, none if there isn't one."""
+    try:
+        with open(filename) as src:
+            entries = json.load(src)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as ex:
+        print(f'Unable to read midi routes from {filename}: {ex}')
+        return []
+    if not isinstance(entries, list):
+        print(f'Unable to read midi routes from {filename}: expected a list')
+        return []
+    result = []
+    for i, entry in enumerate(entries):
+        try:
+            # "from" may be a single pattern.
+            sources = entry['from']
+            if isinstance(sources, str):
+                sources = [sources]
+            if not all(isinstance(source, str) for source in sources) or \
+                    not isinstance(entry['to'], str):
+                raise TypeError('ports must be strings')
+            result.append(Route(list(sources), entry['to']))
+        except (KeyError, TypeError) as ex:
+            print(f'Ignoring midi route {i} in {filename}: '
+                  f'{type(ex).__name__}: {ex}')
+    return result
+
+class DeviceRegistry:
+    """Indexed midi ports and the routing rules applied to them.
+
+    Attributes:
+        devices: Port names by device (ALSA client) name.
+        routes: The active routes.
+    """
+
+    def __init__(self, watcher: PortWatcher,
+                 connect: Callable[[str, str], None],
+                 disconnect: Callable[[str, str], None]
+                 ):
+        """
+        Args:
+            watcher: Watcher of the midi ports.
+            connect: Called with (source, target) to connect two ports.
+            disconnect: Called with (source, target) to disconnect two ports.
+        """
+        self.watcher = watcher
+        self.connect = connect
+        self.disconnect = disconnect
+        self.devices : Dict[str, Set[str]] = {}
+        self.routes : List[Route] = []
+
+        # The current ports matching each route pattern, and the number of
+        # routes using the pattern.
+        self.__matches : Dict[str, Set[str]] = {}
+        self.__pattern_users : Dict[str, int] = {}
+
+        # Routes by target port.
+        self.__targets : Dict[str, List[Route]] = {}
+
+        # Routes by (sources, target).
+        self.__keys : Dict[Tuple[Tuple[str, ...], str], Route] = {}
+
+        self.__lock = threading.RLock()
+        MIDI_PORT_ADDED.subscribe(self.__port_added)
+        MIDI_PORT_REMOVED.subscribe(self.__port_removed)
+
+    def find(self, pattern: str) -> List[str]:
+        """Returns the current ports matching glob pattern 'pattern'."""
+        with self.__lock:
+            matches = self.__matches.get(pattern)
+            if matches is None:
+                matches = {port for ports in self.devices.values()
+                           for port in ports
+                           if fnmatchcase(port, pattern)
+                           }
+            return sorted(matches)
+
+    def __connect(self, route: Route, source: str) -> None:
+        if source in route.connected or source == route.target:
+            return
+        try:
+            self.connect(source, route.target)
+        except Exception as ex:
+            print(f'Unable to connect {source} to {route.target}: {ex}')
+            return
+        print(f'midi route {source} -> {route.target}')
+        route.connected.add(source)
+
+    def __apply(self, route: Route) -> None:
+        """Connect all of the route's current sources."""
+        if not self.watcher.has_port(route.target):
+            return
+        for pattern in route.sources:
+            for source in sorted(self.__matches[pattern]):
+                self.__connect(route, source)
+
+    def add_route(self, route: Route) -> Route:
+        """Add a routing rule, connecting the ports that match it now.
+
+        Returns 'route', to be passed to remove_route().  If an equal route
+        (same sources and target) is already registered, returns that one
+        instead and 'route' isn't added.
+        """
+        key = (tuple(route.sources), route.target)
+        with self.__lock:
+            existing = self.__keys.get(key)
+            if existing is not None:
+                return existing
+            self.__keys[key] = route
+            for pattern in route.sources:
+                if pattern not in self.__matches:
+                    self.__matches[pattern] = set(self.find(pattern))
+                self.__pattern_users[pattern] = \
+                    self.__pattern_users.get(pattern, 0) + 1
+            self.routes.append(route)
+            self.__targets.setdefault(route.target, []).append(route)
+            self.__apply(route)
+        return route
+
+    def remove_route(self, route: Route) -> None:
+        """Stop applying a routing rule and undo the connections it made.
+
+        A connection is left in place if another route to the same target
+        also made it.
+        """
+        with self.__lock:
+            if route not in self.routes:
+                return
+            self.routes.remove(route)
+            del self.__keys[(tuple(route.sources), route.target)]
+            self.__targets[route.target].remove(route)
+            if not self.__targets[route.target]:
+                del self.__targets[route.target]
+            for pattern in route.sources:
+                self.__pattern_users[pattern] -= 1
+                if not self.__pattern_users[pattern]:
+                    del self.__pattern_users[pattern]
+                    del self.__matches[pattern]
+            others = self.__targets.get(route.target, ())
+            for source in sorted(route.connected):
+                if any(source in other.connected for other in others):
+                    continue
+                try:
+                    self.disconnect(source, route.target)
+                except Exception as ex:
+                    print(f'Unable to disconnect {source} from '
+                          f'{route.target}: {ex}')
+            route.connected.clear()
+
+    def __port_added(self, port: str) -> None:
+        with self.__lock:
+            self.devices.setdefault(port.split('/', 1)[0], set()).add(port)
+            matched = set()
+            for pattern, matches in self.__matches.items():
+                if fnmatchcase(port, pattern):
+                    matches.add(port)
+                    matched.add(pattern)
+            if matched:
+                for route in self.routes:
+                    if not matched.isdisjoint(route.sources) and \
+                            self.watcher.has_port(route.target):
+                        self.__connect(route, port)
+            for route in self.__targets.get(port, ()):
+                self.__apply(route)
+
+    def __port_removed(self, port: str) -> None:
+        with self.__lock:
+            device = port.split('/', 1)[0]
+            ports = self.devices.get(device)
+            if ports is not None:
+                ports.discard(port)
+                if not ports:
+                    del self.devices[device]
+            for matches in self.__matches.values():
+                matches.discard(port)
+            for route in self.routes:
+                route.connected.discard(port)
+            for route in self.__targets.get(port, ()):
+                route.connected.clear()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Returns the devices and routes, for the remote API."""
+        with self.__lock:
+            return {
+                'devices': {name: sorted(ports)
+                            for name, ports in self.devices.items()
+                            },
+                'routes': [{'from': route.sources, 'to': route.target,
+                            'connected': sorted(route.connected)
+                            }
+                           for route in self.routes
+                           ],
+            }
@@ -0,0 +1,161 @@
+"""Layered switch bindings.
+
+Switch bindings are organized as a stack of layers.  The bottom layers
+belong to the engine (the "base" layer for bindings that are always present,
+e.g. the microswitch that brings up the menu, and the "config" layer for the
+bindings of the current config), temporary things like menus push layers of
+their own on top.  A switch that isn't bound in a layer falls through to
+the layers below it.
+
+The effective bindings of all layers are compiled into a single
+BindingTable whenever a layer changes, so that handling a switch event only
+costs a lookup in that table.
+
+Layers are either used as scopes:
+
+    with engine.layers.scope('menu') as layer:
+        layer.bind_press(0, handler)
+        ...
+
+or pushed and popped explicitly when their lifetime isn't lexical:
+
+    layer = engine.layers.push('menu')
+    ...
+    engine.layers.pop(layer)
+
+Popping a layer that isn't on top of the stack reports and removes the
+layers above it, which were leaked by whoever pushed them.
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+from gestures import Bindings, BindingTable, GestureHandler, PressHandler
+import threading
+from typing import Iterable, Iterator, List
+
+# A stack deeper than this is reported as a probable leak.
+MAX_DEPTH = 8
+
+class Layer:
+    """A layer of switch bindings.  Create these with LayerStack.push()."""
+
+    def __init__(self, stack: LayerStack, name: str):
+        self.name = name
+        self.bindings = Bindings()
+        self.__stack = stack
+
+    def bind_press(self, index: int, handler: PressHandler) -> None:
+        """Bind a press/release handler, see gestures.Bindings."""
+        self.bindings.press[index] = handler
+        self.__stack.rebuild()
+
+    def bind_gesture(self, index: int, gesture: str, handler: GestureHandler
+                     ) -> None:
+        """Bind a gesture (see the gestures module) on a switch."""
+        self.bindings.gestures.setdefault(index, {})[gesture] = handler
+        self.__stack.rebuild()
+
+    def bind_chord(self, indices: Iterable[int], handler: GestureHandler
+                   ) -> None:
+        """Bind the simultaneous press of a set of switches."""
+        self.bindings.chords[frozenset(indices)] = handler
+        self.__stack.rebuild()
+
+    def clear(self) -> None:
+        """Remove all of the layer's bindings."""
+        self.bindings.clear()
+        self.__stack.rebuild()
+
+    def __repr__(self) -> str:
+        return f'<Layer {self.name}>'
+
+class LayerStack:
+    """A stack of binding layers.
+
+    Attributes:
+        table: The compiled effective bindings of the stack.  This is
+            replaced (never modified) when the stack changes, so it's safe to
+            read without a lock.
+    """
+
+    def __init__(self):
+        self.__layers : List[Layer] = []
+        self.__lock = threading.RLock()
+        self.table = BindingTable()
+
+    def push(self, name: str) -> Layer:
+        """Push a new, empty layer and return it."""
+        with self.__lock:
+            layer = Layer(self, name)
+            self.__layers.append(layer)
+            if len(self.__layers) > MAX_DEPTH:
+                print(f'Warning: binding layer stack is {len(self.__layers)} '
+                      f'deep, probable leak: {self.__layers}')
+            # An empty layer doesn't change the effective bindings.
+            return layer
+
+    def pop(self, layer: Layer) -> None:
+        """Remove 'layer' from the stack.
+
+        If there are layers above it, they are reported as leaked and
+        removed as well.
+        """
+        with self.__lock:
+            if layer not in self.__layers:
+                print(f'Warning: {layer} popped twice')
+                return
+            index = self.__layers.index(layer)
+            leaked = self.__layers[index + 1:]
+            if leaked:
+                print(f'Warning: {layer} popped with leaked layers {leaked}')
+            del self.__layers[index:]
+            self.rebuild()
+
+    @contextmanager
+    def scope(self, name: str) -> Iterator[Layer]:
+        """Context manager that pushes a layer and pops it on exit."""
+        layer = self.push(name)
+        try:
+            yield layer
+        finally:
+            self.pop(layer)
+
+    @property
+    def layers(self) -> List[Layer]:
+        """The layers, from bottom to top."""
+        return list(self.__layers)
+
+    def rebuild(self) -> None:
+        """Recompile the effective binding table."""
+        with self.__lock:
+            # Work from the top down, each layer only gets the switches that
+            # aren't bound by the layers above it.  A chord falls through
+            # only if none of its switches are bound above it.
+            claimed = set()
+            press = {}
+            gestures = {}
+            chords = {}
+            for layer in reversed(self.__layers):
+                bindings = layer.bindings
+                for index, handler in bindings.press.items():
+                    if index not in claimed:
+                        press[index] = handler
+                for index, handlers in bindings.gestures.items():
+                    if index not in claimed and handlers:
+                        gestures[index] = dict(handlers)
+                for chord, handler in bindings.chords.items():
+                    if not chord & claimed:
+                        chords[chord] = handler
+                claimed |= bindings.bound()
+
+            table = BindingTable(max(claimed) + 1 if claimed else 0)
+            for index, handler in press.items():
+                table.press[index] = handler
+            for index, handlers in gestures.items():
+                table.gestures[index] = handlers
+            table.chords = chords
+            for chord in chords:
+                for index in chord:
+                    table.chord_mask |= 1 << index
+            self.table = table
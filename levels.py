@@ -0,0 +1,356 @@
+"""Level metering and automatic preset volume.
+
+The LevelMonitor taps the input (the guitar) and the output (whatever is
+connected to each of the playback ports) and measures their RMS level and
+their loudness.  Loudness follows ITU-R BS.1770: K-weighted mean square over
+400ms blocks, in LUFS.  The K-weighting is applied in the frequency domain
+(the power spectrum of the block times the filter's power response), so a
+measurement is a couple of FFTs rather than a per-sample filter loop.
+
+The output is measured on each playback port and the mean squares are
+averaged, so a mono signal sent to both ports reads the same as on one
+port.  (Tapping the sum of the sources would add up signals that are only
+ever heard on separate speakers.)
+
+Output loudness is attributed to the current preset, which configs report
+with set_preset() along with the volume they set it to.  Blocks where the
+output is quieter than ACTIVE_GATE (i.e. we're not playing) are ignored.
+Once a preset has been measured for MIN_MEASURED_TIME, volume() returns the
+volume that brings it to TARGET_LOUDNESS, and configs use that instead of
+their hand-tuned default the next time they switch to it.
+
+Volumes are midi values (0-127), assumed to scale amplitude linearly.  The
+measurements are kept in LEVELS_FILE.
+
+Run this module to check the loudness measurement against the reference
+levels of BS.1770:
+
+    python3 levels.py
+"""
+
+from __future__ import annotations
+
+import asyncio
+import attr
+from audiotap import AudioTap
+from boot import lazy_import
+from functools import lru_cache
+import jack
+import json
+import math
+import os
+from snapshot import SnapshotWriter
+import sys
+import threading
+from typing import Any, Dict, Optional, Sequence
+
+np = lazy_import('numpy')
+
+LEVELS_FILE = os.path.expanduser('~/.pidal/levels.json')
+
+# Loudness that presets are calibrated to, in LUFS.
+TARGET_LOUDNESS = float(os.environ.get('PIDAL_TARGET_LUFS', -18.0))
+
+# Loudness block size and the interval between measurements, in seconds.
+BLOCK_TIME = 0.4
+MEASURE_INTERVAL = 0.1
+
+# Output blocks below this loudness aren't attributed to the preset.
+ACTIVE_GATE = -50.0
+
+# Seconds of measurements needed before a preset's volume is calibrated.
+MIN_MEASURED_TIME = 10.0
+
+# Time constant of the loudness average, in seconds of measurements.
+AVERAGE_TIME = 60.0
+
+# Interval between checks of what's connected to the playback ports.
+SOURCE_CHECK_INTERVAL = 2.0
+
+MAX_VOLUME = 127
+
+# Loudness of silence.
+SILENCE = -120.0
+
+@lru_cache(maxsize=8)
+def k_weighting(size: int, samplerate: int) -> np.ndarray:
+    """Returns the power response of the BS.1770 K-weighting filter at the
+    frequencies of an rfft of 'size' frames, scaled for Parseval's theorem
+    so that the mean square of the weighted block is the dot product of
+    this with the block's power spectrum.
+    """
+    z = np.exp(-1j * np.pi * np.arange(size // 2 + 1) * 2 / size)
+
+    def biquad(b: Sequence[float], a: Sequence[float]) -> np.ndarray:
+        return (b[0] + b[1] * z + b[2] * z * z) / \
+            (a[0] + a[1] * z + a[2] * z * z)
+
+    # The pre-filter (a high shelf) and the RLB high pass, with the
+    # coefficients computed for 'samplerate' (see BS.1770-4, table 1 and 2
+    # for the 48kHz values these reproduce).
+    k = math.tan(math.pi * 1681.974450955533 / samplerate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = biquad([(vh + vb * k / q + k * k) / a0,
+                    2 * (k * k - vh) / a0,
+                    (vh - vb * k / q + k * k) / a0
+                    ],
+                   [1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+                   )
+    k = math.tan(math.pi * 38.13547087602444 / samplerate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    high_pass = biquad([1, -2, 1],
+                       [1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+                       )
+
+    weights = np.abs(shelf * high_pass) ** 2 * 2 / (size * size)
+    weights[0] /= 2
+    if size % 2 == 0:
+        weights[-1] /= 2
+    return weights
+
+def k_power(frames: np.ndarray, samplerate: int) -> float:
+    """Returns the K-weighted mean square of a block of mono frames."""
+    spectrum = np.fft.rfft(frames)
+    return float(np.dot(k_weighting(len(frames), samplerate),
+                        spectrum.real ** 2 + spectrum.imag ** 2
+                        ))
+
+def power_to_lufs(power: float) -> float:
+    return -0.691 + 10 * math.log10(power) if power > 1e-12 else SILENCE
+
+def loudness(frames: np.ndarray, samplerate: int) -> float:
+    """Returns the loudness of a block of mono frames, in LUFS."""
+    return power_to_lufs(k_power(frames, samplerate))
+
+def mean_square(frames: np.ndarray) -> float:
+    return float(np.dot(frames, frames)) / len(frames)
+
+def power_to_db(power: float) -> float:
+    return 10 * math.log10(power) if power > 1e-12 else SILENCE
+
+def rms_db(frames: np.ndarray) -> float:
+    """Returns the RMS level of 'frames' in dBFS."""
+    return power_to_db(mean_square(frames))
+
+@attr.s
+class PresetLevel:
+    """Measured level of a preset.
+
+    Attributes:
+        loudness: Average loudness normalized to full volume (i.e. the
+            loudness the preset would have at a volume of MAX_VOLUME).
+        seconds: Time measured.
+    """
+    loudness : float = attr.ib(default=SILENCE)
+    seconds : float = attr.ib(default=0.0)
+
+    def add(self, loudness: float, volume: int, seconds: float) -> None:
+        normalized = loudness - 20 * math.log10(max(volume, 1) / MAX_VOLUME)
+        if not self.seconds:
+            self.loudness = normalized
+        else:
+            # Exponential average of the power, rather than of the LUFS.
+            weight = seconds / min(self.seconds + seconds, AVERAGE_TIME)
+            power = (1 - weight) * 10 ** (self.loudness / 10) + \
+                weight * 10 ** (normalized / 10)
+            self.loudness = 10 * math.log10(power)
+        self.seconds += seconds
+
+class LevelMonitor:
+    """Meters the audio path and calibrates preset volumes.
+
+    Attributes:
+        preset: Key of the current preset, None if the current config
+            doesn't report presets.
+        levels: Measured level by preset key.
+        input_rms, input_loudness, output_rms, output_loudness: The most
+            recent measurements.
+    """
+
+    def __init__(self, client: jack.Client,
+                 input_port: str = 'system:capture_1',
+                 playback_ports: Sequence[str] = ('system:playback_1',
+                                                  'system:playback_2'
+                                                  ),
+                 filename: Optional[str] = LEVELS_FILE,
+                 target: float = TARGET_LOUDNESS
+                 ):
+        """
+        Args:
+            client: JACK client used to look up the playback connections.
+            input_port: The input to meter.
+            playback_ports: The output is what's connected to these, each
+                port is tapped on its own channel.
+            filename: File the measurements are stored in, None to not store
+                them.
+            target: Loudness to calibrate presets to.
+        """
+        self.client = client
+        self.playback_ports = list(playback_ports)
+        self.target = target
+        self.tap = AudioTap([input_port] + [None] * len(self.playback_ports),
+                            seconds=1.0, client_name='pidal-levels'
+                            )
+        self.preset : Optional[str] = None
+        self.__volume = MAX_VOLUME
+        self.levels : Dict[str, PresetLevel] = {}
+        self.__lock = threading.Lock()
+        self.input_rms = self.input_loudness = SILENCE
+        self.output_rms = self.output_loudness = SILENCE
+
+        self.__writer : Optional[SnapshotWriter] = None
+        if filename:
+            self.__writer = SnapshotWriter(self.to_json, filename,
+                                           min_interval=30.0
+                                           )
+            self.__load(filename)
+
+    def __load(self, filename: str) -> None:
+        try:
+            with open(filename) as src:
+                data = json.load(src)
+        except (OSError, ValueError):
+            return
+        for key, level in data.items():
+            self.levels[key] = PresetLevel(**level)
+
+    def to_json(self) -> Dict[str, Any]:
+        with self.__lock:
+            return {key: attr.asdict(level)
+                    for key, level in self.levels.items()
+                    }
+
+    def set_preset(self, key: Optional[str], volume: int = MAX_VOLUME
+                   ) -> None:
+        """Attribute the output level to preset 'key' from now on.
+
+        Args:
+            key: Preset key, unique across configs (e.g. "<config
+                name>/<preset name>"), None to stop attributing.
+            volume: The volume the preset was set to.
+        """
+        with self.__lock:
+            self.preset = key
+            self.__volume = volume
+
+    def volume(self, key: str, default: int) -> int:
+        """Returns the volume to use for preset 'key'.
+
+        This is the calibrated volume if the preset has been measured for
+        long enough, 'default' otherwise.
+        """
+        level = self.levels.get(key)
+        if level is None or level.seconds < MIN_MEASURED_TIME:
+            return default
+        volume = MAX_VOLUME * 10 ** ((self.target - level.loudness) / 20)
+        return max(1, min(MAX_VOLUME, int(round(volume))))
+
+    def __measure(self) -> None:
+        samplerate = self.tap.samplerate
+        size = int(BLOCK_TIME * samplerate)
+        input = self.tap.rings[0].window(size)
+        self.input_rms = rms_db(input)
+        self.input_loudness = loudness(input, samplerate)
+        outputs = [ring.window(size) for ring in self.tap.rings[1:]]
+        self.output_rms = power_to_db(
+            sum(mean_square(output) for output in outputs) / len(outputs)
+        )
+        self.output_loudness = power_to_lufs(
+            sum(k_power(output, samplerate) for output in outputs) /
+            len(outputs)
+        )
+        if self.output_loudness < ACTIVE_GATE:
+            return
+        with self.__lock:
+            if self.preset is None:
+                return
+            level = self.levels.get(self.preset)
+            if level is None:
+                level = self.levels[self.preset] = PresetLevel()
+            level.add(self.output_loudness, self.__volume, MEASURE_INTERVAL)
+        if self.__writer:
+            self.__writer.mark_dirty()
+
+    def __update_sources(self) -> None:
+        for channel, port in enumerate(self.playback_ports, 1):
+            try:
+                sources = [
+                    source.name
+                    for source in self.client.get_all_connections(port)
+                    if not source.name.startswith(self.tap.client_name + ':')
+                ]
+            except jack.JackError:
+                continue
+            self.tap.set_sources(channel, sorted(sources))
+
+    async def run(self) -> None:
+        """Meter until cancelled.  Run this in the engine's event loop."""
+        loop = asyncio.get_running_loop()
+        self.tap.acquire()
+        try:
+            checks = 0
+            while True:
+                if not checks:
+                    await loop.run_in_executor(None, self.__update_sources)
+                    checks = int(SOURCE_CHECK_INTERVAL / MEASURE_INTERVAL)
+                checks -= 1
+                await asyncio.sleep(MEASURE_INTERVAL)
+                self.__measure()
+        finally:
+            self.tap.release()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Returns the current levels, for the remote API."""
+        level = self.levels.get(self.preset) if self.preset else None
+        return {
+            'input_rms': self.input_rms,
+            'input_lufs': self.input_loudness,
+            'output_rms': self.output_rms,
+            'output_lufs': self.output_loudness,
+            'preset': self.preset,
+            'preset_lufs': level.loudness if level else None,
+            'preset_volume': self.volume(self.preset, self.__volume)
+                if self.preset else None,
+        }
+
+if __name__ == '__main__':
+    failures = 0
+    for rate in (44100, 48000, 96000):
+        t = np.arange(int(BLOCK_TIME * rate)) / rate
+        for freq, amplitude, expected in (
+                # BS.1770: a 0dB full scale 997Hz sine in one channel reads
+                # -3.01 LKFS.
+                (997.0, 1.0, -3.01),
+                (997.0, 0.1, -23.01),
+                # Reference values from a time domain implementation of the
+                # BS.1770 filters: the shelf adds 3.35dB at 10kHz, the high
+                # pass takes off 6.26dB at 40Hz.
+                (10000.0, 1.0, 0.34),
+                (40.0, 1.0, -9.27)):
+            frames = (amplitude * np.sin(2 * np.pi * freq * t)).astype(
+                np.float32
+            )
+            measured = loudness(frames, rate)
+            ok = abs(measured - expected) < 0.2
+            failures += not ok
+            print(f'{rate:6d} Hz, {freq:7.1f} Hz at {amplitude}: '
+                  f'{measured:+7.2f} LUFS (expected {expected:+.2f}) '
+                  f'{"ok" if ok else "FAIL"}')
+
+    # Calibration goes through LevelMonitor.volume(), with a preset that
+    # needs 6dB more (twice the volume) without hitting MAX_VOLUME.
+    monitor = LevelMonitor(None, filename=None, target=-18.0)
+    level = monitor.levels['test'] = PresetLevel()
+    for i in range(200):
+        level.add(-24.0, 32, MEASURE_INTERVAL)
+    volume = monitor.volume('test', 32)
+    print(f'preset at -24 LUFS with volume 32 calibrates to volume '
+          f'{volume} for -18 LUFS')
+    if abs(volume - 32 * 2) > 1:
+        failures += 1
+        print('FAIL')
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,426 @@
+"""Audio looper.
+
+The Looper is a JACK client that records its inputs into layers and plays
+back their mix.  The first take sets the loop length, each overdub after
+that goes into a new layer so that it can be undone.
+
+The layers and the mix are memory-mapped files in LOOP_DIR, so a long loop
+costs page cache rather than process memory.  When the looper starts their
+disk blocks are allocated for MAX_LOOP_TIME (posix_fallocate, not sparse
+files) so the process callback never extends a file, and the pages that
+the callback writes before anything else touches them (the first take and
+the mix) are faulted in by zeroing them.  An overdub layer is zeroed over
+the loop length by the control side before it's recorded.  The pages
+aren't locked, so under memory pressure the kernel can still evict them.
+The mix is kept up to date as layers are recorded (the process
+callback adds the input to it), so playback copies from a single buffer
+however many layers there are, and undo subtracts the layer from the mix
+with one vectorized operation outside of the process callback.
+
+The process callback never allocates audio buffers, it only copies between
+the JACK port buffers and the preallocated arrays.  Changes of state are
+passed to it through a single command slot, applied at the start of a
+period, so that transitions land on period boundaries and the callback
+never waits for a lock.
+
+util.LoopButtons puts a looper on two buttons of a ConfigFramework config.
+This module doesn't depend on the engine, so its self-test can be run on
+its own:
+
+    python3 looper.py
+"""
+
+from __future__ import annotations
+
+from boot import lazy_import
+import jack
+import os
+import threading
+import time
+from typing import Any, List, Optional, Sequence
+
+np = lazy_import('numpy')
+
+LOOP_DIR = os.path.expanduser('~/.pidal/loops')
+
+# Longest loop, in seconds.
+MAX_LOOP_TIME = 120.0
+
+# Maximum number of layers (the first take and the overdubs).
+MAX_LAYERS = 16
+
+# Shortest take, in seconds.  Anything shorter is treated as a mistake.
+MIN_LOOP_TIME = 0.1
+
+# Looper states.
+EMPTY = 'empty'
+RECORDING = 'recording'
+PLAYING = 'playing'
+OVERDUBBING = 'overdubbing'
+STOPPED = 'stopped'
+
+# Commands to the process callback.
+_NONE = 0
+_START_RECORD = 1
+_END_RECORD = 2
+_START_OVERDUB = 3
+_END_OVERDUB = 4
+_PLAY = 5
+_STOP = 6
+_UNDO = 7
+_CLEAR = 8
+
+class Looper:
+    """A multi-layer looper.
+
+    Attributes:
+        state: One of the state constants.
+        length: Loop length in frames, 0 if there's no loop.
+        pos: Playback/record position in frames.
+        layers: Number of recorded layers.
+    """
+
+    def __init__(self, inputs: Sequence[str], outputs: Sequence[str],
+                 name: str = 'pidal-looper'
+                 ):
+        """
+        Args:
+            inputs: JACK ports to record, one per channel.
+            outputs: JACK ports to play the loop to, one per channel.
+            name: JACK client name, also used for the take files.
+        """
+        assert len(inputs) == len(outputs)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.name = name
+        self.channels = len(inputs)
+        self.state = EMPTY
+        self.length = 0
+        self.pos = 0
+        self.layers = 0
+        self.capacity = 0
+        self.__client : Optional[jack.Client] = None
+        self.__mix : Optional[np.ndarray] = None
+        self.__layers : List[np.ndarray] = []
+        self.__in_ports : List[Any] = []
+        self.__out_ports : List[Any] = []
+        self.__min_length = 0
+
+        # The command slot, written by the control side and cleared by the
+        # process callback when it has applied the command.  __lock
+        # serializes the control side.
+        self.__pending = _NONE
+        self.__lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.__client is not None
+
+    def __map(self, filename: str, touch: bool = False) -> np.ndarray:
+        """Map a take file, allocating its blocks first.
+
+        Args:
+            filename: File name in LOOP_DIR.
+            touch: If true, fault the pages in by zeroing them.
+        """
+        path = os.path.join(LOOP_DIR, filename)
+        size = self.channels * self.capacity * np.dtype(np.float32).itemsize
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError as ex:
+                print(f'Unable to allocate {path}: {ex}')
+        finally:
+            os.close(fd)
+        result = np.memmap(path, dtype=np.float32, mode='r+',
+                           shape=(self.channels, self.capacity)
+                           )
+        if touch:
+            result.fill(0)
+        return result
+
+    def start(self) -> None:
+        """Create the JACK client and the take files."""
+        with self.__lock:
+            if self.__client:
+                return
+            client = jack.Client(self.name)
+            self.capacity = int(MAX_LOOP_TIME * client.samplerate)
+            self.__min_length = max(int(MIN_LOOP_TIME * client.samplerate),
+                                    2 * client.blocksize
+                                    )
+            os.makedirs(LOOP_DIR, exist_ok=True)
+            self.__mix = self.__map(f'{self.name}-mix.f32', touch=True)
+            self.__layers = [self.__map(f'{self.name}-layer{i}.f32',
+                                        touch=not i
+                                        )
+                             for i in range(MAX_LAYERS)
+                             ]
+            self.__in_ports = [client.inports.register(f'in_{i + 1}')
+                               for i in range(self.channels)
+                               ]
+            self.__out_ports = [client.outports.register(f'out_{i + 1}')
+                                for i in range(self.channels)
+                                ]
+            self.__apply(_CLEAR)
+            client.set_process_callback(self._process)
+            client.activate()
+            for src, dst in zip(self.inputs, self.__in_ports):
+                self.__connect(client, src, dst)
+            for src, dst in zip(self.__out_ports, self.outputs):
+                self.__connect(client, src, dst)
+            self.__client = client
+
+    def __connect(self, client: jack.Client, src: Any, dst: Any) -> None:
+        try:
+            client.connect(src, dst)
+        except jack.JackError as ex:
+            print(f'Looper unable to connect {src} to {dst}: {ex}')
+
+    def stop(self) -> None:
+        """Release the JACK client and the take files.  The loop is lost."""
+        with self.__lock:
+            if not self.__client:
+                return
+            self.__client.deactivate()
+            self.__client.close()
+            self.__client = None
+            self.__apply(_CLEAR)
+            self.__mix = None
+            self.__layers = []
+
+    # The control side.
+
+    def __send(self, command: int) -> None:
+        """Pass 'command' to the process callback and wait for it to be
+        applied.  Must be called with the lock held.
+        """
+        if not self.__client:
+            self.__apply(command)
+            return
+        self.__pending = command
+        deadline = time.time() + 0.5
+        while self.__pending and time.time() < deadline:
+            time.sleep(0.001)
+        if self.__pending:
+            # JACK isn't running us, so there's nobody to race with.
+            self.__pending = _NONE
+            self.__apply(command)
+
+    def advance(self) -> None:
+        """Record, play or overdub, depending on the state (see the module
+        docs).
+        """
+        with self.__lock:
+            if not self.__client:
+                return
+            state = self.state
+            if state == EMPTY:
+                self.__send(_START_RECORD)
+            elif state == RECORDING:
+                self.__send(_END_RECORD)
+            elif state == PLAYING:
+                if self.layers >= MAX_LAYERS:
+                    print('Looper is out of layers')
+                    return
+                # The layer may hold an undone take, it must be silent
+                # outside of the part we overdub.
+                self.__layers[self.layers][:, :self.length] = 0
+                self.__send(_START_OVERDUB)
+            elif state == OVERDUBBING:
+                self.__send(_END_OVERDUB)
+            elif state == STOPPED:
+                self.__send(_PLAY)
+
+    def toggle_play(self) -> None:
+        """Stop playback, or restart it from the top."""
+        with self.__lock:
+            if self.state in (PLAYING, OVERDUBBING):
+                self.__send(_STOP)
+            elif self.state == STOPPED:
+                self.__send(_PLAY)
+
+    def undo(self) -> None:
+        """Drop the last layer, or the take being recorded."""
+        with self.__lock:
+            layers = self.layers
+            self.__send(_UNDO)
+            if 0 < self.layers < layers:
+                length = self.length
+                mix = self.__mix[:, :length]
+                np.subtract(mix, self.__layers[self.layers][:, :length],
+                            out=mix
+                            )
+
+    def clear(self) -> None:
+        """Drop the loop."""
+        with self.__lock:
+            self.__send(_CLEAR)
+
+    # The process side.
+
+    def __apply(self, command: int) -> None:
+        """Apply a command.  Runs in the process callback (or with the
+        client stopped).
+        """
+        if command == _START_RECORD:
+            self.pos = 0
+            self.length = 0
+            self.layers = 1
+            self.state = RECORDING
+        elif command == _END_RECORD:
+            if self.pos < self.__min_length:
+                self.__apply(_CLEAR)
+                return
+            self.length = self.pos
+            self.pos = 0
+            self.state = PLAYING
+        elif command == _START_OVERDUB:
+            self.layers += 1
+            self.state = OVERDUBBING
+        elif command in (_END_OVERDUB, _PLAY):
+            self.state = PLAYING
+        elif command == _STOP:
+            self.pos = 0
+            self.state = STOPPED
+        elif command == _UNDO:
+            if self.state == RECORDING or self.layers <= 1:
+                self.__apply(_CLEAR)
+            else:
+                self.layers -= 1
+                if self.state == OVERDUBBING:
+                    self.state = PLAYING
+        elif command == _CLEAR:
+            self.state = EMPTY
+            self.pos = 0
+            self.length = 0
+            self.layers = 0
+
+    def _process(self, frames: int) -> None:
+        """The JACK process callback."""
+        command = self.__pending
+        if command:
+            self.__apply(command)
+            self.__pending = _NONE
+
+        state = self.state
+        if state == RECORDING and self.pos + frames > self.capacity:
+            self.__apply(_END_RECORD)
+            state = self.state
+
+        if state == RECORDING:
+            pos = self.pos
+            end = pos + frames
+            layer = self.__layers[0]
+            for c in range(self.channels):
+                input = self.__in_ports[c].get_array()
+                layer[c, pos:end] = input
+                self.__mix[c, pos:end] = input
+                self.__out_ports[c].get_array().fill(0)
+            self.pos = end
+        elif state == PLAYING or state == OVERDUBBING:
+            pos = self.pos
+            length = self.length
+
+            # The period may wrap around the end of the loop (only once,
+            # the loop is at least two periods long).
+            first = min(frames, length - pos)
+            rest = frames - first
+            layer = self.__layers[self.layers - 1] \
+                if state == OVERDUBBING else None
+            for c in range(self.channels):
+                mix = self.__mix[c]
+                output = self.__out_ports[c].get_array()
+                output[:first] = mix[pos:pos + first]
+                output[first:] = mix[:rest]
+                if layer is not None:
+                    input = self.__in_ports[c].get_array()
+                    layer[c, pos:pos + first] = input[:first]
+                    layer[c, :rest] = input[first:]
+                    np.add(mix[pos:pos + first], input[:first],
+                           out=mix[pos:pos + first]
+                           )
+                    np.add(mix[:rest], input[first:], out=mix[:rest])
+            self.pos = (pos + frames) % length
+        else:
+            for port in self.__out_ports:
+                port.get_array().fill(0)
+
+    def mixdown(self) -> np.ndarray:
+        """Returns the loop, mixed down from the layers (channels x length).
+
+        This rebuilds the mix from scratch rather than returning the
+        running mix, so it's also a check on it.
+        """
+        with self.__lock:
+            result = np.zeros((self.channels, self.length),
+                              dtype=np.float32
+                              )
+            for layer in self.__layers[:self.layers]:
+                np.add(result, layer[:, :self.length], out=result)
+            return result
+
+if __name__ == '__main__':
+    # Run the process callback against fake ports: record a take, overdub
+    # two layers, undo one, and check the mix and the output.
+    class _FakePort:
+        def __init__(self, frames: int):
+            self.array = np.zeros(frames, dtype=np.float32)
+
+        def get_array(self) -> np.ndarray:
+            return self.array
+
+    import tempfile
+    LOOP_DIR = tempfile.mkdtemp()
+    MAX_LOOP_TIME = 1.0
+    frames = 64
+    looper = Looper(['in'], ['out'], name='test')
+    looper.capacity = int(MAX_LOOP_TIME * 48000)
+    looper._Looper__min_length = 2 * frames
+    looper._Looper__mix = looper._Looper__map('test-mix.f32')
+    looper._Looper__layers = [looper._Looper__map(f'test-layer{i}.f32')
+                              for i in range(MAX_LAYERS)
+                              ]
+    inp, out = _FakePort(frames), _FakePort(frames)
+    looper._Looper__in_ports = [inp]
+    looper._Looper__out_ports = [out]
+
+    def run(periods: int, value: float) -> None:
+        for i in range(periods):
+            inp.array.fill(value)
+            looper._process(frames)
+
+    looper._Looper__apply(_START_RECORD)
+    run(10, 1.0)
+    looper._Looper__apply(_END_RECORD)
+    assert looper.length == 10 * frames, looper.length
+    run(3, 0.0)
+    assert np.all(out.array == 1.0)
+
+    for value in (2.0, 4.0):
+        # Overdub half a loop, starting mid-period to exercise the wrap.
+        looper._Looper__layers[looper.layers][:, :looper.length] = 0
+        looper._Looper__apply(_START_OVERDUB)
+        run(5, value)
+        looper._Looper__apply(_END_OVERDUB)
+    assert looper.layers == 3
+    assert np.allclose(looper.mixdown(), looper._Looper__mix[:, :640])
+    mix = looper.mixdown()[0]
+    print('mix values after two overdubs:', sorted(set(mix.tolist())))
+
+    looper.undo()
+    assert looper.layers == 2
+    assert np.allclose(looper.mixdown(), looper._Looper__mix[:, :640])
+    print('mix values after undo:',
+          sorted(set(looper.mixdown()[0].tolist())))
+
+    # Callback cost while overdubbing.
+    looper._Looper__apply(_START_OVERDUB)
+    iterations = 20000
+    start = time.perf_counter()
+    for i in range(iterations):
+        looper._process(frames)
+    elapsed = (time.perf_counter() - start) / iterations
+    print(f'overdub callback: {elapsed * 1e6:.1f} us per {frames} frames')
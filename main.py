@@ -1,8 +1,22 @@
+import boot
+boot.start()
+
 from ui import Screen
 from engine import Engine
 
-engine = Engine.get_instance()
-main_screen = Screen()
-engine.initialize()
+with boot.span('engine'):
+    engine = Engine.get_instance()
+with boot.span('ui'):
+    main_screen = Screen()
+
+# Paint the UI before initializing the engine, which waits for the audio
+# programs to come up, so that there's something on the screen while it
+# does.  The home screen shows a splash until the engine has restored its
+# config.
+main_screen.update()
+boot.mark('ui first paint')
+with boot.span('engine initialize'):
+    engine.initialize()
 
+main_screen.after_idle(boot.finish)
 main_screen.mainloop()
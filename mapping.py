@@ -0,0 +1,110 @@
+"""Compiled controller mapping tables.
+
+Physical controllers (an expression pedal on an FCB1010, a knob on a
+keyboard...) are identified by their midi channel and controller number.
+Extensions and midi learn bind these to controller names ("RightPedal"), and
+configs bind controller names to targets (a plugin parameter, a midi
+controller on another program).
+
+Rather than resolving names on every event, we compile these two mappings
+into a dense table indexed by (channel, controller) for each config.  Each
+entry holds the target function along with a precomputed offset and scale
+factor, so handling an incoming control change is one list lookup and a
+multiply.
+"""
+
+from __future__ import annotations
+
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+# Controller numbers per channel.
+NUM_CONTROLLERS = 128
+
+# Size of a controller table: 16 channels of 128 controllers.
+TABLE_SIZE = 16 * NUM_CONTROLLERS
+
+# Key identifying a physical controller: (channel, controller).  A channel of
+# None matches all channels.
+ControllerKey = Tuple[Optional[int], int]
+
+class ControllerTarget:
+    """Something a controller can be mapped to.
+
+    'func' is called with the controller value mapped linearly from the
+    midi range (0..127) to the range min..max.
+    """
+
+    __slots__ = ('func', 'min', 'max')
+
+    def __init__(self, func: Callable[[float], None], min: float = 0,
+                 max: float = 127
+                 ):
+        self.func = func
+        self.min = min
+        self.max = max
+
+class Binding:
+    """A compiled table entry."""
+
+    __slots__ = ('offset', 'scale', 'func')
+
+    def __init__(self, target: ControllerTarget):
+        self.offset = target.min
+        self.scale = (target.max - target.min) / 127
+        self.func = target.func
+
+class ControllerTable:
+    """Dense table of Binding objects indexed by channel * 128 + controller.
+    """
+
+    __slots__ = ('entries',)
+
+    def __init__(self):
+        self.entries = [None] * TABLE_SIZE
+
+    def bind(self, channel: int, controller: int, binding: Binding) -> None:
+        self.entries[channel * NUM_CONTROLLERS + controller] = binding
+
+    def dispatch(self, channel: int, controller: int, value: int) -> bool:
+        """Dispatch a controller value to its target.
+
+        Returns true if the controller is bound, false if not.
+        """
+        binding = self.entries[channel * NUM_CONTROLLERS + controller]
+        if binding is None:
+            return False
+        binding.func(binding.offset + value * binding.scale)
+        return True
+
+def compile_table(names: Dict[ControllerKey, str],
+                  targets: Dict[str, ControllerTarget]
+                  ) -> ControllerTable:
+    """Compile a controller table.
+
+    Args:
+        names: Mapping from physical controller to controller name.  Entries
+            with a specific channel take precedence over entries for all
+            channels.
+        targets: Mapping from controller name to target.  Names with no
+            target are left unbound so events for them fall through to the
+            midi input handlers.
+    """
+    table = ControllerTable()
+
+    def sorted_keys() -> Iterable[ControllerKey]:
+        # Do the "all channel" entries first so that specific channels
+        # overwrite them.
+        return sorted(names, key=lambda key: key[0] is not None)
+
+    for key in sorted_keys():
+        target = targets.get(names[key])
+        if target is None:
+            continue
+        binding = Binding(target)
+        channel, controller = key
+        if channel is None:
+            for channel in range(16):
+                table.bind(channel, controller, binding)
+        else:
+            table.bind(channel, controller, binding)
+    return table
@@ -0,0 +1,132 @@
+"""Preallocated midi messages.
+
+Every midi message that we send through amidi has to be a midi.Event object.
+Rather than constructing a new event for every footswitch press and every
+pedal update, we keep tables of prebuilt events and hand out the same object
+every time the same message is sent.  A sustained controller stream from an
+expression pedal therefore doesn't create any new event objects.
+"""
+
+from __future__ import annotations
+
+from midi import ControlChange, Event, ProgramChange
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Status nibbles for the channel messages that we deal with.
+CONTROL_CHANGE = 0xB0
+PROGRAM_CHANGE = 0xC0
+
+# Length of each of those messages, including the status byte.
+_MESSAGE_LENGTHS = {CONTROL_CHANGE: 3, PROGRAM_CHANGE: 2}
+
+# Controller numbers used for bank select.
+BANK_MSB = 0
+BANK_LSB = 32
+
+class Command:
+    """A fixed sequence of prebuilt events to be sent to a single port.
+
+    Use this for things like "select bank 1, program 3" where the entire
+    message sequence is known when the config is created.
+    """
+
+    __slots__ = ('port', 'events')
+
+    def __init__(self, port, events: Sequence[Event]):
+        self.port = port
+        self.events = tuple(events)
+
+class MessageCache:
+    """Tables of preallocated channel messages.
+
+    Tables are populated lazily: the first time a (channel, controller) pair
+    is used we build all 128 values for it, after that every message for that
+    controller is a pair of list lookups.
+
+    Events in the cache are shared, callers must never modify them.
+    """
+
+    __slots__ = ('__cc', '__pc', '__programs')
+
+    def __init__(self):
+        # __cc[channel][controller] is either None or a list of 128 events,
+        # one for each controller value.
+        self.__cc : List[List[Optional[List[ControlChange]]]] = \
+            [[None] * 128 for channel in range(16)]
+
+        # __pc[channel] is either None or a list of 128 program changes.
+        self.__pc : List[Optional[List[ProgramChange]]] = [None] * 16
+
+        # Bank and program selection sequences by (channel, bank, program).
+        self.__programs : Dict[Tuple[int, int, int], Tuple[Event, ...]] = {}
+
+    def control_change(self, channel: int, controller: int, value: int
+                       ) -> ControlChange:
+        """Returns the prebuilt control change event for the parameters.
+
+        Raises ValueError if a parameter is out of range.
+        """
+        if not (0 <= channel < 16 and 0 <= controller < 128 and
+                0 <= value < 128):
+            raise ValueError(f'Invalid control change: channel {channel}, '
+                             f'controller {controller}, value {value}')
+        table = self.__cc[channel][controller]
+        if table is None:
+            table = self.__cc[channel][controller] = [
+                ControlChange(0, channel, controller, v) for v in range(128)
+            ]
+        return table[value]
+
+    def program_change(self, channel: int, program: int) -> ProgramChange:
+        """Returns the prebuilt program change event for the parameters.
+
+        Raises ValueError if a parameter is out of range.
+        """
+        if not (0 <= channel < 16 and 0 <= program < 128):
+            raise ValueError(f'Invalid program change: channel {channel}, '
+                             f'program {program}')
+        table = self.__pc[channel]
+        if table is None:
+            table = self.__pc[channel] = [
+                ProgramChange(0, channel, p) for p in range(128)
+            ]
+        return table[program]
+
+    def program_events(self, channel: int, bank: int, program: int
+                       ) -> Tuple[Event, ...]:
+        """Returns the events to select 'bank' and 'program'.
+
+        The sequence is built the first time it's requested and shared after
+        that.  Raises ValueError if a parameter is out of range.
+        """
+        key = (channel, bank, program)
+        events = self.__programs.get(key)
+        if events is None:
+            if not 0 <= bank < 128 * 128:
+                raise ValueError(f'Invalid bank {bank}')
+            events = self.__programs[key] = (
+                self.control_change(channel, BANK_MSB, bank >> 7),
+                self.control_change(channel, BANK_LSB, bank & 127),
+                self.program_change(channel, program),
+            )
+        return events
+
+    def decode(self, data: bytes) -> Event:
+        """Returns the prebuilt event corresponding to raw midi bytes.
+
+        'data' is a complete channel message (status byte followed by its
+        data bytes).  Raises ValueError for messages that are truncated or that
+        we don't support.
+        """
+        if not data:
+            raise ValueError('Empty midi message')
+        status = data[0]
+        kind = status & 0xF0
+        length = _MESSAGE_LENGTHS.get(kind)
+        if length is not None and len(data) < length:
+            raise ValueError(f'Truncated midi message {bytes(data).hex()}')
+        if kind == CONTROL_CHANGE:
+            return self.control_change(status & 0xF, data[1], data[2])
+        elif kind == PROGRAM_CHANGE:
+            return self.program_change(status & 0xF, data[1])
+        raise ValueError(f'Unsupported midi status byte {status:#x}')
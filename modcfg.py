@@ -0,0 +1,128 @@
+"""Reader for .modcfg files.
+
+The file format is described in custom.ModConfig.  This module only parses
+it, so that tools (e.g. render.py) can read configs without importing
+custom, which starts up the whole pedal.
+"""
+
+from __future__ import annotations
+
+import attr
+from graph import compile_graph, compile_teardown, read_graph
+from mapping import ControllerKey
+import os
+from typing import Dict, List, Optional, Tuple
+
+# Mapping from controller name to a list of (id, param, min, max, curve)
+ControllerMap = Dict[str, List[Tuple[int, str, float, float, str]]]
+
+@attr.s
+class ModCfg:
+    """The contents of a .modcfg file.
+
+    Attributes:
+        name: Config name.
+        buttons: Button names.
+        actions: Pedal action of each button, None if unbound.
+        on_enter: mod-host commands to run on entering the config.  For a
+            config with a graph, this is the compiled graph.
+        on_leave: mod-host commands to run on leaving the config.
+        controllers: Controller targets.
+        controller_names: Config specific midi controller mappings.
+        scenes: (param_set block, transition time in seconds) by scene name.
+        blocksize: Pinned JACK buffer size, None if not pinned.
+    """
+    name : Optional[str] = attr.ib()
+    buttons : List[str] = attr.ib()
+    actions : List[Optional[str]] = attr.ib()
+    on_enter : Optional[str] = attr.ib()
+    on_leave : Optional[str] = attr.ib()
+    controllers : ControllerMap = attr.ib()
+    controller_names : Dict[ControllerKey, str] = attr.ib()
+    scenes : Dict[str, Tuple[str, float]] = attr.ib()
+    blocksize : Optional[int] = attr.ib(default=None)
+
+def read_modcfg(filename: str) -> ModCfg:
+    """Parse a .modcfg file."""
+    src = open(filename)
+
+    name = None
+    buttons = ['1', '2', '3', '4']
+    actions : List[Optional[str]] = [None] * 4
+    on_enter = None
+    on_leave = None
+    controllers : ControllerMap = {}
+    controller_names : Dict[ControllerKey, str] = {}
+    scenes : Dict[str, Tuple[str, float]] = {}
+    graph = None
+    blocksize = None
+
+    def read_block():
+        result = []
+        for line in src:
+            if line.strip() == '}':
+                return ''.join(result)
+            result.append(line)
+        raise Exception('End of line encountered in block')
+
+    def parse_cmd_or_block(args):
+        if args[0] == '{':
+            return read_block()
+        else:
+            return ' '.join(args)
+
+    for line in src:
+        cmd = line.rstrip().split()
+        if not cmd or cmd[0].startswith('#'):
+            continue
+
+        if cmd[0] == 'name':
+            name = ' '.join(cmd[1:])
+        elif cmd[0] == 'pedal':
+            num = int(cmd[1])
+            button_name = cmd[2]
+            action = parse_cmd_or_block(cmd[3:])
+            buttons[num] = button_name
+            actions[num] = action
+        elif cmd[0] == 'controller':
+            controller = cmd[1]
+            id = int(cmd[2])
+            param = cmd[3]
+            min = float(cmd[4])
+            max = float(cmd[5])
+            curve = cmd[6] if len(cmd) > 6 else 'linear'
+            controllers.setdefault(controller, []).append(
+                (id, param, min, max, curve)
+            )
+        elif cmd[0] == 'midi':
+            channel = None if cmd[1] == '*' else int(cmd[1])
+            controller_names[channel, int(cmd[2])] = cmd[3]
+        elif cmd[0] == 'scene':
+            scenes[cmd[1]] = (parse_cmd_or_block(cmd[3:]),
+                              float(cmd[2]) / 1000
+                              )
+        elif cmd[0] == 'on_enter':
+            on_enter = parse_cmd_or_block(cmd[1:])
+        elif cmd[0] == 'on_leave':
+            on_leave = parse_cmd_or_block(cmd[1:])
+        elif cmd[0] == 'blocksize':
+            blocksize = int(cmd[1])
+        elif cmd[0] == 'graph':
+            graph = read_graph(os.path.join(os.path.dirname(filename),
+                                            ' '.join(cmd[1:])
+                                            )
+                               )
+        else:
+            raise Exception(f'Unknown command: {cmd[0]}')
+
+    if graph:
+        if on_enter:
+            raise Exception('A config can have a graph or an on_enter '
+                            'block, not both')
+        on_enter = compile_graph(graph)
+        if on_leave is None:
+            on_leave = compile_teardown(graph)
+
+    return ModCfg(name, buttons, actions, on_enter, on_leave, controllers,
+                  controller_names, scenes, blocksize
+                  )
@@ -1,6 +1,122 @@
 # mod-host interface.
 
 import socket
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+def parse_param_sets(block: str) -> Dict[Tuple[int, str], float]:
+    """Returns the numeric parameter values set by a block of commands.
+
+    The result maps (instance id, symbol) to the last value set for the
+    parameter.  Parameters with non-numeric values are ignored.
+    """
+    result = {}
+    for line in block.split('\n'):
+        cmd = line.split()
+        if len(cmd) == 4 and cmd[0] == 'param_set':
+            try:
+                result[int(cmd[1]), cmd[2]] = float(cmd[3])
+            except ValueError:
+                pass
+    return result
+
+class _BlockState:
+    """The state produced by a block of mod-host commands."""
+
+    def __init__(self, block: str):
+        # Mapping from instance id to plugin url.
+        self.plugins : Dict[int, str] = {}
+
+        # Mapping from instance id to preset url.
+        self.presets : Dict[int, str] = {}
+
+        # Mapping from (instance id, symbol) to the value (as a string).
+        self.params : Dict[Tuple[int, str], str] = {}
+
+        # Mapping from instance id to bypass value ('0' or '1').
+        self.bypass : Dict[int, str] = {}
+
+        # Set of (source, dest) port pairs.
+        self.connections : Set[Tuple[str, str]] = set()
+
+        # All other commands, in order.
+        self.other : List[str] = []
+
+        for line in block.split('\n'):
+            line = line.strip()
+            cmd = line.split()
+            if not cmd:
+                continue
+            if cmd[0] == 'add' and len(cmd) == 3:
+                self.plugins[int(cmd[2])] = cmd[1]
+            elif cmd[0] == 'preset_load' and len(cmd) == 3:
+                self.presets[int(cmd[1])] = cmd[2]
+            elif cmd[0] == 'param_set' and len(cmd) >= 3:
+                self.params[int(cmd[1]), cmd[2]] = ' '.join(cmd[3:])
+            elif cmd[0] == 'bypass' and len(cmd) == 3:
+                self.bypass[int(cmd[1])] = cmd[2]
+            elif cmd[0] == 'connect' and len(cmd) == 3:
+                self.connections.add((cmd[1], cmd[2]))
+            else:
+                self.other.append(line)
+
+def _instance(port: str) -> Optional[int]:
+    """Returns the instance id of a port name like "effect_1:in".
+
+    Returns None for ports that aren't plugin ports.
+    """
+    if port.startswith('effect_'):
+        return int(port[7:].split(':', 1)[0])
+    return None
+
+def diff_blocks(old: str, new: str) -> Optional[str]:
+    """Returns the commands needed to get from the state produced by block
+    'old' to the state produced by block 'new'.
+
+    Only plugins, presets, parameters, bypass states and connections are
+    diffed.  If any other commands differ between the blocks, returns None:
+    the caller must apply the new block from scratch.
+    """
+    old = _BlockState(old)
+    new = _BlockState(new)
+    if old.other != new.other:
+        return None
+
+    # Plugins that have been removed or whose url has changed.
+    removed = {id for id, url in old.plugins.items()
+               if new.plugins.get(id) != url}
+    added = {id for id, url in new.plugins.items()
+             if old.plugins.get(id) != url}
+
+    def touches(connection: Tuple[str, str], ids: Set[int]) -> bool:
+        return _instance(connection[0]) in ids or \
+            _instance(connection[1]) in ids
+
+    result = []
+    for src, dst in sorted(old.connections - new.connections):
+        if not touches((src, dst), removed):
+            result.append(f'disconnect {src} {dst}')
+    for id in sorted(removed):
+        result.append(f'remove {id}')
+    for id in sorted(added):
+        result.append(f'add {new.plugins[id]} {id}')
+    for id, url in sorted(new.presets.items()):
+        if id in added or old.presets.get(id) != url:
+            result.append(f'preset_load {id} {url}')
+    for (id, symbol), value in new.params.items():
+        if id in added or old.params.get((id, symbol)) != value:
+            result.append(f'param_set {id} {symbol} {value}')
+    for id, value in sorted(new.bypass.items()):
+        if id in added or old.bypass.get(id) != value:
+            result.append(f'bypass {id} {value}')
+
+    # Removing a plugin drops its connections, so connections to re-added
+    # plugins have to be made again.
+    for src, dst in sorted(new.connections):
+        if (src, dst) not in old.connections or \
+                touches((src, dst), removed):
+            result.append(f'connect {src} {dst}')
+    return '\n'.join(result)
 
 class ModHost:
     """Proxy object for communicating with mod-host."""
@@ -9,40 +125,107 @@ class ModHost:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect(('127.0.0.1', 5555))
 
+        # Data received from mod-host beyond the end of the last response.
+        self.__buffer = b''
+
+        # Commands are sent from the midi, GPIO and morphing threads, this
+        # keeps each request paired with its response.
+        self.lock = threading.RLock()
+
     def add(self, id: int, url: str) -> None:
         """Add the plugin identified by url as instance number 'id'."""
-        self.socket.send(f'add {url} {id}\n'.encode())
-        self._read_response()
+        with self.lock:
+            self.socket.send(f'add {url} {id}\n'.encode())
+            self._read_response()
 
     def remove(self, id: int) -> None:
         """Remove the plugin identified by "id"."""
-        self.socket.send(f'remove {id}\n'.encode())
-        return self._read_response()
+        with self.lock:
+            self.socket.send(f'remove {id}\n'.encode())
+            return self._read_response()
 
     def bypass(self, id: int, bypass: bool) -> None:
         """Bypass/unbypass a given event."""
-        self.socket.send(f'bypass {id} {1 if bypass else 0}\n'.encode())
-        return self._read_response()
+        with self.lock:
+            self.socket.send(f'bypass {id} {1 if bypass else 0}\n'.encode())
+            return self._read_response()
 
     def send_block(self, block: str) -> None:
         for line in block.split('\n'):
             line = line.strip()
             if line:
                 print(f'sending: {line!r}')
-                self.socket.send(line.encode() + b'\n')
-                self._read_response()
+                with self.lock:
+                    self.socket.send(line.encode() + b'\n')
+                    self._read_response()
+
+    def send_batch(self, block: str) -> List[bytes]:
+        """Send all of the commands in 'block' in a single write.
+
+        Unlike send_block(), this doesn't wait for each response before
+        sending the next command.  Failed commands are reported.
+
+        Returns the responses, one for each command.
+        """
+        lines = [line.strip() for line in block.split('\n')]
+        lines = [line for line in lines if line]
+        if not lines:
+            return []
+        data = ''.join(line + '\n' for line in lines).encode()
+        with self.lock:
+            self.socket.sendall(data)
+            responses = [self._read_response(quiet=True) for line in lines]
+        for line, response in zip(lines, responses):
+            # Responses are "resp <status> ...", negative status is an error.
+            fields = response.rstrip(b'\x00').split()
+            if len(fields) > 1 and fields[1].startswith(b'-'):
+                print(f'mod-host error {response!r} for {line!r}')
+        return responses
 
     def param_set(self, id: int, symbol: str, value: float) -> None:
-        self.socket.send(f'param_set {id} {symbol} {value}\n'.encode())
-        self._read_response()
+        with self.lock:
+            self.socket.send(f'param_set {id} {symbol} {value}\n'.encode())
+            self._read_response()
+
+    def param_set_many(self, params: Sequence[Tuple[int, str]],
+                       values: Iterable[float]
+                       ) -> None:
+        """Set a group of parameters in a single write.
+
+        Args:
+            params: (instance id, symbol) for each parameter.
+            values: Value for each parameter.
+        """
+        data = ''.join(
+            f'param_set {id} {symbol} {value}\n'
+            for (id, symbol), value in zip(params, values)
+        ).encode()
+        with self.lock:
+            self.socket.sendall(data)
+            for i in range(len(params)):
+                self._read_response(quiet=True)
 
     def param_get(self, id: int, symbol: str) -> float:
-        self.socket.send(f'param_get {id} {symbol}\n')
-        self._read_response()
-
-    def _read_response(self) -> str:
-        response = b''
-        while not response.endswith(b'\x00'):
-            response += self.socket.recv(1024)
-        print(f'response: {response}')
+        with self.lock:
+            self.socket.send(f'param_get {id} {symbol}\n'.encode())
+
+            # The response is "resp <status> <value>".
+            response = self._read_response().rstrip(b'\x00').split()
+        if len(response) < 3 or int(response[1]) < 0:
+            raise ValueError(f'Unable to get {symbol} from instance {id}: '
+                             f'{response}')
+        return float(response[2])
+
+    def _read_response(self, quiet: bool = False) -> bytes:
+        while b'\x00' not in self.__buffer:
+            data = self.socket.recv(1024)
+            if not data:
+                # mod-host has gone away.  Under the supervisor the engine
+                # is restarted along with it.
+                raise ConnectionError('mod-host closed the connection')
+            self.__buffer += data
+        response, self.__buffer = self.__buffer.split(b'\x00', 1)
+        response += b'\x00'
+        if not quiet:
+            print(f'response: {response}')
         return response
@@ -0,0 +1,282 @@
+"""Preset index.
+
+Scans the installed rakarrack-plus banks, guitarix banks and mod pedalboards
+and keeps an index of all of the presets they define so that configs can
+refer to presets by name rather than by (bank, program) numbers.
+
+The index is stored in ~/.pidal/presets.json.  Each source file (or
+pedalboard directory) is stored with its modification time, and when the
+index is refreshed only sources that have changed are rescanned.
+"""
+
+from __future__ import annotations
+
+import attr
+import glob
+import json
+import os
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+INDEX_FILE = os.path.expanduser('~/.pidal/presets.json')
+
+# Version of the index file format.
+INDEX_VERSION = 2
+
+# Preset kinds.
+RAK = 'rak'
+GTX = 'gtx'
+PEDALBOARD = 'pedalboard'
+
+# Rakarrack-plus system banks, in midi bank order.  User banks follow these.
+RAK_SYSTEM_BANKS = ['Default.rkrb', 'Extra.rkrb', 'Extra1.rkrb']
+RAK_BANK_DIRS = ['/usr/share/rakarrack-plus',
+                 '/usr/local/share/rakarrack-plus',
+                 '~/.config/rakarrack-plus',
+                 ]
+
+# Number of presets in a rakarrack bank file.  Slot 0 is the empty preset,
+# slots 1-61 are selected by the program number of the same value.
+RAK_BANK_SIZE = 62
+
+# Size of the preset name field at the start of each rakarrack preset.
+RAK_NAME_SIZE = 64
+
+GTX_BANK_DIR = '~/.config/guitarix/banks'
+PEDALBOARD_DIR = '~/.pedalboards'
+
+@attr.s
+class Preset:
+    kind : str = attr.ib()
+    name : str = attr.ib()
+
+    # Midi bank and program number, None for pedalboards.
+    bank : Optional[int] = attr.ib(default=None)
+    program : Optional[int] = attr.ib(default=None)
+
+    # The file or directory that the preset was loaded from.
+    path : str = attr.ib(default='')
+
+def read_rak_bank(filename: str, bank: int) -> List[Preset]:
+    """Read the preset names from a rakarrack-plus bank file.
+
+    Bank files are an array of fixed-size preset records each of which
+    starts with the preset name, so we just need the name field from each
+    record.
+    """
+    with open(filename, 'rb') as src:
+        data = src.read()
+    record_size = len(data) // RAK_BANK_SIZE
+    result = []
+    for program in range(1, RAK_BANK_SIZE):
+        offset = program * record_size
+        name = data[offset:offset + RAK_NAME_SIZE].split(b'\0', 1)[0]
+        name = name.decode('latin-1').strip()
+        if name:
+            result.append(Preset(RAK, name, bank, program, filename))
+    return result
+
+def read_gtx_bank(filename: str, bank: int) -> List[Preset]:
+    """Read the preset names from a guitarix bank file.
+
+    Guitarix banks are JSON lists consisting of a version header followed by
+    alternating preset names and preset data.
+    """
+    with open(filename) as src:
+        data = json.load(src)
+    names = [item for item in data[2::2] if isinstance(item, str)]
+    return [Preset(GTX, name, bank, program, filename)
+            for program, name in enumerate(names)
+            ]
+
+def read_pedalboard(dirname: str) -> List[Preset]:
+    """Returns the preset for a mod pedalboard directory.
+
+    The name comes from the doap:name in the pedalboard's turtle files,
+    falling back to the directory name.
+    """
+    name = os.path.splitext(os.path.basename(dirname))[0]
+    for ttl in glob.glob(os.path.join(dirname, '*.ttl')):
+        with open(ttl, errors='replace') as src:
+            match = re.search(r'doap:name\s+"([^"]*)"', src.read())
+        if match:
+            name = match.group(1)
+            break
+    return [Preset(PEDALBOARD, name, path=dirname)]
+
+def _mtime(path: str) -> float:
+    """Returns the modification time of a source.
+
+    For directories this is the latest modification time of the directory
+    and the files in it, since editing a file in place doesn't touch the
+    directory.
+    """
+    result = os.stat(path).st_mtime
+    if os.path.isdir(path):
+        for entry in os.scandir(path):
+            result = max(result, entry.stat().st_mtime)
+    return result
+
+class PresetIndex:
+    """Index of all installed presets.
+
+    Lookups by (kind, name) are case insensitive.
+    """
+
+    def __init__(self, filename: str = INDEX_FILE):
+        self.filename = filename
+
+        # Mapping from source path to (mtime, bank, presets).  The bank is
+        # None for sources that aren't banks.
+        self.__sources : Dict[str, Tuple[float, Optional[int],
+                                         List[Preset]]] = {}
+
+        self.__by_name : Dict[Tuple[str, str], Preset] = {}
+
+    def __iter_sources(self) -> Iterator[Tuple[str, Optional[int],
+                                               callable]]:
+        """Generates (path, bank, reader) for all of the preset sources.
+
+        'bank' is the midi bank number of the source, None if it isn't a
+        bank.  'reader' is a function that accepts the path and returns a
+        list of presets.
+        """
+        user_banks = []
+        system_banks = {}
+        for dirname in RAK_BANK_DIRS:
+            for filename in sorted(glob.glob(
+                    os.path.join(os.path.expanduser(dirname), '*.rkrb'))):
+                base = os.path.basename(filename)
+                if base in RAK_SYSTEM_BANKS:
+                    system_banks.setdefault(base, filename)
+                else:
+                    user_banks.append(filename)
+        rak_banks = [system_banks[name] for name in RAK_SYSTEM_BANKS
+                     if name in system_banks] + user_banks
+        for bank, filename in enumerate(rak_banks):
+            yield filename, bank, \
+                lambda f, bank=bank: read_rak_bank(f, bank)
+
+        gtx_banks = sorted(glob.glob(
+            os.path.join(os.path.expanduser(GTX_BANK_DIR), '*.gx')))
+        for bank, filename in enumerate(gtx_banks):
+            yield filename, bank, \
+                lambda f, bank=bank: read_gtx_bank(f, bank)
+
+        for dirname in sorted(glob.glob(
+                os.path.join(os.path.expanduser(PEDALBOARD_DIR),
+                             '*.pedalboard'))):
+            yield dirname, None, read_pedalboard
+
+    def load(self) -> None:
+        """Load the index file, if there is one."""
+        try:
+            with open(self.filename) as src:
+                data = json.load(src)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != INDEX_VERSION:
+            return
+        self.__sources = {
+            path: (mtime, bank, [Preset(**preset) for preset in presets])
+            for path, (mtime, bank, presets) in data['sources'].items()
+        }
+        self.__rebuild_names()
+
+    def save(self) -> None:
+        """Write the index file atomically."""
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as dst:
+            json.dump({
+                'version': INDEX_VERSION,
+                'sources': {
+                    path: (mtime, bank,
+                           [attr.asdict(preset) for preset in presets]
+                           )
+                    for path, (mtime, bank, presets)
+                    in self.__sources.items()
+                }
+            }, dst)
+        os.replace(tmp, self.filename)
+
+    def refresh(self) -> bool:
+        """Rescan all sources that have changed since they were indexed.
+
+        Returns true if anything changed.
+        """
+        sources = {}
+        changed = False
+        for path, bank, reader in self.__iter_sources():
+            try:
+                mtime = _mtime(path)
+
+                # Bank numbers depend on the set of banks, so the presets
+                # can shift without the file changing.
+                old = self.__sources.get(path)
+                if old and old[0] == mtime and old[1] == bank:
+                    presets = old[2]
+                else:
+                    presets = reader(path)
+                    changed = True
+            except (OSError, ValueError) as ex:
+                print(f'Unable to read presets from {path}: {ex}')
+                continue
+            sources[path] = (mtime, bank, presets)
+
+        if set(sources) != set(self.__sources):
+            changed = True
+        self.__sources = sources
+        if changed:
+            self.__rebuild_names()
+        return changed
+
+    def __rebuild_names(self) -> None:
+        self.__by_name = {}
+        for mtime, bank, presets in self.__sources.values():
+            for preset in presets:
+                self.__by_name.setdefault((preset.kind, preset.name.lower()),
+                                          preset
+                                          )
+
+    def get(self, kind: str, name: str) -> Preset:
+        """Returns the preset of the given kind and name.
+
+        Raises KeyError if there is no such preset.
+        """
+        return self.__by_name[kind, name.lower()]
+
+    def program(self, kind: str, name: str) -> Tuple[int, int]:
+        """Returns the (bank, program) tuple for a named preset.
+
+        For use in configs, e.g.:
+
+            PRESETS = [('Fuzz', *index.program(RAK, 'Tight Rock'), 63)]
+        """
+        preset = self.get(kind, name)
+        return preset.bank, preset.program
+
+    def search(self, text: str, kind: Optional[str] = None) -> List[Preset]:
+        """Returns all presets whose names contain 'text' (case insensitive).
+        """
+        text = text.lower()
+        return sorted(
+            (preset for (k, name), preset in self.__by_name.items()
+             if text in name and (kind is None or k == kind)),
+            key=lambda preset: (preset.kind, preset.name.lower())
+        )
+
+    @classmethod
+    def get_instance(cls) -> PresetIndex:
+        """Returns the global preset index, loading and refreshing it on the
+        first call.
+        """
+        global _index
+        if not _index:
+            _index = cls()
+            _index.load()
+            if _index.refresh():
+                _index.save()
+        return _index
+
+_index : Optional[PresetIndex] = None
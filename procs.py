@@ -0,0 +1,132 @@
+"""Asynchronous management of helper processes.
+
+Starting a program like zynaddsubfx and waiting for its ports to show up
+takes seconds, and killing one means waiting for it to exit.  Neither should
+happen in a footswitch or midi callback, so this module does both in
+background threads:
+
+-   AsyncProcess.start() spawns the program in a worker thread and returns a
+    future that completes when the program is ready.
+-   reap() kills a process and waits for it in the reaper thread.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+import queue
+from subprocess import Popen
+import threading
+from typing import Callable, List, Optional
+
+# Executor for process startup.
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='procs')
+
+# Processes waiting to be killed.
+_reap_queue : queue.Queue = queue.Queue()
+
+def _reaper_thread_func() -> None:
+    while True:
+        proc = _reap_queue.get()
+        try:
+            proc.kill()
+            proc.wait()
+        except Exception as ex:
+            print(f'Error killing process {proc.pid}: {ex}')
+
+_reaper = threading.Thread(target=_reaper_thread_func)
+_reaper.setDaemon(True)
+_reaper.start()
+
+def reap(proc: Popen) -> None:
+    """Kill 'proc' and wait for it to terminate in the background."""
+    _reap_queue.put(proc)
+
+class AsyncProcess:
+    """A helper program that is started and stopped in the background.
+
+    Attributes:
+        keep_warm: If true, stop() leaves the program running so the next
+            start() is immediate.  Use terminate() to really stop it.
+    """
+
+    def __init__(self, args: List[str],
+                 wait_ready: Optional[Callable[[], None]] = None,
+                 keep_warm: bool = False
+                 ):
+        """
+        Args:
+            args: The program's command line.
+            wait_ready: Function that blocks until the program is ready
+                (e.g. waits for its jack ports), raising an exception if it
+                doesn't become ready.  Called from a worker thread.
+            keep_warm: See the class docs.
+        """
+        self.args = args
+        self.wait_ready = wait_ready
+        self.keep_warm = keep_warm
+        self.__lock = threading.Lock()
+        self.__proc : Optional[Popen] = None
+        self.__future : Optional[Future] = None
+
+        # Incremented by terminate(), so that a start that was queued before
+        # it doesn't spawn a process nobody will stop.
+        self.__generation = 0
+
+    def __start(self, generation: int) -> None:
+        with self.__lock:
+            if generation != self.__generation:
+                raise CancelledError()
+            if not self.__proc or self.__proc.poll() is not None:
+                self.__proc = Popen(self.args)
+        if self.wait_ready:
+            self.wait_ready()
+
+    def start(self) -> Future:
+        """Start the program if it isn't running.
+
+        Returns a future that completes when the program is ready (or fails
+        if it doesn't become ready, with a CancelledError if terminate() is
+        called before the program is spawned).
+        """
+        with self.__lock:
+            future = self.__future
+
+            # Start over if we've never been started, or if the last start
+            # finished and either failed or the program has since exited.
+            if future is None or future.done() and (
+                    future.exception() is not None or
+                    not self.__proc or self.__proc.poll() is not None):
+                self.__future = _executor.submit(self.__start,
+                                                 self.__generation
+                                                 )
+            return self.__future
+
+    def prespawn(self) -> Future:
+        """Start the program ahead of time and keep it running.
+
+        Equivalent to setting keep_warm and calling start().
+        """
+        self.keep_warm = True
+        return self.start()
+
+    @property
+    def ready(self) -> bool:
+        """True if the program is running and ready."""
+        future = self.__future
+        return bool(future and future.done() and not future.exception() and
+                    self.__proc and self.__proc.poll() is None)
+
+    def stop(self) -> None:
+        """Stop the program in the background, unless keep_warm is set."""
+        if not self.keep_warm:
+            self.terminate()
+
+    def terminate(self) -> None:
+        """Stop the program in the background."""
+        with self.__lock:
+            proc = self.__proc
+            self.__proc = None
+            self.__future = None
+            self.__generation += 1
+        if proc:
+            reap(proc)
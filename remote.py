@@ -0,0 +1,471 @@
+"""Remote control and telemetry API.
+
+A small HTTP and WebSocket server that runs in the engine's event loop, so
+that a tablet or laptop can drive the pedal.  It's written directly on
+asyncio streams so that it doesn't need any additional packages.
+
+HTTP endpoints (all responses are JSON):
+
+    GET  /configs               List the configs: [{"index", "name",
+                                "current"}, ...]
+    POST /configs/<index>       Select a config.
+    POST /footswitch/<index>    Press or release a virtual footswitch.  The
+                                body is {"pressed": true|false}, an empty
+                                body is a tap (press and release).
+    POST /modhost               Send the body (mod-host commands, one per
+                                line) to mod-host as a single batch.  Returns
+                                the responses.
+    POST /graph                 Compile the body (a plugin graph, see the
+                                graph module) and send it to mod-host as a
+                                single batch.  Returns the responses.
+    GET  /state                 The engine state, as stored in the snapshot.
+    GET  /metrics               The current metrics.
+    GET  /audio                 The audio measurement time series of each
+                                config (see the audiomon module).
+    GET  /boot                  The timeline of the last boot (see the boot
+                                module).
+    GET  /events                WebSocket, see below.
+
+The /events websocket streams engine events as {"topic": <name>,
+"args": [...]} and the metrics as {"topic": "metrics", "args": [{...}]}
+every METRICS_INTERVAL seconds.  Clients can also send commands over it,
+which avoids the connection setup of an HTTP request for every footswitch
+press:
+
+    {"cmd": "configs"}
+    {"cmd": "config", "index": <index>}
+    {"cmd": "footswitch", "index": <index>, "pressed": <bool, optional>}
+    {"cmd": "modhost", "commands": <commands>}
+    {"cmd": "graph", "graph": <graph>}
+    {"cmd": "state"}
+    {"cmd": "metrics"}
+    {"cmd": "audio"}
+    {"cmd": "boot"}
+
+Each command is answered with {"id": <id from the command>, "result": ...}
+or {"id": <id>, "error": <message>}.
+
+The server listens on the address in the PIDAL_REMOTE_ADDR environment
+variable (host:port), by default only on localhost.  There's no
+authentication, so only expose it on a network you trust.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import boot
+from engine import Config, Engine, CONFIG_CHANGE, CONFIG_PENDING, \
+    CONTROLLER_LEARNED, PEDAL_BUTTON_STATUS
+from graph import compile_graph, Graph
+import hashlib
+import json
+from modhost import ModHost
+import os
+import re
+import struct
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+ADDR_ENV = 'PIDAL_REMOTE_ADDR'
+DEFAULT_ADDR = '127.0.0.1:8080'
+
+# Interval between metrics messages on the websocket, in seconds.
+METRICS_INTERVAL = 1.0
+
+# Maximum size of a request body or websocket message.
+MAX_MESSAGE = 1 << 20
+
+# Maximum number of messages queued for a websocket client.  Messages for a
+# client that isn't keeping up are dropped.
+MAX_QUEUED = 256
+
+_WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Websocket opcodes.
+_WS_TEXT = 0x1
+_WS_CLOSE = 0x8
+_WS_PING = 0x9
+_WS_PONG = 0xA
+
+_STATUS_TEXT = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+class HttpError(Exception):
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+def _jsonable(value: Any) -> Any:
+    """Convert event arguments to something json can serialize."""
+    if isinstance(value, Config):
+        return value.name
+    elif isinstance(value, (list, tuple)):
+        return [_jsonable(item) for item in value]
+    elif isinstance(value, dict):
+        return {str(key): _jsonable(item) for key, item in value.items()}
+    elif value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    else:
+        return str(value)
+
+def parse_address(addr: str) -> Tuple[str, int]:
+    host, _, port = addr.rpartition(':')
+    return host, int(port)
+
+class RemoteServer:
+    """The remote API server.
+
+    Attributes:
+        metrics: Mapping from name to a function returning the current value
+            of a metric.  Add entries to publish additional metrics.
+    """
+
+    def __init__(self, engine: Engine, mod_host: Optional[ModHost] = None,
+                 addr: Optional[str] = None
+                 ):
+        """
+        Args:
+            engine: The engine.
+            mod_host: The mod-host connection, needed for the mod-host
+                commands.
+            addr: Address to listen on (host:port), defaults to the value of
+                the PIDAL_REMOTE_ADDR environment variable or DEFAULT_ADDR.
+        """
+        self.engine = engine
+        self.mod_host = mod_host
+        self.addr = addr or os.environ.get(ADDR_ENV, DEFAULT_ADDR)
+        self.metrics : Dict[str, Callable[[], Any]] = {
+            'gestures': engine.gestures.latency_stats,
+            'audio': engine.audio.get_metrics,
+            'buffer_sizes': engine.buffer_sizes.get_metrics,
+            'levels': engine.levels.get_metrics,
+            'boot': boot.get_totals,
+            'extensions': engine.extensions.get_metrics,
+            'midi_devices': engine.devices.get_metrics,
+        }
+        self.__loop : Optional[asyncio.AbstractEventLoop] = None
+        self.__clients : Set[asyncio.Queue] = set()
+
+        # HTTP routes: (method, path regex, function returning the command).
+        self.__routes : List[Tuple[str, re.Pattern, Callable]] = [
+            ('GET', re.compile(r'/configs'),
+             lambda m, body: {'cmd': 'configs'}),
+            ('POST', re.compile(r'/configs/(\d+)'),
+             lambda m, body: {'cmd': 'config', 'index': int(m.group(1))}),
+            ('POST', re.compile(r'/footswitch/(\d+)'),
+             lambda m, body: dict(json.loads(body) if body else {},
+                                  cmd='footswitch',
+                                  index=int(m.group(1))
+                                  )
+             ),
+            ('POST', re.compile(r'/modhost'),
+             lambda m, body: {'cmd': 'modhost', 'commands': body.decode()}),
+            ('POST', re.compile(r'/graph'),
+             lambda m, body: {'cmd': 'graph', 'graph': json.loads(body)}),
+            ('GET', re.compile(r'/state'), lambda m, body: {'cmd': 'state'}),
+            ('GET', re.compile(r'/metrics'),
+             lambda m, body: {'cmd': 'metrics'}),
+            ('GET', re.compile(r'/audio'), lambda m, body: {'cmd': 'audio'}),
+            ('GET', re.compile(r'/boot'), lambda m, body: {'cmd': 'boot'}),
+        ]
+
+    async def start(self) -> None:
+        """Start serving.  Must be run in the engine's event loop (see
+        Engine.run_coroutine()).
+        """
+        self.__loop = asyncio.get_running_loop()
+        for topic in (CONFIG_CHANGE, PEDAL_BUTTON_STATUS, CONFIG_PENDING,
+                      CONTROLLER_LEARNED):
+            topic.subscribe(
+                lambda *args, name=topic.name: self.__broadcast(name, args)
+            )
+        host, port = parse_address(self.addr)
+        try:
+            await asyncio.start_server(self.__handle_connection, host, port)
+        except OSError as ex:
+            print(f'Unable to start remote API on {self.addr}: {ex}')
+            return
+        print(f'remote API listening on {self.addr}')
+        self.__loop.create_task(self.__metrics_loop())
+
+    def get_metrics(self) -> Dict[str, Any]:
+        result = {}
+        for name, func in self.metrics.items():
+            try:
+                result[name] = _jsonable(func())
+            except Exception as ex:
+                result[name] = {'error': str(ex)}
+        return result
+
+    # Event streaming.
+
+    def __broadcast(self, topic: str, args: tuple) -> None:
+        """Send an event to all websocket clients.  May be called from any
+        thread.
+        """
+        if not self.__clients:
+            return
+        message = json.dumps({'topic': topic, 'args': _jsonable(args)})
+        self.__loop.call_soon_threadsafe(self.__queue_message, message)
+
+    def __queue_message(self, message: str) -> None:
+        for queue in self.__clients:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                pass
+
+    async def __metrics_loop(self) -> None:
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            if self.__clients:
+                metrics = await self.__loop.run_in_executor(
+                    None, self.get_metrics
+                )
+                self.__queue_message(
+                    json.dumps({'topic': 'metrics', 'args': [metrics]})
+                )
+
+    # Commands.
+
+    def __command(self, cmd: Dict[str, Any]) -> Any:
+        """Execute a command.  Runs in an executor thread, since most of
+        these block.
+        """
+        name = cmd.get('cmd')
+        engine = self.engine
+        if name == 'configs':
+            return [{'index': i, 'name': config.name,
+                     'current': config is engine.cur_config
+                     }
+                    for i, config in enumerate(engine.get_all_configs())
+                    ]
+        elif name == 'config':
+            configs = engine.get_all_configs()
+            index = int(cmd['index'])
+            if not 0 <= index < len(configs):
+                raise HttpError(404, f'No config {index}')
+            engine.set_config(configs[index])
+            return configs[index].name
+        elif name == 'footswitch':
+            index = int(cmd['index'])
+            if not 0 <= index < engine.switches.size:
+                raise HttpError(404, f'No footswitch {index}')
+            pressed = cmd.get('pressed')
+            if pressed is None:
+                engine.emulate_footswitch(index, True)
+                engine.emulate_footswitch(index, False)
+            else:
+                engine.emulate_footswitch(index, bool(pressed))
+            return None
+        elif name in ('modhost', 'graph'):
+            if not self.mod_host:
+                raise HttpError(503, 'No mod-host connection')
+            if name == 'graph':
+                try:
+                    commands = compile_graph(Graph.from_json(cmd['graph']))
+                except (KeyError, TypeError, ValueError) as ex:
+                    raise HttpError(400, f'Invalid graph: {ex}')
+            else:
+                commands = cmd['commands']
+            return [response.rstrip(b'\0').decode(errors='replace')
+                    for response in self.mod_host.send_batch(commands)
+                    ]
+        elif name == 'state':
+            return _jsonable(engine.get_snapshot())
+        elif name == 'metrics':
+            return self.get_metrics()
+        elif name == 'audio':
+            return engine.audio.get_series()
+        elif name == 'boot':
+            return boot.get_metrics()
+        else:
+            raise HttpError(404, f'Unknown command {name!r}')
+
+    async def __run_command(self, cmd: Dict[str, Any]) -> Any:
+        return await self.__loop.run_in_executor(None, self.__command, cmd)
+
+    # HTTP.
+
+    async def __handle_connection(self, reader: asyncio.StreamReader,
+                                  writer: asyncio.StreamWriter
+                                  ) -> None:
+        try:
+            await self.__handle_request(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as ex:
+            print(f'Error in remote API connection: {ex}')
+        finally:
+            writer.close()
+
+    async def __handle_request(self, reader: asyncio.StreamReader,
+                               writer: asyncio.StreamWriter
+                               ) -> None:
+        status = 200
+        try:
+            request_line = (await reader.readline()).decode('latin-1')
+            parts = request_line.split()
+            if len(parts) != 3:
+                raise HttpError(400, 'Bad request line')
+            method, path, version = parts
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            if path == '/events':
+                if headers.get('upgrade', '').lower() != 'websocket':
+                    raise HttpError(400, 'Expected a websocket upgrade')
+                await self.__websocket(reader, writer, headers)
+                return
+
+            length = int(headers.get('content-length', 0))
+            if length > MAX_MESSAGE:
+                raise HttpError(413, 'Request body too large')
+            body = await reader.readexactly(length) if length else b''
+
+            for route_method, pattern, make_command in self.__routes:
+                match = pattern.fullmatch(path)
+                if match:
+                    if method != route_method:
+                        raise HttpError(405, f'{method} not allowed')
+                    result = await self.__run_command(
+                        make_command(match, body)
+                    )
+                    break
+            else:
+                raise HttpError(404, f'{path} not found')
+        except HttpError as ex:
+            status, result = ex.status, {'error': str(ex)}
+        except (KeyError, ValueError, TypeError) as ex:
+            status, result = 400, {'error': str(ex)}
+        except Exception as ex:
+            # Errors from the engine (e.g. a dead mod-host connection)
+            # still get a response.
+            print(f'Error in remote API request: {ex}')
+            status, result = 500, {'error': str(ex)}
+
+        data = json.dumps(result).encode()
+        writer.write(
+            f'HTTP/1.1 {status} {_STATUS_TEXT.get(status, "")}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(data)}\r\n'
+            f'Connection: close\r\n\r\n'.encode() + data
+        )
+        await writer.drain()
+
+    # WebSocket.
+
+    async def __websocket(self, reader: asyncio.StreamReader,
+                          writer: asyncio.StreamWriter,
+                          headers: Dict[str, str]
+                          ) -> None:
+        key = headers.get('sec-websocket-key')
+        if not key:
+            raise HttpError(400, 'No websocket key')
+        accept = base64.b64encode(
+            hashlib.sha1((key + _WS_GUID).encode()).digest()
+        ).decode()
+        writer.write(
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Accept: {accept}\r\n\r\n'.encode()
+        )
+        await writer.drain()
+
+        queue : asyncio.Queue = asyncio.Queue(MAX_QUEUED)
+        self.__clients.add(queue)
+        sender = self.__loop.create_task(self.__ws_sender(writer, queue))
+        try:
+            while True:
+                opcode, payload = await self.__ws_read_frame(reader)
+                if opcode == _WS_CLOSE:
+                    _ws_write_frame(writer, _WS_CLOSE, payload[:2])
+                    break
+                elif opcode == _WS_PING:
+                    _ws_write_frame(writer, _WS_PONG, payload)
+                elif opcode == _WS_TEXT:
+                    reply = await self.__ws_command(payload)
+                    try:
+                        queue.put_nowait(json.dumps(reply))
+                    except asyncio.QueueFull:
+                        pass
+        finally:
+            self.__clients.discard(queue)
+            sender.cancel()
+
+    async def __ws_command(self, payload: bytes) -> Dict[str, Any]:
+        cmd = {}
+        try:
+            cmd = json.loads(payload)
+            return {'id': cmd.get('id'),
+                    'result': await self.__run_command(cmd)
+                    }
+        except Exception as ex:
+            return {'id': cmd.get('id') if isinstance(cmd, dict) else None,
+                    'error': str(ex)
+                    }
+
+    async def __ws_sender(self, writer: asyncio.StreamWriter,
+                          queue: asyncio.Queue
+                          ) -> None:
+        while True:
+            message = await queue.get()
+            _ws_write_frame(writer, _WS_TEXT, message.encode())
+            await writer.drain()
+
+    async def __ws_read_frame(self, reader: asyncio.StreamReader
+                              ) -> Tuple[int, bytes]:
+        """Read a complete (possibly fragmented) message.
+
+        Returns (opcode, payload).
+        """
+        opcode = None
+        payload = b''
+        while True:
+            b0, b1 = await reader.readexactly(2)
+            length = b1 & 0x7f
+            if length == 126:
+                length, = struct.unpack('!H', await reader.readexactly(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', await reader.readexactly(8))
+            if len(payload) + length > MAX_MESSAGE:
+                raise HttpError(413, 'Websocket message too large')
+            mask = await reader.readexactly(4) if b1 & 0x80 else None
+            data = await reader.readexactly(length)
+            if mask:
+                data = bytes(byte ^ mask[i & 3] for i, byte in enumerate(data))
+
+            frame_opcode = b0 & 0x0f
+            if frame_opcode >= 0x8:
+                # Control frames can be interleaved with fragments.
+                return frame_opcode, data
+            if opcode is None:
+                opcode = frame_opcode
+            payload += data
+            if b0 & 0x80:
+                return opcode, payload
+
+def _ws_write_frame(writer: asyncio.StreamWriter, opcode: int, data: bytes
+                    ) -> None:
+    length = len(data)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    writer.write(header + data)
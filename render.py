@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+"""Offline rendering of pedalboards through mod-host.
+
+Renders a WAV file through the plugin graph of each of a set of .modcfg
+files, with JACK in freewheel mode, so the rendering runs as fast as the
+plugins allow rather than in realtime:
+
+    python3 render.py [-b <blocksize>] [-t <tail seconds>] [-o <dir>] \\
+        input.wav config.modcfg...
+
+The render client stands in for the sound card: connections from
+system:capture_<n> in the config's on_enter block are made from the
+client's out_<n> ports instead, and connections to system:playback_<n> go
+to its in_<n> ports.  The input file is streamed in periods from a reader
+thread, and the output is checksummed (and written to <dir>, if given) by
+a writer thread, so long files don't have to fit in memory.  In freewheel
+mode JACK doesn't time out the process callback, so it simply waits for
+the reader.
+
+For each config this reports the time taken, the speed relative to
+realtime, the CPU time used by mod-host per second of audio (the DSP cost
+of the pedalboard) and a checksum of the output.  Plugins with free-running
+modulation (chorus LFOs and the like) won't necessarily give the same
+checksum twice.
+
+This needs jackd and mod-host running but not the engine, which would be
+sending mod-host commands of its own.
+"""
+
+from __future__ import annotations
+
+import getopt
+import hashlib
+import jack
+from modcfg import read_modcfg
+from modhost import ModHost
+import numpy as np
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from typing import Iterator, Optional, Tuple
+import wave
+
+CLIENT_NAME = 'pidal-render'
+
+# Number of source and sink ports.
+CHANNELS = 2
+
+# Periods buffered between the reader/writer threads and the process
+# callback.
+QUEUE_PERIODS = 256
+
+# Seconds of silence rendered after the input, to catch reverb tails and
+# plugin latency.
+DEFAULT_TAIL = 1.0
+
+def read_wav(filename: str, chunk: int) -> Iterator[np.ndarray]:
+    """Yields the frames of a PCM WAV file as (channels, frames) float32
+    arrays of 'chunk' frames.  The last array is padded with silence.
+    """
+    with wave.open(filename) as src:
+        channels = src.getnchannels()
+        width = src.getsampwidth()
+        while True:
+            data = src.readframes(chunk)
+            if not data:
+                return
+            if width == 3:
+                # 24 bit, widen to 32.
+                raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+                samples = (raw[:, 0].astype(np.int32) << 8 |
+                           raw[:, 1].astype(np.int32) << 16 |
+                           raw[:, 2].astype(np.int32) << 24
+                           )
+                scale = 2.0 ** 31
+            elif width == 1:
+                samples = np.frombuffer(data, dtype=np.uint8).astype(
+                    np.int32
+                ) - 128
+                scale = 128.0
+            else:
+                samples = np.frombuffer(data, dtype=f'<i{width}')
+                scale = 2.0 ** (8 * width - 1)
+            frames = (samples.astype(np.float32) / scale).reshape(
+                -1, channels
+            ).T
+            if frames.shape[1] < chunk:
+                frames = np.pad(frames,
+                                ((0, 0), (0, chunk - frames.shape[1]))
+                                )
+            yield frames
+
+def wav_info(filename: str) -> Tuple[int, int]:
+    """Returns (sample rate, frames) of a WAV file."""
+    with wave.open(filename) as src:
+        return src.getframerate(), src.getnframes()
+
+def _cpu_time(pid: int) -> float:
+    """Returns the CPU time (user + system) used by process 'pid'."""
+    with open(f'/proc/{pid}/stat') as src:
+        fields = src.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def _find_mod_host() -> Optional[int]:
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/comm') as src:
+                    if src.read().strip() == 'mod-host':
+                        return int(entry)
+            except OSError:
+                pass
+    return None
+
+def reroute(block: str) -> str:
+    """Returns 'block' with the sound card ports replaced by the render
+    client's.
+    """
+    block = re.sub(r'\bsystem:capture_(\d+)', CLIENT_NAME + r':out_\1',
+                   block
+                   )
+    return re.sub(r'\bsystem:playback_(\d+)', CLIENT_NAME + r':in_\1', block)
+
+class Renderer:
+    """Renders audio through whatever is connected to its client."""
+
+    def __init__(self, blocksize: Optional[int] = None):
+        self.client = jack.Client(CLIENT_NAME)
+
+        # The buffer size is server wide, so it's put back by close().
+        self.__prev_blocksize : Optional[int] = None
+        if blocksize and blocksize != self.client.blocksize:
+            self.__prev_blocksize = self.client.blocksize
+            self.client.blocksize = blocksize
+        self.sources = [self.client.outports.register(f'out_{i + 1}')
+                        for i in range(CHANNELS)
+                        ]
+        self.sinks = [self.client.inports.register(f'in_{i + 1}')
+                      for i in range(CHANNELS)
+                      ]
+        self.__input : queue.Queue = queue.Queue(QUEUE_PERIODS)
+        self.__output : queue.Queue = queue.Queue(QUEUE_PERIODS)
+        # Set while not rendering, so that the callback doesn't wait for
+        # input outside of freewheel mode.
+        self.__done = threading.Event()
+        self.__done.set()
+        self.client.set_process_callback(self.__process)
+        self.client.activate()
+
+    def __process(self, frames: int) -> None:
+        if self.__done.is_set():
+            for port in self.sources:
+                port.get_array().fill(0)
+            return
+        chunk = self.__input.get()
+        if chunk is None:
+            self.__done.set()
+            self.__output.put(None)
+            for port in self.sources:
+                port.get_array().fill(0)
+            return
+        for i, port in enumerate(self.sources):
+            port.get_array()[:] = chunk[i % len(chunk)]
+        self.__output.put(np.stack([port.get_array()
+                                    for port in self.sinks
+                                    ]))
+
+    def render(self, filename: str, tail: float,
+               output: Optional[str] = None
+               ) -> Tuple[int, str, float]:
+        """Render 'filename'.
+
+        Args:
+            filename: Input WAV file.
+            tail: Seconds of silence to render after the input.
+            output: If provided, the output is written to this file (16
+                bit stereo WAV).
+
+        Returns (frames rendered, sha256 of the float32 output, peak level).
+        """
+        blocksize = self.client.blocksize
+        samplerate = self.client.samplerate
+
+        def reader():
+            for chunk in read_wav(filename, blocksize):
+                self.__input.put(chunk)
+            silence = np.zeros((1, blocksize), dtype=np.float32)
+            for i in range(int(tail * samplerate / blocksize) + 1):
+                self.__input.put(silence)
+            self.__input.put(None)
+
+        digest = hashlib.sha256()
+        frames = 0
+        peak = 0.0
+        dst = None
+        if output:
+            dst = wave.open(output, 'wb')
+            dst.setnchannels(CHANNELS)
+            dst.setsampwidth(2)
+            dst.setframerate(samplerate)
+
+        reader_thread = threading.Thread(target=reader)
+        reader_thread.setDaemon(True)
+        reader_thread.start()
+        self.client.set_freewheel(True)
+        self.__done.clear()
+        try:
+            while True:
+                chunk = self.__output.get()
+                if chunk is None:
+                    break
+                digest.update(chunk.tobytes())
+                frames += chunk.shape[1]
+                peak = max(peak, float(np.max(np.abs(chunk))))
+                if dst:
+                    dst.writeframes(
+                        (np.clip(chunk.T, -1, 1) * 32767).astype('<i2')
+                        .tobytes()
+                    )
+        finally:
+            self.__done.set()
+            self.client.set_freewheel(False)
+            if dst:
+                dst.close()
+        reader_thread.join()
+        return frames, digest.hexdigest(), peak
+
+    def close(self) -> None:
+        self.client.deactivate()
+        if self.__prev_blocksize:
+            try:
+                self.client.blocksize = self.__prev_blocksize
+            except jack.JackError as ex:
+                print(f'Unable to restore the buffer size to '
+                      f'{self.__prev_blocksize}: {ex}')
+        self.client.close()
+
+def main(args) -> int:
+    opts, args = getopt.getopt(args, 'b:t:o:')
+    opts = dict(opts)
+    if len(args) < 2:
+        print(__doc__)
+        return 1
+    input, configs = args[0], args[1:]
+    tail = float(opts.get('-t', DEFAULT_TAIL))
+    out_dir = opts.get('-o')
+
+    renderer = Renderer(int(opts['-b']) if '-b' in opts else None)
+    try:
+        rate, input_frames = wav_info(input)
+        if rate != renderer.client.samplerate:
+            print(f'Warning: {input} is {rate}Hz, JACK is running at '
+                  f'{renderer.client.samplerate}Hz')
+        mod_host = ModHost()
+        mod_host_pid = _find_mod_host()
+        print(f'{input}: {input_frames / rate:.1f}s, '
+              f'blocksize {renderer.client.blocksize}')
+        print(f'{"config":30} {"time":>7} {"speed":>7} {"cpu/s":>7} '
+              f'{"peak":>6}  checksum')
+        for filename in configs:
+            cfg = read_modcfg(filename)
+            name = cfg.name or os.path.basename(filename)
+            mod_host.send_batch('remove -1')
+            mod_host.send_batch(reroute(cfg.on_enter or ''))
+            output = None
+            if out_dir:
+                output = os.path.join(
+                    out_dir,
+                    os.path.splitext(os.path.basename(filename))[0] + '.wav'
+                )
+
+            cpu = _cpu_time(mod_host_pid) if mod_host_pid else 0.0
+            start = time.time()
+            frames, checksum, peak = renderer.render(input, tail, output)
+            elapsed = time.time() - start
+            cpu = _cpu_time(mod_host_pid) - cpu if mod_host_pid else 0.0
+
+            seconds = frames / renderer.client.samplerate
+            mod_host.send_batch(reroute(cfg.on_leave or 'remove -1'))
+            print(f'{name[:30]:30} {elapsed:6.2f}s {seconds / elapsed:6.1f}x '
+                  f'{cpu / seconds:7.3f} {peak:6.3f}  {checksum[:16]}')
+    finally:
+        renderer.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
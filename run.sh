@@ -4,9 +4,11 @@ if [ -z "$DISPLAY" ]; then
     export DISPLAY=:0
 fi
 
-# Number of jack periods (frames between process calls) to use.
+# Number of jack periods (frames between process calls) to start with.
 # 128 would be better, but that doesn't work well with multiple effects on
-# mod-host.
+# mod-host.  The engine switches to each config's own buffer size when it is
+# selected (see bufsize.py), this is just the startup size and the initial
+# target for new configs.
 export PERIODS=256
 
 # Wait for the xserver to come up.
@@ -49,9 +51,13 @@ fi
 
 echo "jack pid is $jack_pid"
 while true; do
-    python3 main.py
-    echo "killing $jack_pid"
-    kill -9 $jack_pid
-    sleep 1
-    start_jack
+    # The supervisor runs the engine and the audio programs, restarting them
+    # individually if they exit.  It only returns if jackd goes away, or if
+    # it is killed.
+    JACK_PID=$jack_pid python3 supervisor.py
+    if ! kill -0 $jack_pid 2>/dev/null; then
+        echo "restarting jack"
+        sleep 1
+        start_jack
+    fi
 done
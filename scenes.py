@@ -0,0 +1,170 @@
+"""Scenes and scene morphing for mod-host configs.
+
+A scene is a set of plugin parameter values.  Rather than switching scenes
+with a hard cut, the Morpher interpolates from the current parameter values
+to those of the new scene over a period of time, sending batches of
+param_set commands to mod-host at a bounded rate.
+
+All of the scenes of a config share a single parameter index (see
+SceneSet), so a scene is just an array of values and interpolation is done
+over whole arrays.
+"""
+
+from __future__ import annotations
+
+from modhost import ModHost
+import numpy as np
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Parameter key: (mod-host instance id, parameter symbol).
+ParamKey = Tuple[int, str]
+
+class SceneSet:
+    """The scenes of a config.
+
+    Attributes:
+        params: List of parameter keys, the index of a key in this list is
+            its index in all of the value arrays.
+        base: Parameter values when the config is entered.  NaN for
+            parameters that are not set on entry.
+        scenes: Mapping from scene name to value array.
+    """
+
+    def __init__(self, base: Dict[ParamKey, float],
+                 scenes: Dict[str, Dict[ParamKey, float]]
+                 ):
+        keys = set(base)
+        for values in scenes.values():
+            keys.update(values)
+        self.params : List[ParamKey] = sorted(keys)
+        self.index = {key: i for i, key in enumerate(self.params)}
+        self.base = self.__make_array(base, np.full(len(self.params), np.nan))
+        self.scenes = {name: self.__make_array(values, self.base.copy())
+                       for name, values in scenes.items()
+                       }
+
+    def __make_array(self, values: Dict[ParamKey, float],
+                     result: np.ndarray
+                     ) -> np.ndarray:
+        for key, value in values.items():
+            result[self.index[key]] = value
+        return result
+
+class Morpher:
+    """Interpolates parameter values between scenes.
+
+    Morphing is done in a daemon thread.  At each step we compute the
+    interpolated values for all parameters, then send only those that have
+    moved by more than 'threshold' since they were last sent.  Steps are
+    limited to 'max_rate' per second so a long parameter list doesn't flood
+    mod-host.
+    """
+
+    def __init__(self, mod_host: ModHost, max_rate: float = 30.0,
+                 threshold: float = 1e-3
+                 ):
+        self.mod_host = mod_host
+        self.interval = 1.0 / max_rate
+        self.threshold = threshold
+
+        self.__params : List[ParamKey] = []
+        self.__index : Dict[ParamKey, int] = {}
+        self.__sent = np.zeros(0)
+        self.__start = np.zeros(0)
+        self.__target : Optional[np.ndarray] = None
+        self.__start_time = 0.0
+        self.__duration = 0.0
+        self.__cond = threading.Condition()
+
+        thread = threading.Thread(target=self.__run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def reset(self, params: List[ParamKey], values: np.ndarray) -> None:
+        """Reset the morpher for a new set of parameters.
+
+        Args:
+            params: Parameter keys.
+            values: The current values of the parameters on mod-host (NaN
+                if unknown).
+        """
+        with self.__cond:
+            self.__params = params
+            self.__index = {key: i for i, key in enumerate(params)}
+            self.__sent = values.copy()
+            self.__target = None
+
+    def update_sent(self, params: Sequence[ParamKey],
+                    values: Sequence[float]
+                    ) -> None:
+        """Record parameter values that were sent to mod-host by someone
+        else (e.g. an expression pedal), so that the next transition starts
+        from them.  Parameters that aren't morphed are ignored.
+        """
+        with self.__cond:
+            for key, value in zip(params, values):
+                index = self.__index.get(key)
+                if index is not None:
+                    self.__sent[index] = value
+
+    def stop(self) -> None:
+        """Stop the current transition, if any."""
+        with self.__cond:
+            self.__target = None
+
+    def morph(self, target: np.ndarray, duration: float) -> None:
+        """Start a transition to 'target' over 'duration' seconds.
+
+        If a transition is already in progress, the new one starts from the
+        values most recently sent.
+        """
+        with self.__cond:
+            # Parameters we don't know the current value of just jump to the
+            # target value.
+            self.__start = np.where(np.isnan(self.__sent), target,
+                                    self.__sent
+                                    )
+            self.__target = target
+            self.__start_time = time.time()
+            self.__duration = duration
+            self.__cond.notify()
+
+    def __step(self) -> bool:
+        """Do one interpolation step.
+
+        Must be called with the condition locked.  Returns true if the
+        transition is complete.
+        """
+        if self.__duration > 0:
+            t = min(1.0, (time.time() - self.__start_time) / self.__duration)
+        else:
+            t = 1.0
+        values = self.__start + (self.__target - self.__start) * t
+
+        # On the last step, send everything that isn't exactly on target.
+        # Values that we haven't sent yet (NaN in __sent) always go out,
+        # parameters with no value in the target (NaN in values) never do.
+        delta = np.abs(values - self.__sent)
+        np.copyto(delta, np.inf, where=np.isnan(self.__sent))
+        np.copyto(delta, 0.0, where=np.isnan(values))
+        changed = np.flatnonzero(
+            delta > (self.threshold if t < 1.0 else 0.0)
+        )
+        if len(changed):
+            params = self.__params
+            self.mod_host.param_set_many([params[i] for i in changed],
+                                         values[changed]
+                                         )
+            self.__sent[changed] = values[changed]
+        return t >= 1.0
+
+    def __run(self) -> None:
+        while True:
+            with self.__cond:
+                while self.__target is None:
+                    self.__cond.wait()
+                if self.__step():
+                    self.__target = None
+            time.sleep(self.interval)
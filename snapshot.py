@@ -0,0 +1,89 @@
+"""Persistent engine state.
+
+The engine state (current config, the state of each config's buttons,
+controller values and UI selections) is written to a small JSON file so that
+the pedal comes back up sounding the way it did when it went down.
+
+Writes are throttled: marking the state as dirty schedules a write no
+sooner than 'min_interval' seconds after the last one, so a stream of
+controller changes results in at most one write per interval.  Files are
+written atomically (write to a temporary file, then rename) so a power cut
+during a write leaves the previous snapshot intact.
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+STATE_FILE = os.path.expanduser('~/.pidal/state.json')
+
+def write_atomically(filename: str, data: Any) -> None:
+    """Write 'data' as JSON to 'filename' atomically."""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as dst:
+        json.dump(data, dst)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp, filename)
+
+def read_snapshot(filename: str = STATE_FILE) -> Optional[Dict[str, Any]]:
+    """Returns the stored snapshot, None if there isn't a readable one."""
+    try:
+        with open(filename) as src:
+            return json.load(src)
+    except (OSError, ValueError) as ex:
+        print(f'No engine state restored: {ex}')
+        return None
+
+class SnapshotWriter:
+    """Writes snapshots of the engine state at a throttled rate."""
+
+    def __init__(self, get_state: Callable[[], Dict[str, Any]],
+                 filename: str = STATE_FILE,
+                 min_interval: float = 2.0
+                 ):
+        """
+        Args:
+            get_state: Function returning the state to be written.  Called
+                from the writer's timer thread.
+            filename: File to write the state to.
+            min_interval: Minimum time between writes, in seconds.
+        """
+        self.get_state = get_state
+        self.filename = filename
+        self.min_interval = min_interval
+        self.__lock = threading.Lock()
+        self.__timer : Optional[threading.Timer] = None
+        self.__last_write = 0.0
+        atexit.register(self.flush)
+
+    def mark_dirty(self) -> None:
+        """Schedule a write of the current state."""
+        with self.__lock:
+            if self.__timer:
+                return
+            delay = max(0.0,
+                        self.__last_write + self.min_interval - time.time()
+                        )
+            self.__timer = threading.Timer(delay, self.flush)
+            self.__timer.setDaemon(True)
+            self.__timer.start()
+
+    def flush(self) -> None:
+        """Write the state now if a write is pending."""
+        with self.__lock:
+            if not self.__timer:
+                return
+            self.__timer.cancel()
+            self.__timer = None
+            self.__last_write = time.time()
+        try:
+            write_atomically(self.filename, self.get_state())
+        except Exception as ex:
+            print(f'Error writing engine state: {ex}')
@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+"""Process supervisor for the pidal.
+
+Runs the audio programs (guitarix, mod-host, a2jmidid) and the engine
+(main.py) as separate children so that the engine can be restarted without
+restarting the audio programs: a restarted engine just reattaches to them.
+Children that exit are restarted individually, with an exponential backoff
+for children that keep crashing.
+
+If a program is already running when the supervisor starts (e.g. because
+the supervisor itself was restarted) we adopt it rather than starting a
+second copy.
+
+An audio program that is restarted has lost its JACK connections (and
+mod-host its plugins), so the engine is restarted along with it to set
+everything up again.
+
+The supervisor exits when jackd (identified by the JACK_PID environment
+variable) goes away, since everything needs to be restarted in that case.
+"""
+
+from __future__ import annotations
+
+import os
+import signal
+from subprocess import Popen
+import sys
+import time
+from typing import List, Optional
+
+# Environment variable that tells the engine that it is being supervised,
+# in which case it doesn't start (or kill) the audio programs itself.
+SUPERVISED_ENV = 'PIDAL_SUPERVISED'
+
+# Backoff parameters, in seconds.
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 30.0
+
+# A child that has run this long is considered healthy and its backoff is
+# reset.
+STABLE_TIME = 60.0
+
+POLL_INTERVAL = 0.5
+
+def find_process(args: List[str]) -> Optional[int]:
+    """Returns the pid of a running process with the given command line.
+
+    Only the program name and arguments are compared, not the path of the
+    program.
+    """
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/cmdline', 'rb') as src:
+                cmdline = src.read().split(b'\0')[:-1]
+        except OSError:
+            continue
+        if cmdline and \
+                [os.path.basename(cmdline[0]).decode()] + \
+                [arg.decode(errors='replace') for arg in cmdline[1:]] == \
+                [os.path.basename(args[0])] + args[1:]:
+            return int(entry)
+    return None
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+class Child:
+    """A supervised process."""
+
+    def __init__(self, name: str, args: List[str], adopt: bool = True):
+        """
+        Args:
+            name: Name for log messages.
+            args: Command line.
+            adopt: If true, adopt an already running process with the same
+                command line rather than starting a new one.
+        """
+        self.name = name
+        self.args = args
+        self.adopt = adopt
+        self.proc : Optional[Popen] = None
+        self.pid : Optional[int] = None
+        self.start_time = 0.0
+        self.backoff = MIN_BACKOFF
+        self.next_start = 0.0
+
+    def start(self) -> None:
+        pid = find_process(self.args) if self.adopt else None
+        if pid:
+            print(f'supervisor: adopting {self.name} (pid {pid})')
+            self.proc = None
+            self.pid = pid
+        else:
+            print(f'supervisor: starting {self.name}')
+            self.proc = Popen(self.args)
+            self.pid = self.proc.pid
+        self.start_time = time.time()
+
+    def running(self) -> bool:
+        """Returns true if the child is running."""
+        if self.pid is None:
+            return False
+        if self.proc:
+            return self.proc.poll() is None
+        return pid_alive(self.pid)
+
+    def poll(self) -> bool:
+        """Check the child, restarting it if necessary.
+
+        Returns true if the child was restarted.
+        """
+        if self.running():
+            return False
+
+        now = time.time()
+        if self.pid is not None:
+            # The child has just exited.  Schedule a restart.  A clean exit
+            # from the engine is a "restart shell" so do it immediately.
+            status = self.proc.returncode if self.proc else None
+            print(f'supervisor: {self.name} exited with status {status}')
+            if now - self.start_time > STABLE_TIME:
+                self.backoff = MIN_BACKOFF
+            if status == 0:
+                self.next_start = now
+            else:
+                self.next_start = now + self.backoff
+                self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+            self.pid = self.proc = None
+
+        if now >= self.next_start:
+            restarted = self.start_time != 0.0
+            self.start()
+            return restarted
+        return False
+
+    def stop(self) -> None:
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+
+    def restart(self) -> None:
+        """Stop the child and start it again on the next poll, without any
+        backoff.
+        """
+        if not self.running():
+            return
+        print(f'supervisor: restarting {self.name}')
+        self.stop()
+        self.pid = self.proc = None
+        self.next_start = time.time()
+
+def main() -> None:
+    jack_pid = int(os.environ.get('JACK_PID', '0')) or None
+
+    # The audio programs are left running if we exit (unless it's because
+    # jackd went away) so they can be adopted by the next supervisor.
+    audio = [
+        Child('guitarix', ['guitarix', '-N']),
+        Child('mod-host', ['mod-host', '-n']),
+        Child('a2jmidid', ['a2jmidid', '-eu']),
+    ]
+    engine = Child('engine', [sys.executable, 'main.py'], adopt=False)
+    os.environ[SUPERVISED_ENV] = '1'
+
+    def shutdown(signum, frame):
+        engine.stop()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    while True:
+        if jack_pid and not pid_alive(jack_pid):
+            print('supervisor: jackd has gone away')
+            engine.stop()
+            for child in audio:
+                child.stop()
+            return
+        restarted = [child.name for child in audio if child.poll()]
+        if restarted:
+            print(f'supervisor: {", ".join(restarted)} restarted')
+            engine.restart()
+        engine.poll()
+        time.sleep(POLL_INTERVAL)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""The switch matrix.
+
+All of the switches that the engine knows about (the footswitches and
+microswitches on the GPIO pins, switches on midi controllers, keys on a
+keyboard) are numbered in a single index space.  Each device gets a
+contiguous block of indices when it is added to the matrix, the built-in
+footswitches being device 0 so they keep indices 0-3.
+
+Per-switch state is kept in flat arrays and a bitmask of the pressed
+switches rather than in per-switch objects, so a controller with a hundred
+switches costs a few hundred bytes.  Release polling only looks at the bits
+that are both pressed and pollable.
+"""
+
+from __future__ import annotations
+
+from array import array
+from midi import ControlChange, Event, ProgramChange
+from RPi import GPIO
+import threading
+import time
+from typing import Callable, List, Optional, Sequence
+
+# Callback for a switch event: (index, time).
+SwitchHandler = Callable[[int, float], None]
+
+# Default debounce time, in seconds.
+DEBOUNCE_TIME = 0.1
+
+# Midi switch table layout: 16 channels of 128 control changes followed by
+# 16 channels of 128 program changes.
+_MIDI_CC = 0
+_MIDI_PROGRAM = 16 * 128
+
+class SwitchDevice:
+    """A block of switches in the matrix.
+
+    Attributes:
+        name: Device name.
+        base: Index of the device's first switch.
+        count: Number of switches.
+        read: If provided, called with the index (relative to the device) of
+            a pressed switch to poll for its release.  Returns true if the
+            switch is still down.
+        on_press: If provided, overrides the matrix press handler for the
+            switches of this device.  Unlike the matrix handler, this is
+            called with the index relative to the device.
+        on_release: Likewise for the release handler.
+    """
+
+    __slots__ = ('name', 'base', 'count', 'read', 'on_press', 'on_release')
+
+    def __init__(self, name: str, base: int, count: int,
+                 read: Optional[Callable[[int], bool]],
+                 on_press: Optional[SwitchHandler],
+                 on_release: Optional[SwitchHandler]
+                 ):
+        self.name = name
+        self.base = base
+        self.count = count
+        self.read = read
+        self.on_press = on_press
+        self.on_release = on_release
+
+class SwitchMatrix:
+    """Tracks the state of all switches and dispatches their events.
+
+    Attributes:
+        on_press: Called with (index, time) when a switch is pressed.
+        on_release: Called with (index, time) when a switch is released.
+    """
+
+    def __init__(self):
+        self.on_press : Optional[SwitchHandler] = None
+        self.on_release : Optional[SwitchHandler] = None
+        self.devices : List[SwitchDevice] = []
+        self.size = 0
+
+        # Bitmasks of the pressed switches and of the switches whose release
+        # is detected by polling.
+        self.__pressed = 0
+        self.__polled = 0
+
+        # Per-switch arrays: time of the last event, debounce time and index
+        # of the owning device.
+        self.__last_event = array('d')
+        self.__debounce = array('d')
+        self.__owner = array('H')
+
+        # Mapping from midi message (see _MIDI_CC and _MIDI_PROGRAM) to
+        # switch index, -1 if unbound.
+        self.__midi = array('i', [-1]) * (2 * 16 * 128)
+
+        self.__lock = threading.Lock()
+
+    def add_device(self, name: str, count: int,
+                   debounce: float = DEBOUNCE_TIME,
+                   read: Optional[Callable[[int], bool]] = None,
+                   on_press: Optional[SwitchHandler] = None,
+                   on_release: Optional[SwitchHandler] = None
+                   ) -> SwitchDevice:
+        """Add a device with 'count' switches.
+
+        Args:
+            name: Device name, which must be unique.
+            count: Number of switches.
+            debounce: Presses less than this many seconds after the last
+                event on the same switch are ignored.
+            read: Release polling function, see SwitchDevice.
+            on_press: Press handler override, see SwitchDevice.
+            on_release: Release handler override, see SwitchDevice.
+
+        Returns the new device.  Its 'base' attribute is the index of its
+        first switch.
+        """
+        with self.__lock:
+            if self.get_device(name):
+                raise ValueError(f'Switch device {name} already exists')
+            device = SwitchDevice(name, self.size, count, read, on_press,
+                                  on_release
+                                  )
+            owner = len(self.devices)
+            self.devices.append(device)
+            self.__last_event.extend([0.0] * count)
+            self.__debounce.extend([debounce] * count)
+            self.__owner.extend([owner] * count)
+            if read:
+                self.__polled |= ((1 << count) - 1) << self.size
+            self.size += count
+            return device
+
+    def add_gpio_device(self, name: str, pins: Sequence[int],
+                        debounce: float = DEBOUNCE_TIME,
+                        poll_release: bool = True,
+                        on_press: Optional[SwitchHandler] = None,
+                        on_release: Optional[SwitchHandler] = None
+                        ) -> SwitchDevice:
+        """Add a device for switches on GPIO pins.
+
+        The pins are pulled up, a switch is down when its pin reads zero.
+
+        Args:
+            name: Device name.
+            pins: The GPIO (BCM) pin numbers of the switches.
+            debounce: See add_device().
+            poll_release: If false, the release isn't polled for and the
+                switches are released immediately after they're pressed.
+            on_press: See add_device().
+            on_release: See add_device().
+        """
+        pins = list(pins)
+        device = self.add_device(
+            name, len(pins), debounce,
+            read=(lambda i: not GPIO.input(pins[i])) if poll_release else None,
+            on_press=on_press,
+            on_release=on_release
+        )
+        for i, pin in enumerate(pins):
+            index = device.base + i
+            if poll_release:
+                callback = lambda x, index=index: self.set(index, True)
+            else:
+                callback = lambda x, index=index: self.tap(index)
+            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            GPIO.add_event_detect(pin, GPIO.FALLING, callback=callback)
+        return device
+
+    def get_device(self, name: str) -> Optional[SwitchDevice]:
+        for device in self.devices:
+            if device.name == name:
+                return device
+        return None
+
+    def bind_midi_cc(self, index: int, channel: int, controller: int) -> None:
+        """Drive switch 'index' from a midi control change.
+
+        Values of 64 and above press the switch, lower values release it.
+        """
+        self.__midi[_MIDI_CC + channel * 128 + controller] = index
+
+    def bind_midi_program(self, index: int, channel: int, program: int
+                          ) -> None:
+        """Drive switch 'index' from a midi program change.
+
+        Program changes carry no release, so the switch is pressed and
+        immediately released.
+        """
+        self.__midi[_MIDI_PROGRAM + channel * 128 + program] = index
+
+    def handle_midi(self, event: Event) -> bool:
+        """Midi input handler for the bound switches.
+
+        Returns true if the event was consumed.
+        """
+        if isinstance(event, ControlChange):
+            index = self.__midi[_MIDI_CC + event.channel * 128 +
+                                event.controller]
+            if index < 0:
+                return False
+            self.set(index, event.value >= 64)
+            return True
+        elif isinstance(event, ProgramChange):
+            index = self.__midi[_MIDI_PROGRAM + event.channel * 128 +
+                                event.program]
+            if index < 0:
+                return False
+            self.tap(index)
+            return True
+        return False
+
+    def set(self, index: int, pressed: bool, t: Optional[float] = None,
+            debounce: bool = True
+            ) -> bool:
+        """Report a switch event.
+
+        Presses are debounced unless 'debounce' is false (for events that
+        don't come from hardware), releases are not (polled devices only
+        poll for release after the debounce time).
+
+        Returns true if the event changed the state of the switch.
+        """
+        t = time.time() if t is None else t
+        bit = 1 << index
+        with self.__lock:
+            if pressed:
+                if self.__pressed & bit or debounce and \
+                        t - self.__last_event[index] <= self.__debounce[index]:
+                    # Store the time so a bouncing switch stays debounced.
+                    self.__last_event[index] = t
+                    return False
+                self.__pressed |= bit
+            else:
+                if not self.__pressed & bit:
+                    return False
+                self.__pressed &= ~bit
+            self.__last_event[index] = t
+            device = self.devices[self.__owner[index]]
+
+        if pressed:
+            override, handler = device.on_press, self.on_press
+        else:
+            override, handler = device.on_release, self.on_release
+        if override:
+            override(index - device.base, t)
+        elif handler:
+            handler(index, t)
+        return True
+
+    def tap(self, index: int) -> None:
+        """Press and release a switch."""
+        t = time.time()
+        if self.set(index, True, t):
+            self.set(index, False, t)
+
+    def poll(self, t: Optional[float] = None) -> None:
+        """Poll the pressed switches of polled devices for release."""
+        t = time.time() if t is None else t
+        mask = self.__pressed & self.__polled
+        while mask:
+            low = mask & -mask
+            mask ^= low
+            index = low.bit_length() - 1
+            if t - self.__last_event[index] <= self.__debounce[index]:
+                continue
+            device = self.devices[self.__owner[index]]
+            if not device.read(index - device.base):
+                self.set(index, False, t)
+
+    def is_pressed(self, index: int) -> bool:
+        return bool(self.__pressed >> index & 1)
+
+    @property
+    def pressed(self) -> int:
+        """Bitmask of the pressed switches."""
+        return self.__pressed
@@ -0,0 +1,180 @@
+"""Built-in tuner.
+
+Pitch detection is the YIN algorithm (de Cheveigné and Kawahara, 2002)
+vectorized with numpy: the difference function is computed from an FFT
+autocorrelation and a running sum of squares rather than a loop over lags.
+
+The Tuner reads from an audio tap (see the audiotap module), which only
+exists while the tuner is running, so starting it costs a client activation
+rather than a process launch and it costs nothing at all when it's not in
+use.
+
+Run this module to test the detector against synthetic signals:
+
+    python3 tuner.py
+"""
+
+from __future__ import annotations
+
+from audiotap import get_tap
+from boot import lazy_import
+import math
+import os
+import sys
+from typing import Optional, Tuple
+
+np = lazy_import('numpy')
+
+# Capture port to tune from, override with the PIDAL_TUNER_PORT environment
+# variable.
+TUNER_PORT = os.environ.get('PIDAL_TUNER_PORT', 'system:capture_1')
+
+# Detection range: a bit below a 5 string bass's low B and a bit above the
+# guitar's top fret on the high E string.
+MIN_FREQ = 28.0
+MAX_FREQ = 1400.0
+
+# Analysis window, in seconds.  This must hold at least two periods of
+# MIN_FREQ.
+WINDOW_TIME = 0.08
+
+# YIN threshold on the cumulative mean normalized difference.
+THRESHOLD = 0.15
+
+# Signals with a lower RMS level than this are treated as silence.
+MIN_LEVEL = 1e-3
+
+NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#',
+              'B'
+              ]
+
+def detect_pitch(frames: np.ndarray, samplerate: int,
+                 min_freq: float = MIN_FREQ,
+                 max_freq: float = MAX_FREQ,
+                 threshold: float = THRESHOLD
+                 ) -> Optional[float]:
+    """Returns the fundamental frequency of 'frames', None if there's no
+    clear pitch.
+
+    Args:
+        frames: The signal.  Must be longer than two periods of 'min_freq'.
+        samplerate: Sample rate of 'frames'.
+        min_freq: Lowest frequency to detect.
+        max_freq: Highest frequency to detect.
+        threshold: YIN threshold, lower is stricter.
+    """
+    x = np.asarray(frames, dtype=np.float64)
+    size = len(x)
+    max_lag = min(int(samplerate / min_freq) + 1, size // 2)
+    min_lag = max(int(samplerate / max_freq), 2)
+    width = size - max_lag
+    if max_lag <= min_lag or \
+            np.sqrt(np.mean(x * x)) < MIN_LEVEL:
+        return None
+
+    # Difference function d(lag) = sum((x[j] - x[j + lag])^2) over j in
+    # [0, width), expanded as energy(0) + energy(lag) - 2 * corr(lag).
+    fft_size = 1 << (size + width).bit_length()
+    spectrum = np.fft.rfft(x, fft_size)
+    window = np.fft.rfft(x[:width], fft_size)
+    corr = np.fft.irfft(spectrum * np.conj(window), fft_size)[:max_lag + 1]
+    squares = np.concatenate(([0.0], np.cumsum(x * x)))
+    lags = np.arange(max_lag + 1)
+    energy = squares[lags + width] - squares[lags]
+    diff = np.maximum(energy[0] + energy - 2 * corr, 0.0)
+
+    # Cumulative mean normalized difference.
+    cmnd = np.ones_like(diff)
+    running = np.cumsum(diff[1:])
+    cmnd[1:] = diff[1:] * lags[1:] / np.maximum(running, 1e-12)
+
+    # The first dip below the threshold, followed down to its minimum.
+    below = np.flatnonzero(cmnd[min_lag:max_lag] < threshold)
+    if not below.size:
+        return None
+    lag = min_lag + int(below[0])
+    while lag + 1 < max_lag and cmnd[lag + 1] < cmnd[lag]:
+        lag += 1
+
+    # Parabolic interpolation between the neighbouring lags.
+    prev, cur, next = cmnd[lag - 1], cmnd[lag], cmnd[lag + 1]
+    denom = prev - 2 * cur + next
+    offset = 0.5 * (prev - next) / denom if denom > 0 else 0.0
+    return samplerate / (lag + offset)
+
+def note_for(freq: float, a4: float = 440.0) -> Tuple[str, int, float]:
+    """Returns the nearest note to 'freq' as (name, octave, cents), where
+    cents is the deviation from the note (-50 to 50).
+    """
+    semitones = 12 * math.log2(freq / a4) + 69
+    note = int(round(semitones))
+    return (NOTE_NAMES[note % 12], note // 12 - 1,
+            (semitones - note) * 100
+            )
+
+class Tuner:
+    """Detects the pitch of a JACK capture port while running."""
+
+    def __init__(self, port: str = TUNER_PORT):
+        """
+        Args:
+            port: Name of the JACK port to tune from.
+        """
+        self.tap = get_tap([port])
+        self.running = False
+
+    def start(self) -> None:
+        """Start listening to the port."""
+        if not self.running:
+            self.tap.acquire()
+            self.running = True
+
+    def stop(self) -> None:
+        """Stop listening."""
+        if self.running:
+            self.running = False
+            self.tap.release()
+
+    def get_pitch(self) -> Optional[float]:
+        """Returns the current frequency, None if not running or there's no
+        clear pitch.
+        """
+        if not self.running:
+            return None
+        samplerate = self.tap.samplerate
+        return detect_pitch(
+            self.tap.rings[0].window(int(WINDOW_TIME * samplerate)),
+            samplerate
+        )
+
+if __name__ == '__main__':
+    rate = 48000
+    t = np.arange(int(WINDOW_TIME * rate)) / rate
+    rng = np.random.default_rng(1)
+    failures = 0
+    for freq in (30.87, 41.2, 82.41, 110.0, 146.83, 196.0, 246.94, 329.63,
+                 440.0, 659.26, 1318.5):
+        # A plucked-string-like signal: harmonics with decaying amplitude, a
+        # random phase and some noise.
+        signal = sum(np.sin(2 * np.pi * freq * n * t + rng.uniform(0, 6)) / n
+                     for n in range(1, 6)
+                     )
+        signal = 0.3 * signal + rng.normal(0, 0.01, len(t))
+        detected = detect_pitch(signal.astype(np.float32), rate)
+        if detected is None:
+            error = float('inf')
+        else:
+            error = 1200 * math.log2(detected / freq)
+        name, octave, cents = note_for(freq)
+        ok = abs(error) < 2
+        failures += not ok
+        print(f'{freq:8.2f} Hz {name:>2}{octave} ({cents:+5.1f}c): '
+              f'{detected or 0:8.2f} Hz, error {error:+.2f}c '
+              f'{"ok" if ok else "FAIL"}')
+    if detect_pitch(rng.normal(0, 0.3, len(t)), rate) is not None:
+        print('noise detected as a pitch: FAIL')
+        failures += 1
+    if detect_pitch(np.zeros(len(t)), rate) is not None:
+        print('silence detected as a pitch: FAIL')
+        failures += 1
+    sys.exit(1 if failures else 0)
@@ -1,13 +1,25 @@
 """Hog 1 Pidal User interface."""
 
 import attr
-from engine import Config, Engine, ProcessManager, FSIO
+from engine import Config, Engine, FSIO, CONFIG_CHANGE, CONFIG_LIST, \
+    CONFIG_PENDING, PEDAL_BUTTON_STATUS
+from events import EventQueue
 from typing import Any, Callable, List, Optional
 from tkinter import Button, Frame, Label, Listbox, Tk, Toplevel, BOTH, END, \
     NSEW, W
 from RPi import GPIO
 import subprocess
 from tkinter.font import Font
+from tuner import note_for, Tuner
+
+# Interval at which engine events are delivered to the UI, in milliseconds.
+EVENT_POLL_MS = 20
+
+# Interval between tuner display updates, in milliseconds.
+TUNER_POLL_MS = 50
+
+# Deviation within which the tuner shows a note as in tune, in cents.
+IN_TUNE_CENTS = 3
 
 def fs_pressed(action: Callable[[], None]) -> Callable[[bool], Any]:
     """Returns a handler that calls 'action' only when the button is pressed.
@@ -37,23 +49,21 @@ class Menu(Listbox):
 
         self.bind('<Double-Button-1>', self.selected)
         engine = Engine.get_instance()
-        engine.push_switch_configs()
-        engine.register_microswitch(0, self.close)
-        engine.register_microswitch(1, self.select_prev)
-        engine.register_microswitch(2, self.select_next)
-        engine.register_microswitch(3, self.selected)
+        self.layer = layer = engine.layers.push('menu')
+        engine.register_microswitch(0, self.close, layer)
+        engine.register_microswitch(1, self.select_prev, layer)
+        engine.register_microswitch(2, self.select_next, layer)
+        engine.register_microswitch(3, self.selected, layer)
 
         index = \
             self.selbox[0] if self.selbox and self.selbox[0] < len(data) else 0
 
         self.selection_set(index)
 
-        engine = Engine.get_instance()
-        engine.push_fs()
-        engine.register_footswitch(0, fs_pressed(self.select_prev))
-        engine.register_footswitch(1, fs_pressed(self.select_next))
-        engine.register_footswitch(2, fs_pressed(self.selected))
-        engine.register_footswitch(3, fs_pressed(self.close))
+        engine.register_footswitch(0, fs_pressed(self.select_prev), layer)
+        engine.register_footswitch(1, fs_pressed(self.select_next), layer)
+        engine.register_footswitch(2, fs_pressed(self.selected), layer)
+        engine.register_footswitch(3, fs_pressed(self.close), layer)
 
         # Just to simplify navigation
         self.bind('<Escape>', self.close)
@@ -81,15 +91,14 @@ class Menu(Listbox):
             self.see(cur - 1)
 
     def close(self, event=None):
-        engine = Engine.get_instance()
-        engine.pop_switch_configs()
-        engine.pop_fs()
+        Engine.get_instance().layers.pop(self.layer)
         self.destroy()
 
     def selected(self, *evt) -> Optional[str]:
         selections = self.curselection()
         if selections:
             self.selbox[:] = [selections[0]]
+            Engine.get_instance().state_changed()
             item = self.data[selections[0]]
             toplevel = self.winfo_toplevel()
             self.close()
@@ -99,15 +108,30 @@ class Menu(Listbox):
 def edit_config_selected(screen: 'Screen') -> None:
     print('got menu')
 
-last_config_selected = []
-
 def list_configs_selected(screen: 'Screen') -> None:
     engine = Engine.get_instance()
     items = [
         MenuItem(config.name, lambda s, cfg=config: engine.set_config(cfg))
         for config in engine.get_all_configs()
     ]
-    menu = Menu(screen, items, last_config_selected)
+
+    # The last selection is stored in the engine snapshot.
+    menu = Menu(screen, items, engine.ui_state.setdefault('config_menu', []))
+
+def learn_controller_selected(screen: 'Screen') -> None:
+    """Shows the controllers of the current config, selecting one puts the
+    engine in midi learn mode for it.
+    """
+    engine = Engine.get_instance()
+    config = engine.cur_config
+    items = [
+        MenuItem(name,
+                 lambda s, name=name: engine.learn_controller(name, config)
+                 )
+        for name in sorted(config.controller_targets())
+    ]
+    if items:
+        menu = Menu(screen, items)
 
 def restart_shell_selected(screen: 'Screen') -> None:
     screen.destroy()
@@ -115,24 +139,8 @@ def restart_shell_selected(screen: 'Screen') -> None:
 def shutdown_selected(screen: 'Screen') -> None:
     subprocess.call(['sudo', 'shutdown', '-h', 'now'])
 
-# XXX Put this in another module.
-
-pre_tuner_config = None
-tuner_proc = None
-
-def end_tuner(pressed: bool) -> None:
-    global tuner_proc
-    tuner_proc = None
-    Engine.get_instance().set_config(pre_tuner_config)
-
 def tuner_selected(screen: 'Screen') -> None:
-    global pre_tuner_config, tuner_proc
-    engine = Engine.get_instance()
-    pre_tuner_config = engine.cur_config
-    engine.set_config(Config('Tuner'))
-    tuner_proc = ProcessManager(subprocess.Popen(['lingot']))
-    for i in range(4):
-        engine.register_footswitch(i, end_tuner)
+    screen.home.show_tuner()
 
 class FSButton(Button):
     """Panel to show the state of a footswitch button."""
@@ -157,14 +165,30 @@ class Home(Frame):
     def __init__(self, top: Toplevel):
         super().__init__(top)
         self._add_top_button('Menu', self.show_menu, 0)
-        self._add_top_button('Tuner',
-                             lambda: tuner_selected(self.winfo_toplevel()), 1)
+        self._add_top_button('Tuner', self.show_tuner, 1)
         self.title = Label(self, text='Config Name',
                            font=Font(family='Roboto', size=72)
                            )
         self.title.grid(row=1, column=0, columnspan=4, sticky=NSEW)
         self.rowconfigure(1, weight=1)
 
+        # Covers the title until the engine has entered its first config
+        # (the one restored from the snapshot, usually), so that nothing
+        # else is shown while it starts up.
+        self.splash = Label(self, text='Starting',
+                            font=Font(family='Roboto', size=72),
+                            foreground='gray'
+                            )
+        self.splash.grid(row=1, column=0, columnspan=4, sticky=NSEW)
+
+        # The tuner display replaces the title while the tuner is running.
+        self.tuner = Tuner()
+        self.tuner_display = Label(self, font=Font(family='Roboto', size=72),
+                                   background='black'
+                                   )
+        self.__tuner_layer = None
+        self.__pre_tuner_config = None
+
         self.buttons = []
         for i, name in enumerate(('Dist', 'Wah', 'Phase', 'Lead')):
             btn = FSButton(self, name)
@@ -173,23 +197,87 @@ class Home(Frame):
             self.columnconfigure(i, weight=1, uniform=True)
 
         engine = Engine.get_instance()
-        engine.subscribe('config_change', self.on_config_change)
-        engine.register_microswitch(0, self.show_menu)
-
-        engine.subscribe('pedal_button_status', self.on_pedal_button_status)
-        engine.subscribe('config_list',
-                         lambda scr=top: list_configs_selected(scr))
+        engine.register_microswitch(0, self.show_menu, engine.base_layer)
+
+        # Events are published from the engine's threads, Tk needs them
+        # delivered in its own thread.
+        self.events = events = EventQueue()
+        CONFIG_CHANGE.subscribe(self.on_config_change, events)
+        PEDAL_BUTTON_STATUS.subscribe(self.on_pedal_button_status, events)
+        CONFIG_PENDING.subscribe(self.on_config_pending, events)
+        CONFIG_LIST.subscribe(lambda scr=top: list_configs_selected(scr),
+                              events
+                              )
+        self.__drain_events()
+
+    def __drain_events(self) -> None:
+        self.events.drain()
+        self.after(EVENT_POLL_MS, self.__drain_events)
 
     def show_menu(self, *args):
         items = [MenuItem('Edit Config', edit_config_selected),
                  MenuItem('List Configs', list_configs_selected),
                  MenuItem('Tuner', tuner_selected),
+                 MenuItem('Learn Controller', learn_controller_selected),
+                 MenuItem('Cancel Learn',
+                          lambda s: Engine.get_instance().cancel_learn()),
                  MenuItem('Restart Shell', restart_shell_selected),
                  MenuItem('Shutdown', shutdown_selected),
                  ]
         menu = Menu(self.winfo_toplevel(), items)
 
+    def show_tuner(self, *args) -> None:
+        """Start the tuner.  Any footswitch ends it."""
+        if self.tuner.running:
+            return
+        engine = Engine.get_instance()
+
+        # Switch to an empty config to mute the effects while tuning.
+        self.__pre_tuner_config = engine.cur_config
+        engine.set_config(Config('Tuner'))
+        self.__tuner_layer = layer = engine.layers.push('tuner')
+        for i in range(len(FSIO)):
+            engine.register_footswitch(i, fs_pressed(self.end_tuner), layer)
+
+        self.tuner.start()
+        self.tuner_display.configure(text='', foreground='gray')
+        self.tuner_display.grid(row=1, column=0, columnspan=4, sticky=NSEW)
+        self.__update_tuner()
+
+    def end_tuner(self) -> None:
+        """Stop the tuner and go back to the config it interrupted.
+
+        This is called from the engine's threads.
+        """
+        if not self.tuner.running:
+            return
+        self.tuner.stop()
+        engine = Engine.get_instance()
+        engine.layers.pop(self.__tuner_layer)
+        if self.__pre_tuner_config:
+            engine.set_config(self.__pre_tuner_config)
+
+    def __update_tuner(self) -> None:
+        if not self.tuner.running:
+            self.tuner_display.grid_remove()
+            return
+        freq = self.tuner.get_pitch()
+        if freq is not None:
+            name, octave, cents = note_for(freq)
+            marks = min(int(abs(cents) / 10) + 1, 5)
+            if abs(cents) <= IN_TUNE_CENTS:
+                text, color = f'> {name}{octave} <', 'LawnGreen'
+            elif cents < 0:
+                text, color = '<' * marks + f' {name}{octave}', 'orange'
+            else:
+                text, color = f'{name}{octave} ' + '>' * marks, 'orange'
+            self.tuner_display.configure(text=f'{text}\n{cents:+.0f}c',
+                                         foreground=color
+                                         )
+        self.after(TUNER_POLL_MS, self.__update_tuner)
+
     def on_config_change(self, config: Config) -> None:
+        self.splash.grid_remove()
         self.title.configure(text=config.name)
         for i, button_name in enumerate(config.buttons):
             self.buttons[i].set_title(button_name)
@@ -197,6 +285,15 @@ class Home(Frame):
                                       background='black'
                                       )
 
+    def on_config_pending(self, config: Config, pending: bool) -> None:
+        """Shows whether the config is still waiting for something to start
+        up.
+        """
+        self.title.configure(
+            text=f'{config.name} (starting)' if pending else config.name,
+            foreground='gray' if pending else 'black'
+        )
+
     def on_pedal_button_status(self, pedal: int, active: bool) -> None:
         if active:
             self.buttons[pedal].configure(background='darkgreen',
@@ -210,8 +307,10 @@ class Home(Frame):
 class Screen(Tk):
 
     def simulate_fs_pressed(self, index: int) -> None:
-        Engine.get_instance().footswitch_pressed(index)
+        # Set the pin first, otherwise the engine can poll for the release
+        # before we do.
         GPIO.clear_gpios.add(FSIO[index])
+        Engine.get_instance().footswitch_pressed(index)
 
     def simulate_fs_released(self, index: int) -> None:
         GPIO.clear_gpios.remove(FSIO[index])
@@ -1,47 +1,41 @@
 import abc
 import attr
 from engine import Config, Engine
+from gestures import GestureHandler, HOLD, LONG_PRESS, TAP
 import itertools
-from typing import Any, Callable, List
+from looper import Looper, OVERDUBBING, RECORDING
+from typing import Any, Callable, Dict, List, Optional
 
 engine = Engine.get_instance()
 
-def double_press(func: Callable[[bool], None],
-                 alt_func: Callable[[bool], None],
-                 other: int
-                 ) -> Callable[[bool], None]:
-    """Returns a footswitch-press handler to handle simultaneous depress of two
-    footswitches.
-
-    Returns a handler that calls alt_func() if footswitch 'other' is also
-    depressed and calls func() if not.  This has the effect of binding the
-    press of both footswitches to alt_func.
-
-    Note that this isn't perfect, as triggering the first footswitch will
-    still result in a "pressed" event being passed through to func().
-    Furthermore, all footswitch released events will continue to be passed to
-    func.
-    """
-    def handler(pressed: bool) -> None:
-        if pressed:
-            engine = Engine.get_instance()
-            if engine.is_fs_pressed(other):
-                alt_func(pressed)
-                return
-        func(pressed)
-
-    return handler
-
-def show_config_list(pressed: bool) -> None:
+def show_config_list(pressed: bool = True) -> None:
     if pressed:
         engine.notify('config_list')
 
+def register_config_list_chord() -> None:
+    """Bind the simultaneous press of footswitches 2 and 3 to the config
+    list.
+
+    Must be called after the footswitches for the config have been
+    registered, since set_config() clears the old bindings.
+    """
+    engine.register_chord((2, 3), show_config_list)
+
 class Button:
-    """Should have a text attribute and a make_callback method?"""
+    """Should have a text attribute and a make_callback method?
+
+    'make_gestures', if provided, returns the gesture handlers to bind on the
+    button's footswitch (a mapping from gesture name to handler, see the
+    gestures module).
+    """
     def __init__(self, text: str,
-                 make_callback: Callable[[int], Callable[[bool], Any]]):
+                 make_callback: Callable[[int], Callable[[bool], Any]],
+                 make_gestures: Optional[
+                     Callable[[int], Dict[str, GestureHandler]]
+                 ] = None):
         self.text = text
         self.make_callback = make_callback
+        self.make_gestures = make_gestures
 
 class ButtonGroup(abc.ABC):
     """A group of buttons or a single button that work together."""
@@ -54,6 +48,22 @@ class ButtonGroup(abc.ABC):
     def expand_buttons(self) -> List[Button]:
         pass
 
+    def get_state(self) -> Any:
+        """Returns the JSON serializable state of the group."""
+        return None
+
+    def set_state(self, state: Any) -> None:
+        """Restore the state returned by get_state()."""
+        pass
+
+    def on_enter(self) -> None:
+        """Called when the group's config is selected."""
+        pass
+
+    def on_leave(self) -> None:
+        """Called when the group's config is left."""
+        pass
+
 class ToggleButton(ButtonGroup):
     def __init__(self, text: str, enable: Callable[[], Any],
                  disable: Callable[[], Any],
@@ -116,6 +126,69 @@ class RadioController(ButtonGroup):
         return [Button(button.text, self.make_button_callback)
                 for button in self.buttons]
 
+    def get_state(self) -> Any:
+        return self.active
+
+    def set_state(self, state: Any) -> None:
+        if state != self.active:
+            self.make_button_callback(state)(True)
+
+class LoopButtons(ButtonGroup):
+    """A looper (see the looper module) on two buttons:
+
+        Loop (press)    Record, then play.  While playing, overdub, then
+                        play.  While stopped, play.
+        Undo (tap)      Undo the last layer (or the take being recorded).
+        Undo (hold)     Stop or restart playback.
+        Undo (long)     Clear the loop.
+
+    The Loop button acts on press rather than on a recognized gesture so
+    that the loop points are as tight as the switch.
+    """
+
+    def __init__(self, looper: Looper):
+        self.looper = looper
+        self.__index = 0
+
+    def on_enter(self) -> None:
+        self.looper.start()
+
+    def on_leave(self) -> None:
+        self.looper.stop()
+
+    def __notify(self) -> None:
+        active = self.looper.state in (RECORDING, OVERDUBBING)
+        engine.notify('pedal_button_status', self.__index, active)
+
+    def make_loop_callback(self, index: int) -> Callable[[bool], None]:
+        self.__index = index
+        def button_callback(pressed: bool) -> None:
+            if pressed:
+                self.looper.advance()
+                self.__notify()
+        return button_callback
+
+    def make_undo_gestures(self, index: int) -> Dict[str, GestureHandler]:
+        def then_notify(action: Callable[[], None]) -> GestureHandler:
+            def handler() -> None:
+                action()
+                self.__notify()
+            return handler
+        return {TAP: then_notify(self.looper.undo),
+                HOLD: then_notify(self.looper.toggle_play),
+                LONG_PRESS: then_notify(self.looper.clear),
+                }
+
+    def expand_buttons(self) -> List[Button]:
+        return [Button('Loop', self.make_loop_callback),
+                Button('Undo', lambda index: lambda pressed: None,
+                       self.make_undo_gestures
+                       )
+                ]
+
+    def make_button_callback(self, index: int) -> None:
+        return self.make_loop_callback(index)
+
 class ConfigFramework(Config):
     """Config base class that lets you define a config in terms of a
     standardized set of button behaviors and a standardized set of actions.
@@ -127,19 +200,34 @@ class ConfigFramework(Config):
             buttons: An array of exactly four buttons.
         """
         super().__init__(name)
+        self.button_groups = button_groups
         self.button_objects = list(itertools.chain.from_iterable(
             group.expand_buttons() for group in button_groups))
         assert(len(self.button_objects) == 4)
         self.buttons = [button.text for button in self.button_objects]
 
     def on_enter(self):
+        for group in self.button_groups:
+            group.on_enter()
         for index, button in enumerate(self.button_objects):
-            callback = button.make_callback(index)
-            if index == 2:
-                callback = double_press(callback, show_config_list, 3)
-            elif index == 3:
-                callback = double_press(callback, show_config_list, 2)
-            engine.register_footswitch(index, callback)
+            engine.register_footswitch(index, button.make_callback(index))
+            make_gestures = getattr(button, 'make_gestures', None)
+            if make_gestures:
+                for gesture, handler in make_gestures(index).items():
+                    engine.register_gesture(index, gesture, handler)
+        register_config_list_chord()
+
+    def on_leave(self):
+        for group in self.button_groups:
+            group.on_leave()
+
+    def get_state(self) -> Any:
+        return [group.get_state() for group in self.button_groups]
+
+    def set_state(self, state: Any) -> None:
+        for group, group_state in zip(self.button_groups, state):
+            if group_state is not None:
+                group.set_state(group_state)
 
 @attr.s
 class Actuator:
@@ -199,3 +287,18 @@ class FlagSetController(ButtonGroup):
     def expand_buttons(self):
         return [Button(name, self.make_button_callback)
                 for name in self.button_names]
+
+    def get_state(self) -> Any:
+        return self.state
+
+    def set_state(self, state: Any) -> None:
+        if state == self.state or state >= len(self.states):
+            return
+        self.states[self.state].disable()
+        self.states[state].enable()
+        self.state = state
+        first = self.first or 0
+        for i in range(len(self.button_names)):
+            engine.notify('pedal_button_status', first + i,
+                          bool(state & (1 << i))
+                          )
@@ -0,0 +1,104 @@
+"""File change notification using inotify.
+
+This talks to inotify directly through ctypes so that it doesn't need any
+additional packages.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import os
+import select
+import struct
+import threading
+from typing import Callable, Dict, List, Set, Tuple
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_CLOEXEC = 0o2000000
+
+# Header of a struct inotify_event: wd, mask, cookie, len.
+_EVENT_HEADER = struct.Struct('iIII')
+
+# Time to wait for a burst of events for the same file to finish (editors
+# often write a file several times or write and rename it).
+SETTLE_TIME = 0.1
+
+class FileWatcher:
+    """Calls a function when a file is changed.
+
+    We watch the directory containing the file rather than the file itself
+    because a lot of editors save by writing a new file and renaming it over
+    the old one.  Callbacks are called from the watcher thread.
+    """
+
+    def __init__(self):
+        self.__libc = ctypes.CDLL(None, use_errno=True)
+        self.__fd = self.__libc.inotify_init1(IN_CLOEXEC)
+        if self.__fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        # Mapping from watch descriptor to directory.
+        self.__dirs : Dict[int, str] = {}
+
+        # Mapping from (directory, basename) to callbacks.
+        self.__callbacks : Dict[Tuple[str, str], List[Callable[[], None]]] = \
+            {}
+        self.__lock = threading.Lock()
+
+        thread = threading.Thread(target=self.__run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def watch(self, filename: str, callback: Callable[[], None]) -> None:
+        """Call 'callback' whenever 'filename' is written."""
+        dirname, basename = os.path.split(os.path.abspath(filename))
+        with self.__lock:
+            if dirname not in self.__dirs.values():
+                wd = self.__libc.inotify_add_watch(
+                    self.__fd, dirname.encode(),
+                    IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+                )
+                if wd < 0:
+                    errno = ctypes.get_errno()
+                    raise OSError(errno, os.strerror(errno), dirname)
+                self.__dirs[wd] = dirname
+            self.__callbacks.setdefault((dirname, basename), []).append(
+                callback
+            )
+
+    def __read_events(self, changed: Set[Tuple[str, str]]) -> None:
+        """Read the available events, adding the changed files to 'changed'.
+        """
+        data = os.read(self.__fd, 4096)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = \
+                _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+            dirname = self.__dirs.get(wd)
+            if dirname:
+                changed.add((dirname, name))
+
+    def __run(self) -> None:
+        while True:
+            changed = set()
+            self.__read_events(changed)
+
+            # Collect everything else that happens until things settle down.
+            while select.select([self.__fd], [], [], SETTLE_TIME)[0]:
+                self.__read_events(changed)
+
+            for key in changed:
+                with self.__lock:
+                    callbacks = list(self.__callbacks.get(key, []))
+                for callback in callbacks:
+                    try:
+                        callback()
+                    except Exception as ex:
+                        print(f'Error handling change to {key[1]}: {ex}')